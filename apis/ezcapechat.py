@@ -1,6 +1,15 @@
 from util import web
 
 
+# retry policy used for the room page and join_room requests.
+RETRY_POLICY = web.RetryPolicy(attempts=3, timeout=10, backoff=0.5, max_backoff=4, deadline=25, hedge_after=4)
+
+
+class PageLoadError(Exception):
+    """ Raised when the room page could not be loaded. """
+    pass
+
+
 class MissingFlashVarsError(Exception):
     """ Raised on missing flash vars. """
     pass
@@ -20,7 +29,7 @@ class Params:
     _t2_post_url = u'https://www.ezcapechat.com/php/ajax/join_room.php?n={0}'
     _html_source = u''
 
-    def __init__(self, room_name, username, n_key=None, proxy=None):
+    def __init__(self, room_name, username, n_key=None, proxy=None, retry=None):
         """
         Initialize the Params class.
 
@@ -32,23 +41,26 @@ class Params:
         :type n_key: str
         :param proxy: Use a proxy for requests.
         :type proxy: str
+        :param retry: The retry policy for the requests, defaults to RETRY_POLICY.
+        :type retry: web.RetryPolicy
         """
         self._room_name = room_name
         self._username = username
         self._provided_n_key = n_key
         self._proxy = proxy
+        self._retry = retry or RETRY_POLICY
         self._n_key = u''
         self._flash_vars = []
         self._t2 = u''
 
-        page = web.get(url=self._base_url.format(self._room_name), proxy=self._proxy)
+        page = web.get(url=self._base_url.format(self._room_name), proxy=self._proxy, retry=self._retry)
         if page.error is None:
             self._html_source = page.content
             self._set_n_key()
             self._set_flash_vars()
             self._set_t2()
         else:
-            raise Exception('Something went wrong, page.error=%s' % page.error)
+            raise PageLoadError('Something went wrong, attempts=%s, page.error=%s' % (page.attempts, page.error))
 
     @property
     def ip(self):
@@ -185,23 +197,29 @@ class Params:
             ts = int(web.time.time())
             post_url = self._t2_post_url.format(self.n_key)
 
-            mpd = web.requests_toolbelt.MultipartEncoder(
-                fields={
-                    'room_name': self._room_name,
-                    'user_id': u'%s' % self.user_id,
-                    't1': self.t1,
-                    'username': self._username
-                },
-                boundary='-------------------------%s' % ts  # 3106125133281
-            )
+            def _multipart():
+                # a new encoder for each attempt, since the encoder can only be read once.
+                return web.requests_toolbelt.MultipartEncoder(
+                    fields={
+                        'room_name': self._room_name,
+                        'user_id': u'%s' % self.user_id,
+                        't1': self.t1,
+                        'username': self._username
+                    },
+                    boundary='-------------------------%s' % ts  # 3106125133281
+                )
 
             header = web.utils.CaseInsensitiveDict(data={
                 'Accept-Language': 'en-US,en;q=0.5',
-                'Content-Type': mpd.content_type
+                'Content-Type': _multipart().content_type
             })
 
-            response = web.post(url=post_url, post_data=mpd, header=header,
-                                referer=self._base_url.format(self._room_name), json=True, proxy=self._proxy)
+            response = web.post(url=post_url, post_data=_multipart, header=header,
+                                referer=self._base_url.format(self._room_name), json=True,
+                                proxy=self._proxy, retry=self._retry)
+
+            if response.error is not None:
+                raise CouldNotSetT2Error('attempts=%s, error=%s' % (response.attempts, response.error))
 
             if 'error' not in response.json:
                 if 't2' in response.json:
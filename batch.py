@@ -0,0 +1,190 @@
+""" Batched delivery of decoded events, for high volume consumers. """
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# event name: (field names, event data indexes)
+EVENT_FIELDS = {
+    'receivePublicMsg': (('timestamp', 'nick', 'msg'), (3, 4, 5)),
+    'pmReceive': (('nick', 'msg', 'color'), (3, 5, 6)),
+    'typingPM': (('nick',), (3,)),
+    'joinuser': (('nick', 'ml', 'st', 'id', 'su'), (3, 4, 5, 6, 7)),
+    'removeuser': (('nick',), (3,)),
+    'statusUpdate': (('data',), (3,))
+}
+
+# the events batched by default.
+DEFAULT_EVENTS = ('receivePublicMsg', 'joinuser', 'removeuser')
+
+
+def decode(event_data):
+    """
+    Decode command event data in to a tuple of fields.
+
+    Events without known fields are decoded as the event data following the event header.
+
+    :param event_data: The command event data.
+    :type event_data: list
+    :return: The decoded fields.
+    :rtype: tuple
+    """
+    fields = EVENT_FIELDS.get(event_data[0])
+    if fields is None:
+        return tuple(event_data[3:])
+    size = len(event_data)
+    return tuple(event_data[i] if i < size else None for i in fields[1])
+
+
+class Batch:
+    """ Class representing a batch of decoded events. """
+    def __init__(self, events):
+        """
+        Initialize the Batch.
+
+        :param events: A list of (event name, received time, fields) tuples, in the order received.
+        :type events: list
+        """
+        self.events = events
+
+    def __len__(self):
+        return len(self.events)
+
+    def records(self, event):
+        """
+        The decoded fields of all events with a name.
+
+        :param event: The event name, E.g receivePublicMsg
+        :type event: str
+        :return: A list of field tuples.
+        :rtype: list
+        """
+        return [fields for name, _, fields in self.events if name == event]
+
+    def columns(self, event):
+        """
+        The events with a name, in columnar form.
+
+        :param event: The event name, E.g receivePublicMsg
+        :type event: str
+        :return: A dictionary of field name to list of values, including the received times.
+        :rtype: dict
+        """
+        received = []
+        records = []
+        for name, _received, fields in self.events:
+            if name == event:
+                received.append(_received)
+                records.append(fields)
+
+        if event in EVENT_FIELDS:
+            names = EVENT_FIELDS[event][0]
+        else:
+            names = tuple('field%s' % i for i in range(len(records[0]) if records else 0))
+
+        columns = {'received': received}
+        for i, name in enumerate(names):
+            columns[name] = [fields[i] if i < len(fields) else None for fields in records]
+        return columns
+
+
+class Batcher:
+    """
+    Collects decoded events, and hands them to a consumer in batches.
+
+    A batch is flushed when it reaches max_size events, or max_delay seconds
+    after its first event. The consumer is called on the batcher's own thread,
+    so a slow consumer does not hold up the event handlers.
+    """
+    def __init__(self, consumer, events=DEFAULT_EVENTS, max_size=500, max_delay=1.0):
+        """
+        Initialize the Batcher and start its flush thread.
+
+        :param consumer: Callable taking a Batch.
+        :type consumer: callable
+        :param events: The command events to batch.
+        :type events: tuple
+        :param max_size: Flush when the batch has this many events.
+        :type max_size: int
+        :param max_delay: Flush when the first event of the batch is this many seconds old.
+        :type max_delay: int | float
+        """
+        self.consumer = consumer
+        self.events = tuple(events)
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.flushed = 0
+
+        self._events = []
+        self._first = None
+        self._ready = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name='ezclib-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, event_data):
+        """
+        Add a command event to the batch, a dispatcher handler.
+
+        :param event_data: The command event data.
+        :type event_data: list
+        """
+        record = (event_data[0], time.time(), decode(event_data))
+        with self._cond:
+            if not self._events:
+                self._first = record[1]
+                self._cond.notify()
+            self._events.append(record)
+            if len(self._events) >= self.max_size:
+                self._swap()
+                self._cond.notify()
+
+    def flush(self):
+        """ Flush the current batch, without waiting for the thresholds. """
+        with self._cond:
+            self._swap()
+            self._cond.notify()
+
+    def close(self):
+        """ Flush the current batch and stop the flush thread. """
+        with self._cond:
+            self._swap()
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _swap(self):
+        """ Move the current events to the ready batches. Must hold the condition. """
+        if self._events:
+            self._ready.append(self._events)
+            self._events = []
+            self._first = None
+
+    def _run(self):
+        """ The flush thread loop. """
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    if self._first is None:
+                        self._cond.wait()
+                    else:
+                        wait = self._first + self.max_delay - time.time()
+                        if wait <= 0:
+                            self._swap()
+                        else:
+                            self._cond.wait(wait)
+                if not self._ready and self._closed:
+                    return
+                ready = self._ready
+                self._ready = []
+
+            for events in ready:
+                try:
+                    self.consumer(Batch(events))
+                except Exception as e:
+                    log.error('error in batch consumer %s: %s' % (self.consumer, e), exc_info=True)
+                self.flushed += 1
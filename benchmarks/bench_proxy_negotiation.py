@@ -0,0 +1,80 @@
+"""
+Benchmark proxy negotiation latency and allocations for each proxy type,
+against the local stand-in proxy server.
+
+Usage: python benchmarks/bench_proxy_negotiation.py [rounds]
+"""
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rtmplib import socks
+from standin_proxy import StandInProxy, GREETING
+
+PROXY_TYPES = [
+    ('http', socks.HTTP, None, None),
+    ('socks4', socks.SOCKS4, None, None),
+    ('socks5', socks.SOCKS5, None, None),
+    ('socks5', socks.SOCKS5, 'user', 'pass')
+]
+
+
+def negotiate(proxy_type, proxy, username, password):
+    """ Negotiate one connection, and check the greeting reached the stream. """
+    sock = socks.socksocket()
+    sock.set_proxy(proxy_type, proxy.host, proxy.port, username=username, password=password)
+    sock.connect(('127.0.0.1', 1935))
+    data = sock.pending_data()
+    while len(data) < len(GREETING):
+        data += sock.recv(len(GREETING) - len(data))
+    assert data == GREETING, data
+    sock.close()
+
+
+def bench(name, proxy_type, username, password, rounds):
+    proxy = StandInProxy(name, username=username, password=password)
+    negotiate(proxy_type, proxy, username, password)
+
+    timings = []
+    for _ in range(rounds):
+        start = time.time()
+        negotiate(proxy_type, proxy, username, password)
+        timings.append(time.time() - start)
+    timings.sort()
+
+    allocated = ''
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        for _ in range(100):
+            negotiate(proxy_type, proxy, username, password)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        allocated = 'peak %6d bytes, retained blocks/100 %4d' % (peak, blocks)
+
+    proxy.close()
+    label = name + (' (auth)' if username else '')
+    print('%-14s mean %.3fms  p50 %.3fms  p99 %.3fms  %s' %
+          (label, 1000 * sum(timings) / len(timings), 1000 * timings[len(timings) // 2],
+           1000 * timings[int(len(timings) * 0.99)], allocated))
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for name, proxy_type, username, password in PROXY_TYPES:
+        bench(name, proxy_type, username, password, rounds)
+
+
+if __name__ == '__main__':
+    main()
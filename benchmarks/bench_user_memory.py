@@ -0,0 +1,124 @@
+"""
+Benchmark the memory used per user by the Users store,
+for rooms of 100, 1000 and 10000 users.
+
+The nicks and statuses are decoded fresh for every room, like they are
+from the stream, so interning can share them across rooms (py3, or py2 byte strings).
+
+Usage: python benchmarks/bench_user_memory.py [rooms]
+"""
+import gc
+import os
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import user
+
+ROOM_SIZES = (100, 1000, 10000)
+STATUSES = (u'', u'afk', u'away', u'busy')
+
+
+class DictUser:
+    """ A __dict__ based user, the representation before slots. """
+    def __init__(self, **data):
+        self.ml = data.get('ml', 0)
+        self.nick = data.get('un', '')
+        self.id = data.get('id', 0)
+        self.su = data.get('su', 0)
+        self.st = data.get('st')
+
+
+def user_data(i):
+    """ Join data for user i, with freshly created strings. """
+    return {
+        'un': u''.join([u'guest-', str(i)]),
+        'ml': 100 if i % 50 == 0 else 0,
+        'st': u''.join([STATUSES[i % len(STATUSES)]]),
+        'id': i if i % 3 == 0 else 0,
+        'su': 0
+    }
+
+
+def fill_rooms(size, rooms):
+    """ Create a Users store for each room, with the same users in every room. """
+    stores = []
+    for _ in range(rooms):
+        users = user.Users()
+        for i in range(size):
+            data = user_data(i)
+            users.add(data['un'], data)
+        stores.append(users)
+    return stores
+
+
+def fill_users(size, rooms):
+    """ The slotted User objects alone, with interned strings. """
+    return [[user.User(**user_data(i)) for i in range(size)] for _ in range(rooms)]
+
+
+def fill_dict_users(size, rooms):
+    """ The users as __dict__ objects with private strings, for comparison. """
+    return [[DictUser(**user_data(i)) for i in range(size)] for _ in range(rooms)]
+
+
+def measure(func, size, rooms):
+    """ Bytes per user held by the objects func creates. """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        result = func(size, rooms)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        # no tracemalloc on python 2, estimate from the object sizes.
+        result = func(size, rooms)
+        before = 0
+        after = estimate(result)
+    del result
+    return float(after - before) / (size * rooms)
+
+
+def estimate(obj, seen=None):
+    """ Estimate the deep size of an object, counting shared objects once. """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += estimate(k, seen) + estimate(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += estimate(v, seen)
+    if hasattr(obj, '__dict__'):
+        size += estimate(obj.__dict__, seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, name):
+            size += estimate(getattr(obj, name), seen)
+    return size
+
+
+def main():
+    rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('%s rooms, %s' % (rooms, 'tracemalloc' if tracemalloc is not None else 'estimated'))
+    print('%12s %16s %16s %22s' % ('', '__dict__ User', 'slotted User', 'Users (with indexes)'))
+    for size in ROOM_SIZES:
+        plain = measure(fill_dict_users, size, rooms)
+        slotted = measure(fill_users, size, rooms)
+        store = measure(fill_rooms, size, rooms)
+        print('%6d users %10.1f bytes %10.1f bytes %16.1f bytes' % (size, plain, slotted, store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark ingesting sendUserList payloads, comparing a json.loads and
+Users.add per user with the bulk parse_userlist and Users.add_many path.
+
+Usage: python benchmarks/bench_userlist_ingest.py [rounds]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import user
+
+USERLIST_SIZES = (1000, 5000, 10000, 20000)
+
+
+def make_userlist(size):
+    """ A sendUserList payload with size users. """
+    userlist = {}
+    for i in range(size):
+        nick = 'guest-%s' % i
+        userlist[nick] = json.dumps({'un': nick, 'ml': 100 if i % 50 == 0 else 0,
+                                     'st': '', 'id': i if i % 3 == 0 else 0, 'su': 0})
+    return json.dumps(userlist)
+
+
+def ingest_per_user(data):
+    """ The ingest path before bulk ingest. """
+    users = user.Users()
+    json_data = json.loads(data)
+    for user_name in json_data:
+        if user_name != 'client':
+            users.add(user_name, json.loads(json_data[user_name]))
+    return users
+
+
+def ingest_bulk(data):
+    users = user.Users()
+    users.add_many(user.parse_userlist(data), exclude='client')
+    return users
+
+
+def bench(func, data, rounds):
+    """ Best time of rounds, in milliseconds. """
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        func(data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return 1000 * best
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('json backend: %s' % user._json.__name__)
+    for size in USERLIST_SIZES:
+        data = make_userlist(size)
+        assert len(ingest_bulk(data).all) == len(ingest_per_user(data).all) == size
+        per_user = bench(ingest_per_user, data, rounds)
+        bulk = bench(ingest_bulk, data, rounds)
+        print('%6d users  per user %8.2fms  bulk %8.2fms  %.1fx' % (size, per_user, bulk, per_user / bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Stress the RtmpWriter with many producer threads writing at once, and check
+the written stream decodes back in to every message, in order per producer.
+
+Usage: python benchmarks/bench_writer_stress.py [producers] [messages]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyamf.util
+
+from rtmplib import reader, rtmp_type, writer
+
+
+class SlowStream(pyamf.util.BufferedByteStream):
+    """ In memory stream yielding the thread between writes, to provoke interleaving. """
+    def write(self, data):
+        pyamf.util.BufferedByteStream.write(self, data)
+        time.sleep(0)
+
+    def flush(self):
+        pass
+
+
+def produce(rtmp_writer, producer, messages, start):
+    """ Write messages, with bodies spanning several chunks. """
+    start.wait()
+    for i in range(messages):
+        rtmp_writer.write({
+            'msg': rtmp_type.DT_COMMAND,
+            'command': [u'send_public', 0, None, producer, i, u'x' * (50 + (i * 37) % 400)]
+        })
+        if i % 10 == 0:
+            # ping responses are written from the reader thread.
+            rtmp_writer.write({
+                'msg': rtmp_type.DT_USER_CONTROL,
+                'event_type': rtmp_type.UC_PING_RESPONSE,
+                'event_data': '\x00\x00\x00\x01'
+            })
+        rtmp_writer.flush()
+
+
+def check(stream, producers, messages):
+    """ Decode the stream, and check each producer's messages arrived whole and in order. """
+    stream.seek(0)
+    rtmp_reader = reader.RtmpReader(stream)
+    expected = dict((producer, 0) for producer in range(producers))
+    pings = 0
+    while stream.remaining():
+        amf_data = rtmp_reader.next()
+        if amf_data['msg'] == rtmp_type.DT_USER_CONTROL:
+            assert amf_data['event_data'] == '\x00\x00\x00\x01', amf_data
+            pings += 1
+            continue
+        command = amf_data['command']
+        producer, i = int(command[3]), int(command[4])
+        assert i == expected[producer], (producer, i, expected[producer])
+        assert command[5] == u'x' * (50 + (i * 37) % 400), command
+        expected[producer] += 1
+    assert all(count == messages for count in expected.values()), expected
+    return sum(expected.values()), pings
+
+
+def main():
+    producers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    stream = SlowStream()
+    rtmp_writer = writer.RtmpWriter(stream)
+    start = threading.Event()
+    threads = [threading.Thread(target=produce, args=(rtmp_writer, p, messages, start))
+               for p in range(producers)]
+    for t in threads:
+        t.start()
+
+    begin = time.time()
+    start.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - begin
+
+    commands, pings = check(stream, producers, messages)
+    print('%s producers, %s commands + %s pings, %s bytes in %.3fs (%.0f msgs/s), stream decoded OK' %
+          (producers, commands, pings, len(stream), elapsed, (commands + pings) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
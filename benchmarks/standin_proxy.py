@@ -0,0 +1,127 @@
+""" A local stand-in proxy server, speaking HTTP CONNECT, SOCKS4 and SOCKS5. """
+import socket
+import struct
+import threading
+
+# sent by the stand-in, in the same packet as the negotiation reply,
+# to check that bytes following the reply reach the tunneled stream.
+GREETING = b'\x03' + b'\xab' * 61
+
+
+def _recv_exact(conn, count):
+    data = b''
+    while len(data) < count:
+        d = conn.recv(count - len(data))
+        if not d:
+            raise socket.error('closed')
+        data += d
+    return data
+
+
+def _recv_until(conn, delimiter):
+    data = b''
+    while delimiter not in data:
+        d = conn.recv(1024)
+        if not d:
+            raise socket.error('closed')
+        data += d
+    return data
+
+
+class StandInProxy:
+    """
+    A proxy server on the loopback interface.
+
+    It negotiates like a real proxy of the given type, but does not connect
+    anywhere. After the negotiation reply it sends GREETING, and then echoes
+    everything it receives.
+    """
+    def __init__(self, proxy_type, username=None, password=None):
+        """
+        Initialize and start the StandInProxy.
+
+        :param proxy_type: The proxy type, http, socks4 or socks5
+        :type proxy_type: str
+        :param username: SOCKS5 username, enables username/password authentication.
+        :type username: str
+        :param password: SOCKS5 password.
+        :type password: str
+        """
+        self.proxy_type = proxy_type
+        self.username = username
+        self.password = password
+
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(128)
+        self.host, self.port = self._server.getsockname()
+
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                break
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, conn):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            getattr(self, '_negotiate_%s' % self.proxy_type)(conn)
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                conn.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _negotiate_http(conn):
+        _recv_until(conn, b'\r\n\r\n')
+        conn.sendall(b'HTTP/1.1 200 Connection established\r\nProxy-Agent: stand-in\r\n\r\n' + GREETING)
+
+    @staticmethod
+    def _negotiate_socks4(conn):
+        request = _recv_exact(conn, 8)
+        data = _recv_until(conn, b'\x00')
+        if request[4:7] == b'\x00\x00\x00' and data.count(b'\x00') < 2:
+            # socks4a, the user id is followed by the host name.
+            _recv_until(conn, b'\x00')
+        conn.sendall(b'\x00\x5a' + struct.pack('>H', 0) + b'\x00' * 4 + GREETING)
+
+    def _negotiate_socks5(self, conn):
+        _, count = struct.unpack('>BB', _recv_exact(conn, 2))
+        methods = _recv_exact(conn, count)
+        if self.username is not None and b'\x02' in methods:
+            conn.sendall(b'\x05\x02')
+            _recv_exact(conn, 1)
+            username = _recv_exact(conn, ord(_recv_exact(conn, 1)))
+            password = _recv_exact(conn, ord(_recv_exact(conn, 1)))
+            if username != self.username.encode() or password != self.password.encode():
+                conn.sendall(b'\x01\x01')
+                return
+            conn.sendall(b'\x01\x00')
+        else:
+            conn.sendall(b'\x05\x00')
+
+        _, _, _, atyp = struct.unpack('>BBBB', _recv_exact(conn, 4))
+        if atyp == 1:
+            _recv_exact(conn, 4)
+        else:
+            _recv_exact(conn, ord(_recv_exact(conn, 1)))
+        _recv_exact(conn, 2)
+        conn.sendall(b'\x05\x00\x00\x01' + b'\x7f\x00\x00\x01' + struct.pack('>H', 1935) + GREETING)
+
+    def close(self):
+        """ Stop accepting connections. """
+        self._server.close()
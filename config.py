@@ -2,3 +2,33 @@ DEBUG_TO_CONSOLE = True
 DEBUG_TO_FILE = True
 FILE_DEBUG_LEVEL = 10
 RECONNECT_DELAY = 20
+# Share logins between processes through this file, None to share only within the process.
+LOGIN_CACHE_FILE = None
+# Number of proxies from a proxy pool to race each connection through.
+PROXY_RACE_COUNT = 2
+# Worker threads running the event handlers, 0 to run them on the socket reader thread.
+HANDLER_WORKERS = 4
+# Max queued events per room, and what to do when full: block, drop_oldest or coalesce.
+HANDLER_QUEUE_SIZE = 1000
+HANDLER_QUEUE_POLICY = 'block'
+# Print 1 in this many packets to the console when DEBUG_TO_CONSOLE.
+CONSOLE_PACKET_SAMPLE = 1
+# Max public messages kept in the message history of each room.
+MESSAGE_HISTORY_SIZE = 1000
+# Outbound messages per second and burst, max queued outbound messages and max chat message length.
+SEND_RATE = 2.0
+SEND_BURST = 5
+SEND_QUEUE_SIZE = 500
+MAX_MSG_LENGTH = 200
+# Seconds an outbound message may wait, E.g during a reconnect, before it is dropped.
+SEND_MAX_AGE = 300
+# Seconds a sent chat message is remembered, the same message sent again within it is ignored. None to disable.
+SEND_DEDUP_WINDOW = 2
+# Keep pending outbound messages in this file while disconnected, %s is the room name. None to keep them in memory.
+SEND_QUEUE_FILE = None
+# Keep a snapshot of the room state in this file for a warm start, %s is the room name. None to disable.
+SNAPSHOT_FILE = None
+# Seconds a snapshot may be old to be restored.
+SNAPSHOT_MAX_AGE = 3600
+# Min seconds between the snapshots saved after room state changes.
+SNAPSHOT_INTERVAL = 30
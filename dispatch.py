@@ -0,0 +1,167 @@
+""" Event dispatch registry used by the RTMP protocol. """
+import logging
+import threading
+import timeit
+
+log = logging.getLogger(__name__)
+
+# handlers registered for this key receive all command events.
+WILDCARD = '*'
+
+
+class HandlerStats:
+    """ Class holding timing information for a handler. """
+    def __init__(self, key, handler):
+        self.key = key
+        self.name = getattr(handler, '__name__', repr(handler))
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def avg_time(self):
+        """
+        The average time spent in the handler.
+
+        :return: The average time in seconds.
+        :rtype: float
+        """
+        if self.calls == 0:
+            return 0.0
+        return self.total_time / self.calls
+
+    def __repr__(self):
+        return '<HandlerStats %s:%s calls=%s avg=%.6fs max=%.6fs errors=%s>' % \
+               (self.key, self.name, self.calls, self.avg_time, self.max_time, self.errors)
+
+
+class Dispatcher:
+    """
+    Maps event keys to lists of handlers.
+
+    A key is a command name (str) for command messages,
+    or a RTMP data type (int) for other messages, E.g rtmp_type.DT_SHARED_OBJECT.
+    Handlers can be registered and unregistered at runtime, from any thread.
+    """
+    def __init__(self, timed=True):
+        """
+        Initialize the Dispatcher.
+
+        :param timed: Record the time spent in each handler.
+        :type timed: bool
+        """
+        self.timed = timed
+        self._handlers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """
+        Timing information for all handlers.
+
+        :return: A list of HandlerStats, slowest total time first.
+        :rtype: list
+        """
+        return sorted(self._stats.values(), key=lambda s: s.total_time, reverse=True)
+
+    def register(self, key, handler):
+        """
+        Register a handler for an event key.
+
+        :param key: The command name, rtmp data type or WILDCARD.
+        :type key: str | int
+        :param handler: The callable to handle the event.
+        :type handler: callable
+        """
+        with self._lock:
+            # replace rather than mutate, so dispatch never needs the lock.
+            self._handlers[key] = self._handlers.get(key, ()) + (handler,)
+
+    def unregister(self, key, handler):
+        """
+        Unregister a handler for an event key.
+
+        :param key: The command name, rtmp data type or WILDCARD.
+        :type key: str | int
+        :param handler: The handler to remove.
+        :type handler: callable
+        :return: True if the handler was removed.
+        :rtype: bool
+        """
+        with self._lock:
+            handlers = self._handlers.get(key, ())
+            if handler not in handlers:
+                return False
+            handlers = tuple(h for h in handlers if h != handler)
+            if handlers:
+                self._handlers[key] = handlers
+            else:
+                del self._handlers[key]
+            self._stats.pop((key, handler), None)
+            return True
+
+    def handlers(self, key):
+        """
+        The handlers registered for an event key.
+
+        :param key: The command name, rtmp data type or WILDCARD.
+        :type key: str | int
+        :return: A tuple of handlers.
+        :rtype: tuple
+        """
+        return self._handlers.get(key, ())
+
+    def has_handlers(self, key):
+        """
+        Check if an event key has handlers.
+
+        :param key: The command name, rtmp data type or WILDCARD.
+        :type key: str | int
+        :return: True if there are handlers for the key.
+        :rtype: bool
+        """
+        return key in self._handlers
+
+    def dispatch(self, key, *args):
+        """
+        Call the handlers of an event key.
+
+        An error in a handler is logged, and does not stop other handlers.
+
+        :param key: The command name or rtmp data type.
+        :type key: str | int
+        :return: The number of handlers called.
+        :rtype: int
+        """
+        handlers = self._handlers.get(key, ())
+        for handler in handlers:
+            self._call(key, handler, args)
+        return len(handlers)
+
+    def _call(self, key, handler, args):
+        """ Call a handler, recording the time spent in it. """
+        if not self.timed:
+            try:
+                handler(*args)
+            except Exception as e:
+                log.error('error in handler %s for %s: %s' % (handler, key, e), exc_info=True)
+            return
+
+        stats = self._stats.get((key, handler))
+        if stats is None:
+            stats = self._stats.setdefault((key, handler), HandlerStats(key, handler))
+
+        start = timeit.default_timer()
+        try:
+            handler(*args)
+        except Exception as e:
+            stats.errors += 1
+            log.error('error in handler %s for %s: %s' % (handler, key, e), exc_info=True)
+        finally:
+            elapsed = timeit.default_timer() - start
+            stats.calls += 1
+            stats.total_time += elapsed
+            if elapsed > stats.max_time:
+                stats.max_time = elapsed
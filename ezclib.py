@@ -1,19 +1,75 @@
 """ Ezcapechat RTMP library by Nortxort (https://github.com/nortxort) """
+import itertools
 import json
 import logging
+import threading
 import time
 
+import batch
 import config
+import dispatch
+import flood
+import history
+import lifecycle
+import media
+import moderation
+import outbound
+import pipeline
+import shared
+import sinks
+import snapshot
 import user
 from apis import ezcapechat
 from pages import acc
-from util import string_util
-from rtmplib import rtmp
+from util import string_util, proxy_pool
+from rtmplib import rtmp, writer
 
 __version__ = '1.1.0'
 log = logging.getLogger(__name__)
 CONFIG = config
 
+# login broker shared by all protocol instances in this process.
+LOGIN_BROKER = acc.LoginBroker(cache_file=config.LOGIN_CACHE_FILE)
+
+# worker pool running the event handlers of all protocol instances in this process.
+WORKER_POOL = pipeline.WorkerPool(workers=config.HANDLER_WORKERS)
+
+
+def default_sink():
+    """
+    Create the output sink from the config.
+
+    Events and errors are always printed. Packets and diagnostics
+    are printed if DEBUG_TO_CONSOLE, and packets logged if DEBUG_TO_FILE.
+
+    :return: The output sink.
+    :rtype: sinks.Sink
+    """
+    console_kinds = (sinks.EVENT, sinks.ERROR)
+    if config.DEBUG_TO_CONSOLE:
+        console_kinds = sinks.ALL_KINDS
+    _sinks = [sinks.ConsoleSink(kinds=console_kinds, sample=config.CONSOLE_PACKET_SAMPLE)]
+    if config.DEBUG_TO_FILE:
+        _sinks.append(sinks.LoggingSink(log, kinds=(sinks.PACKET,)))
+    return sinks.MultiSink(_sinks)
+
+
+def _format_joins(users):
+    """ Render the users of a userlist as join lines. """
+    return '\n'.join('\tJoins: %s' % _user.nick for _user in users)
+
+
+def _format_result(data):
+    """ Render _result data as key: value lines. """
+    lines = []
+    for k in data:
+        if isinstance(data, rtmp.pyamf.MixedArray):
+            for kk in data[k]:
+                lines.append('%s: %s' % (kk, data[k][kk]))
+        else:
+            lines.append('%s: %s' % (k, data[k]))
+    return '\n'.join(lines)
+
 
 class EzcapechatRTMPProtocol:
     """
@@ -21,7 +77,34 @@ class EzcapechatRTMPProtocol:
 
     Contains event methods in use by the flash application.
     """
-    def __init__(self, room_name, username, email=None, password=None, proxy=None):
+    # command event name: (event method name, index of the event data to pass,
+    # None for all of it or False for no argument)
+    _event_methods = {
+        '_result': ('on_result', 3),
+        'joinData': ('on_join_data', None),
+        'joinuser': ('on_joinuser', None),
+        'sendUserList': ('on_send_userlist', 3),
+        'camList': ('on_cam_list', 3),
+        'updateRoomSecurity': ('on_update_room_security', None),
+        'receivePublicMsg': ('on_receive_public_msg', None),
+        'typingPM': ('on_typing_pm', None),
+        'pmReceive': ('on_pm_receive', None),
+        'removeuser': ('on_removeuser', 3),
+        'statusUpdate': ('on_status_update', None),
+        'connectionOK': ('on_connectin_ok', False),
+        'ytVideoQueueAdd': ('on_yt_video_queue_add', None),
+        'ytVideoCurrent': ('on_yt_video_current', None),
+        'ytVideoQueue': ('on_yt_video_queue', None)
+    }
+    # events changing room state, never dropped by the handler queue.
+    _protected_events = ('_result', 'joinData', 'connectionOK', 'joinuser',
+                         'sendUserList', 'removeuser', 'statusUpdate')
+    # events where only the latest one matters, may be coalesced by the handler queue.
+    _coalescable_events = ('camList', 'updateRoomSecurity', 'ytVideoQueue', 'ytVideoCurrent')
+
+    def __init__(self, room_name, username, email=None, password=None, proxy=None,
+                 login_broker=None, worker_pool=None, sink=None, matcher=None, flood_detector=None,
+                 shared_state=None):
         """
         Initialize the ezcapechat protocol class.
 
@@ -33,23 +116,178 @@ class EzcapechatRTMPProtocol:
         :type email: str
         :param password: Login password.
         :type password: str
-        :param proxy: Use a proxy.
-        :type proxy: str
+        :param proxy: Use a proxy, or pick one from a proxy pool for each connection.
+        :type proxy: str | proxy_pool.ProxyPool
+        :param login_broker: The login broker to use, defaults to LOGIN_BROKER.
+        :type login_broker: acc.LoginBroker
+        :param worker_pool: The worker pool running the event handlers, defaults to WORKER_POOL.
+        :type worker_pool: pipeline.WorkerPool
+        :param sink: The sink for events, packets and diagnostics, defaults to default_sink()
+        :type sink: sinks.Sink
+        :param matcher: Check public messages, private messages and nicks against moderation rules.
+        :type matcher: moderation.Matcher
+        :param flood_detector: Detect users flooding the room, calling on_flood.
+        :type flood_detector: flood.FloodDetector
+        :param shared_state: Publish the users and room counters in shared memory, for other processes.
+        :type shared_state: shared.SharedRoomState
         """
         self.room_name = u'' + room_name
         self.email = email
         self.password = password
         self.proxy = proxy
+        self.proxy_pool = None
+        if isinstance(proxy, proxy_pool.ProxyPool):
+            self.proxy_pool = proxy
+            self.proxy = None
+        self._pool_proxy = None
+        self._proxy_candidates = []
+        self._proxy_reported = False
+        self._race_winner = None
+        self.login_broker = login_broker or LOGIN_BROKER
+        self.sink = sink or default_sink()
+        self.matcher = matcher
+        self.flood_detector = flood_detector
+        self.shared_state = shared_state
 
         self.connection = None
-        self.is_connected = False
+        self.lifecycle = lifecycle.Lifecycle(self._on_state_change)
 
         self.users = user.Users()
         self.users.add_client(username)
 
+        self.history = history.MessageHistory(config.MESSAGE_HISTORY_SIZE)
+        self.media = media.MediaQueue()
+        self._cam_list = None
+
         self._pub_n_key = None
+        self._session_expired = False
         self._room_id = 0
         self._msg_counter = 1
+        self._msg_counter_lock = threading.Lock()
+
+        # restored users, cams and queue are reconciled with the events after joining.
+        self._snapshot_file = None
+        self._snapshot_saved = 0
+        self._snapshot_timer = None
+        self._snapshot_lock = threading.Lock()
+        if config.SNAPSHOT_FILE:
+            self._snapshot_file = config.SNAPSHOT_FILE % self.room_name
+            self.restore_snapshot()
+
+        # pending messages are kept across reconnects, and sent once the room accepts the connection.
+        queue_file = None
+        if config.SEND_QUEUE_FILE:
+            queue_file = config.SEND_QUEUE_FILE % self.room_name
+        self._outbound = outbound.SendQueue(self._call, self._build, rate=config.SEND_RATE,
+                                            burst=config.SEND_BURST, maxsize=config.SEND_QUEUE_SIZE,
+                                            max_age=config.SEND_MAX_AGE, path=queue_file,
+                                            on_result=self._on_send_result, name='ezclib-sender-%s' % self.room_name,
+                                            dedup_window=config.SEND_DEDUP_WINDOW)
+        # continue the message counter after the messages loaded from the queue file.
+        for key in self._outbound.pending_keys:
+            self._msg_counter = max(self._msg_counter, key + 1)
+        self._broadcasts = {}
+        self._broadcast_ids = itertools.count(1)
+
+        self.dispatcher = dispatch.Dispatcher()
+        self._register_event_methods()
+        self.dispatcher.register('connectionOK', self._joined)
+
+        # handlers run on the socket reader thread without a worker pool.
+        self._event_queue = None
+        worker_pool = worker_pool or WORKER_POOL
+        if worker_pool.workers > 0:
+            self._event_queue = worker_pool.queue(self.room_name,
+                                                  maxsize=config.HANDLER_QUEUE_SIZE,
+                                                  policy=config.HANDLER_QUEUE_POLICY,
+                                                  protected=self._protected_events,
+                                                  coalescable=self._coalescable_events)
+
+    def _emit(self, kind, fmt, *args):
+        """
+        Emit a record to the sink, if the sink accepts the kind.
+
+        Nothing is formatted here, the sink renders the record if it uses it.
+
+        :param kind: The record kind, E.g sinks.EVENT
+        :type kind: str
+        :param fmt: A format string for args, or a callable returning the message from args.
+        :type fmt: str | callable
+        """
+        if self.sink.accepts(kind):
+            self.sink.emit(sinks.Record(kind, fmt, args))
+
+    @property
+    def event_queue_stats(self):
+        """
+        The metrics of the event handler queue.
+
+        :return: The queue metrics, or None if handlers run on the reader thread.
+        :rtype: pipeline.QueueStats | None
+        """
+        if self._event_queue is None:
+            return None
+        return self._event_queue.stats
+
+    def add_batch_consumer(self, consumer, events=batch.DEFAULT_EVENTS, max_size=500, max_delay=1.0):
+        """
+        Deliver events to a consumer in batches, instead of one call per event.
+
+        The consumer is called with a batch.Batch when max_size events have been
+        collected, or max_delay seconds after the first event of the batch.
+        The event methods (on_*) are still called for each event.
+
+        :param consumer: Callable taking a batch.Batch.
+        :type consumer: callable
+        :param events: The command events to batch.
+        :type events: tuple
+        :param max_size: Max events in a batch.
+        :type max_size: int
+        :param max_delay: Max seconds before a batch is flushed.
+        :type max_delay: int | float
+        :return: The batcher, for remove_batch_consumer.
+        :rtype: batch.Batcher
+        """
+        batcher = batch.Batcher(consumer, events=events, max_size=max_size, max_delay=max_delay)
+        for event in batcher.events:
+            self.dispatcher.register(event, batcher.add)
+        return batcher
+
+    def remove_batch_consumer(self, batcher):
+        """
+        Stop batched delivery to a consumer, flushing the events collected so far.
+
+        :param batcher: The batcher returned by add_batch_consumer.
+        :type batcher: batch.Batcher
+        """
+        for event in batcher.events:
+            self.dispatcher.unregister(event, batcher.add)
+        batcher.close()
+
+    @property
+    def is_connected(self):
+        """
+        Has the room accepted the connection.
+
+        :return: True if joined.
+        :rtype: bool
+        """
+        return self.lifecycle.state == lifecycle.JOINED
+
+    def _on_state_change(self, previous, state):
+        """
+        Received when the connection enters a new state.
+
+        :param previous: The previous state.
+        :type previous: str
+        :param state: The new state.
+        :type state: str
+        """
+        time_to_join = self.lifecycle.elapsed(lifecycle.CONNECTING, lifecycle.JOINED)
+        if state == lifecycle.JOINED and time_to_join is not None:
+            self._emit(sinks.EVENT, 'Joined %s in %.3fs', self.room_name, time_to_join)
+        else:
+            self._emit(sinks.DIAGNOSTIC, 'State: %s -> %s', previous, state)
 
     def _reset(self):
         """
@@ -57,33 +295,66 @@ class EzcapechatRTMPProtocol:
         """
         self._pub_n_key = None  # consider this
         self._room_id = 0
-        self._msg_counter = 1
+        self.media.clear()
+        self._cam_list = None
+        # the message counter is not reset, it identifies the messages pending across reconnects.
 
     def login(self):
         """
         Login to ezcapechat using the provided credentials.
 
+        The login is done through the login broker, so connections
+        using the same account will share a single login.
+
+        :return: True if logged in, else False.
+        :rtype: bool
+        """
+        if self.email and self.password:
+            session = self.login_broker.acquire(self.email, self.password, proxy=self.proxy)
+            if session is not None:
+                self._pub_n_key = session.n_key
+                return True
+            # like a failed login on the page, connect with the n_key of the login page.
+            self._pub_n_key = self.login_broker.page_n_key(self.email)
+        return False
+
+    def refresh_login(self, stale_n_key=None):
+        """
+        Refresh an expired login.
+
+        Only one of the connections sharing the account will do the actual login.
+
+        :param stale_n_key: The n_key of the expired login, defaults to the current n_key.
+        :type stale_n_key: str | None
         :return: True if logged in, else False.
         :rtype: bool
         """
-        account = acc.Account(self.email, self.password)
         if self.email and self.password:
-            if account.is_logged_in:
-                self._pub_n_key = account.n_key
+            session = self.login_broker.refresh(self.email, self.password, stale_n_key or self._pub_n_key,
+                                                proxy=self.proxy)
+            if session is not None:
+                self._pub_n_key = session.n_key
                 return True
-            account.login()
-            self._pub_n_key = account.n_key
-            return account.is_logged_in
+            self._pub_n_key = self.login_broker.page_n_key(self.email)
         return False
 
     def connect(self):
         """ Connect to the remote server. """
         _error = None
+        self.lifecycle.transition(lifecycle.CONNECTING)
 
         if not self.users.client.nick.strip():
             self.users.client.nick = string_util.create_random_string(6, 25)  # adjust length
 
         try:
+            if self.proxy_pool is not None:
+                # race the connection through the best proxies from the pool.
+                self._proxy_reported = False
+                self._race_winner = None
+                self._proxy_candidates = self.proxy_pool.acquire_many(config.PROXY_RACE_COUNT)
+                self._pool_proxy = self._proxy_candidates[0]
+                self.proxy = self._pool_proxy.url
+
             params = ezcapechat.Params(self.room_name, self.users.client.nick,
                                        n_key=self._pub_n_key, proxy=self.proxy)
 
@@ -95,6 +366,9 @@ class EzcapechatRTMPProtocol:
                 swf_url=params.swf_url,
                 page_url=params.page_url,
                 proxy=self.proxy,
+                proxies=[proxy.url for proxy in self._proxy_candidates],
+                on_proxy_result=self._on_proxy_result,
+                on_handshake=lambda: self.lifecycle.transition(lifecycle.HANDSHAKEN),
                 is_win=True         # delete/set to false if not on windows
             )
 
@@ -123,41 +397,197 @@ class EzcapechatRTMPProtocol:
             log.critical(e, exc_info=True)
             _error = e
         finally:
+            if self.proxy_pool is not None:
+                self._settle_proxy(_error)
+
             if _error is not None:
-                print ('connect error: %s' % _error)
+                self._emit(sinks.ERROR, 'connect error: %s', _error)
+                self.lifecycle.transition(lifecycle.CLOSED)
             else:
-                self.is_connected = True
+                # joined once the room sends connectionOK.
+                self.lifecycle.transition(lifecycle.RTMP_CONNECTED)
                 self.__callback()
 
     def disconnect(self):
         """ Disconnect from the remote server. """
         _error = None
+        self.lifecycle.transition(lifecycle.CLOSING)
         try:
             self.connection.shutdown()
         except Exception as e:
             log.error(e, exc_info=True)
-            _error = 'disconnect error: %s' % e
+            _error = e
         finally:
-            if _error is not None and config.DEBUG_TO_CONSOLE:
-                print (_error)
-            self.is_connected = False
+            if _error is not None:
+                self._emit(sinks.ERROR, 'disconnect error: %s', _error)
             self.connection = None
+            self._release_proxy()
+            self._outbound.pause()
+            if self._snapshot_file is not None:
+                self._cancel_snapshot()
+                self.save_snapshot()
+            self.lifecycle.transition(lifecycle.CLOSED)
+
+    def save_snapshot(self, path=None):
+        """
+        Save the room state, the users, cams, client info, room id and media queue.
+
+        :param path: The snapshot file, defaults to the SNAPSHOT_FILE of the room.
+        :type path: str | None
+        :return: True if saved.
+        :rtype: bool
+        """
+        path = path or self._snapshot_file
+        if path is None:
+            raise ValueError('no snapshot file')
+        state = {
+            'room_name': self.room_name,
+            'room_id': self._room_id,
+            'users': self.users.snapshot(),
+            'media': self.media.snapshot()
+        }
+        self._snapshot_saved = time.time()
+        return snapshot.write(path, state)
+
+    def _schedule_snapshot(self):
+        """
+        Save the snapshot after the room state changed, at most once per SNAPSHOT_INTERVAL.
+
+        A process that is killed never disconnects, so the snapshot is not only saved on disconnect.
+        """
+        if self._snapshot_file is None:
+            return
+        with self._snapshot_lock:
+            if self._snapshot_timer is not None:
+                return
+            delay = max(0, self._snapshot_saved + config.SNAPSHOT_INTERVAL - time.time())
+            self._snapshot_timer = threading.Timer(delay, self._save_scheduled_snapshot)
+            self._snapshot_timer.daemon = True
+            self._snapshot_timer.start()
+
+    def _cancel_snapshot(self):
+        """ Cancel a scheduled snapshot, E.g before the final save on disconnect. """
+        with self._snapshot_lock:
+            if self._snapshot_timer is not None:
+                self._snapshot_timer.cancel()
+                self._snapshot_timer = None
+
+    def _save_scheduled_snapshot(self):
+        """ Save the scheduled snapshot, on a timer thread. """
+        with self._snapshot_lock:
+            self._snapshot_timer = None
+        self.save_snapshot()
+
+    def restore_snapshot(self, path=None):
+        """
+        Restore the room state from a snapshot, E.g at startup.
+
+        The restored users are not passed to on_userlist_changes, the userlist
+        received after joining is reconciled with them, so only the changes are.
+
+        :param path: The snapshot file, defaults to the SNAPSHOT_FILE of the room.
+        :type path: str | None
+        :return: True if restored.
+        :rtype: bool
+        """
+        path = path or self._snapshot_file
+        if path is None:
+            raise ValueError('no snapshot file')
+        state = snapshot.read(path, config.SNAPSHOT_MAX_AGE)
+        if state is None or state['room_name'] != self.room_name:
+            return False
+
+        try:
+            restored = self.users.restore(state['users'])
+            self.media.restore(state['media'])
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning('invalid snapshot %s: %s' % (path, e))
+            self.users.clear()
+            self.media.clear()
+            return False
+        self._publish_users()
+        self._room_id = state['room_id']
+        self._emit(sinks.DIAGNOSTIC, 'Restored %s users from %s', restored, path)
+        return True
+
+    def _on_proxy_result(self, proxy_url, error, latency):
+        """
+        Report the outcome of a raced proxy connection to the proxy pool.
+
+        :param proxy_url: The proxy url of the candidate.
+        :type proxy_url: str
+        :param error: The connect error, or None if connected.
+        :type error: Exception | None
+        :param latency: The connect latency in seconds.
+        :type latency: float
+        """
+        for proxy in self._proxy_candidates:
+            if proxy.url == proxy_url:
+                self._proxy_reported = True
+                if error is None:
+                    self._race_winner = proxy
+                    self.proxy_pool.report_success(proxy, latency)
+                else:
+                    self.proxy_pool.report_failure(proxy)
+                break
+
+    def _settle_proxy(self, error):
+        """
+        Keep the proxy that won the connection race, and release the other candidates.
+
+        :param error: The connect error, or None if connected.
+        :type error: Exception | None
+        """
+        winner = None
+        if error is None:
+            for proxy in self._proxy_candidates:
+                if proxy.url == self.connection.proxy:
+                    winner = proxy
+                    break
+        elif self._race_winner is not None:
+            # won the race, but failed after, e.g. in the rtmp handshake.
+            self.proxy_pool.report_failure(self._race_winner)
+        elif not self._proxy_reported and self._pool_proxy is not None:
+            # failed before reaching the race, e.g. loading the room page.
+            self.proxy_pool.report_failure(self._pool_proxy)
+
+        for proxy in self._proxy_candidates:
+            if proxy is not winner:
+                self.proxy_pool.release(proxy)
+        self._proxy_candidates = []
+        self._pool_proxy = winner
+        self.proxy = winner.url if winner is not None else None
+
+    def _release_proxy(self):
+        """ Release the proxy picked from the proxy pool. """
+        if self._pool_proxy is not None:
+            self.proxy_pool.release(self._pool_proxy)
+            self._pool_proxy = None
+            self.proxy = None
 
     def reconnect(self):
         """ Reconnect to the remote server. """
-        if self.is_connected:
+        stale_n_key = self._pub_n_key
+        if self.lifecycle.state != lifecycle.CLOSED:
             self.disconnect()
         self._reset()
         time.sleep(config.RECONNECT_DELAY)  # increase reconnect delay?
+        if self._session_expired:
+            # the room rejected the login, only one connection of the account logs in again.
+            self._session_expired = False
+            self.refresh_login(stale_n_key)
+        else:
+            # the broker only logs in again, if the shared login has expired.
+            self.login()
         self.connect()
 
     def __callback(self):
         """ Callback loop reading packets/events from the stream. """
 
-        log.debug('starting __callback loop, is_connected: %s' % self.is_connected)
+        log.debug('starting __callback loop, state: %s' % self.lifecycle.state)
         fails = 0
 
-        while self.is_connected:
+        while self.lifecycle.is_open:
             try:
                 amf_data = self.connection.amf()
                 msg_type = amf_data['msg']
@@ -165,70 +595,87 @@ class EzcapechatRTMPProtocol:
                 fails += 1
                 log.error(e, exc_info=True)
                 if fails == 2:
+                    if self._pool_proxy is not None:
+                        self.proxy_pool.report_failure(self._pool_proxy)
                     self.reconnect()
                     break
             else:
                 fails = 0
 
-                if config.DEBUG_TO_FILE:
-                    log.debug(amf_data)
-
-                if config.DEBUG_TO_CONSOLE:
-                    print (amf_data)
+                self._emit(sinks.PACKET, '%s', amf_data)
 
+                # the reader only decodes, the handlers run on the worker pool.
                 if msg_type == rtmp.rtmp_type.DT_COMMAND:
-
                     event_data = amf_data['command']
-                    event = event_data[0]
-
-                    if event == '_result':
-                        self.on_result(event_data[3])
+                    self._handle(event_data[0], self._dispatch_command, event_data)
+                else:
+                    self._handle(msg_type, self.dispatcher.dispatch, msg_type, amf_data)
 
-                    elif event == 'joinData':
-                        self.on_join_data(event_data)
-
-                    elif event == 'joinuser':
-                        self.on_joinuser(event_data)
-
-                    elif event == 'sendUserList':
-                        self.on_send_userlist(event_data[3])
-
-                    elif event == 'camList':
-                        cam_data = event_data[3]
-                        self.on_cam_list(cam_data)
-
-                    elif event == 'updateRoomSecurity':
-                        self.on_update_room_security(event_data)
-
-                    elif event == 'receivePublicMsg':
-                        self.on_receive_public_msg(event_data)
+    def _handle(self, key, func, *args):
+        """
+        Queue an event for the worker pool, or run it at once without one.
 
-                    elif event == 'typingPM':
-                        self.on_typing_pm(event_data)
+        :param key: The event key, the command name or rtmp data type.
+        :type key: str | int
+        :param func: The function handling the event.
+        :type func: callable
+        """
+        if self._event_queue is None:
+            func(*args)
+        else:
+            self._event_queue.put(key, func, *args)
 
-                    elif event == 'pmReceive':
-                        self.on_pm_receive(event_data)
+    def _dispatch_command(self, event_data):
+        """
+        Dispatch a command event to its handlers.
 
-                    elif event == 'removeuser':
-                        self.on_removeuser(event_data[3])
+        :param event_data: The command event data.
+        :type event_data: list
+        """
+        event = event_data[0]
+        if not self.dispatcher.dispatch(event, event_data):
+            self.on_unknown_event(event, event_data)
+        self.dispatcher.dispatch(dispatch.WILDCARD, event_data)
 
-                    elif event == 'statusUpdate':
-                        self.on_status_update(event_data)
+    def _event_method(self, name, arg):
+        """
+        Create a dispatcher handler calling an event method.
 
-                    elif event == 'connectionOK':
-                        self.on_connectin_ok()
+        The method is looked up when called, so overridden methods are used.
 
-                    elif event == 'ytVideoQueueAdd':
-                        self.on_yt_video_queue_add(event_data)
+        :param name: The name of the event method.
+        :type name: str
+        :param arg: The index of the event data to pass, None for all of it, or False for no argument.
+        :type arg: int | None | bool
+        :return: A handler taking the event data.
+        :rtype: function
+        """
+        def _handler(event_data):
+            method = getattr(self, name)
+            if arg is None:
+                method(event_data)
+            elif arg is False:
+                method()
+            else:
+                method(event_data[arg])
+        _handler.__name__ = name
+        return _handler
 
-                    elif event == 'ytVideoCurrent':
-                        self.on_yt_video_current(event_data)
+    def _register_event_methods(self):
+        """ Register the default event methods with the dispatcher. """
+        for event, (name, arg) in self._event_methods.items():
+            self.dispatcher.register(event, self._event_method(name, arg))
 
-                    elif event == 'ytVideoQueue':
-                        self.on_yt_video_queue(event_data)
+    def on_unknown_event(self, event, event_data):
+        """
+        Received when a command event has no handlers.
 
-                    else:
-                        print ('Unknown event: `%s`, event data: %s' % (event, event_data))
+        :param event: The event name.
+        :type event: str
+        :param event_data: The event data.
+        :type event_data: list
+        """
+        self._emit(sinks.EVENT, 'Unknown event: `%s`, event data: %s', event, event_data)
 
     def on_result(self, data):
         """
@@ -247,40 +694,35 @@ class EzcapechatRTMPProtocol:
 
                         reject_code = json_data['reject']
                         if reject_code == '0002':
-                            print ('Closed, This room is closed.')
+                            self._emit(sinks.EVENT, 'Closed, This room is closed.')
                         elif reject_code == '0003':
-                            print ('Closed, That username is taken.')
+                            self._emit(sinks.EVENT, 'Closed, That username is taken.')
                         elif reject_code == '0007':
-                            print ('Chat version is out of date, please check the protocol version.')
+                            self._emit(sinks.EVENT, 'Chat version is out of date, please check the protocol version.')
                         elif reject_code == '0008':
-                            print ('Room is password protected.')
+                            self._emit(sinks.EVENT, 'Room is password protected.')
                         elif reject_code == '0009':
-                            print ('You are already in this room, would you like to disconnect the other session?')
+                            self._emit(sinks.EVENT, 'You are already in this room, would you like to disconnect the other session?')
                         elif reject_code == '0010':
-                            print ('Busy, Server is busy, try again in a few seconds.')
+                            self._emit(sinks.EVENT, 'Busy, Server is busy, try again in a few seconds.')
                         elif reject_code == '0012':
-                            print ('No Guests, This room does not allow guests.')
+                            self._emit(sinks.EVENT, 'No Guests, This room does not allow guests.')
                             self.disconnect()
                         elif reject_code == '0013':
-                            print ('Reload the page.')
+                            # the n_key is stale, refresh the login on the reconnect after the server closes.
+                            self._session_expired = True
+                            self._emit(sinks.EVENT, 'Reload the page.')
                         elif reject_code == '0015':
-                            print ('Unverified, You must verify your account before connecting.')
+                            self._emit(sinks.EVENT, 'Unverified, You must verify your account before connecting.')
                         elif reject_code == '0016':
-                            print ('Session Closed, Your other session was closed, you may now join the room.')
+                            self._emit(sinks.EVENT, 'Session Closed, Your other session was closed, you may now join the room.')
 
                         else:
-                            print ('Error joining this room. Code: %s' % reject_code)
-
-            if config.DEBUG_TO_CONSOLE:
-                for k in data:
-                    if isinstance(data, rtmp.pyamf.MixedArray):
-                        for kk in data[k]:
-                            print ('%s: %s' % (kk, data[k][kk]))
-                    else:
-                        print ('%s: %s' % (k, data[k]))
+                            self._emit(sinks.EVENT, 'Error joining this room. Code: %s', reject_code)
+
+            self._emit(sinks.DIAGNOSTIC, _format_result, data)
         else:
-            if config.DEBUG_TO_CONSOLE:
-                print (data)
+            self._emit(sinks.DIAGNOSTIC, '%s', data)
 
     def on_join_data(self, data):
         """
@@ -298,10 +740,7 @@ class EzcapechatRTMPProtocol:
 
         self.send_connection_ok()
 
-        if config.DEBUG_TO_CONSOLE:
-            print ('Join Data:')
-            for i, v in enumerate(data):
-                print ('\t[%s] - %s' % (i, v))
+        self._emit(sinks.DIAGNOSTIC, sinks.format_indexed, 'Join Data:', data)
 
     def on_joinuser(self, data):
         """
@@ -321,31 +760,88 @@ class EzcapechatRTMPProtocol:
             self.users.add_client_data(user_data)
         else:
             _user = self.users.add(data[3], user_data)
-            print ('%s Joined the room.' % _user.nick)
+            if self.flood_detector is not None:
+                self.flood_detector.join(data[3])
+                self._check_flood()
+            if self.shared_state is not None:
+                self.shared_state.count(shared.JOINS)
+            self._users_changed()
+            self._emit(sinks.EVENT, '%s Joined the room.', _user.nick)
 
     def on_send_userlist(self, data):
         """
+        Received after joining the room, with the users in the room.
 
-        :param data:
-        :type data:
+        The userlist is reconciled with the known users, so after a reconnect
+        only the real changes are passed on to on_userlist_changes.
+
+        :param data: The userlist as a json object of nick to json user data.
+        :type data: str
+        """
+        joined, left, changed = self.users.reconcile(user.parse_userlist(data),
+                                                     exclude=self.users.client.nick)
+        if joined or left or changed:
+            if self.shared_state is not None:
+                self.shared_state.count(shared.JOINS, len(joined))
+                self.shared_state.count(shared.LEAVES, len(left))
+            self._users_changed()
+            self.on_userlist_changes(joined, left, changed)
+
+    def on_userlist_changes(self, joined, left, changed):
+        """
+        Received when a userlist differs from the known users.
+
+        On the first join all the users are joined, after a reconnect
+        only the users that joined, left or changed while disconnected.
+
+        :param joined: The users that joined.
+        :type joined: list
+        :param left: The users that left.
+        :type left: list
+        :param changed: (user, previous mod level) tuples for the users with a changed mod level.
+        :type changed: list
         """
-        json_data = json.loads(data)
-        for user_name in json_data:
-            if user_name != self.users.client.nick:
-                user_data = json.loads(json_data[user_name])
-                _user = self.users.add(user_name, user_data)
-                print ('\tJoins: %s' % _user)
+        if joined:
+            self._emit(sinks.EVENT, _format_joins, joined)
+        for _user in left:
+            self._emit(sinks.EVENT, '%s left the room.', _user.nick)
+        for _user, ml in changed:
+            self._emit(sinks.EVENT, '%s mod level changed from %s to %s.', _user.nick, ml, _user.ml)
 
     def on_cam_list(self, data):
         """
+        Received with the full cam list, whenever a cam starts or stops.
 
-        add this data to the user object
-        :param data:
-        :type data:
+        :param data: The JSON encoded cam list.
+        :type data: str
+        """
+        # the cam list is mostly unchanged, skip decoding a repeat.
+        if data == self._cam_list:
+            return
+        self._cam_list = data
+
+        json_data = json.loads(data)    # keyed by nick?
+        started, stopped = self.users.update_cams(json_data)
+        if started or stopped:
+            if self.shared_state is not None:
+                self.shared_state.count(shared.CAMS_STARTED, len(started))
+                self.shared_state.count(shared.CAMS_STOPPED, len(stopped))
+            self._users_changed()
+            self.on_cam_changes(started, stopped)
+
+    def on_cam_changes(self, started, stopped):
+        """
+        Received when cams start or stop broadcasting.
+
+        :param started: The nicks that started broadcasting.
+        :type started: list
+        :param stopped: The nicks that stopped broadcasting.
+        :type stopped: list
         """
-        json_data = json.loads(data)
-        for k in json_data:
-            print (json_data[k])
+        for nick in started:
+            self._emit(sinks.EVENT, '%s is broadcasting.', nick)
+        for nick in stopped:
+            self._emit(sinks.EVENT, '%s stopped broadcasting.', nick)
 
     def on_update_room_security(self, data):
         """
@@ -354,10 +850,7 @@ class EzcapechatRTMPProtocol:
         :param data:
         :type data:
         """
-        if config.DEBUG_TO_CONSOLE:
-            print ('Update room security:')
-            for i, v in enumerate(data):
-                print ('\t[%s] - %s' % (i, v))
+        self._emit(sinks.DIAGNOSTIC, sinks.format_indexed, 'Update room security:', data)
 
     def on_receive_public_msg(self, data):
         """
@@ -369,6 +862,17 @@ class EzcapechatRTMPProtocol:
             # data[3] = unix time stamp including milliseconds.
             user_name = data[4]
             msg = data[5]
+            try:
+                timestamp = float(data[3])
+            except (TypeError, ValueError):
+                timestamp = time.time() * 1000
+            self.history.add(timestamp, user_name, msg)
+            if self.flood_detector is not None:
+                self.flood_detector.message(user_name, msg)
+                self._check_flood()
+            if self.shared_state is not None:
+                self.shared_state.count(shared.MESSAGES)
+            self._moderate(user_name, msg, moderation.PUBLIC)
             self.message_handler(user_name, msg)
 
     def message_handler(self, user_name, msg):
@@ -380,7 +884,7 @@ class EzcapechatRTMPProtocol:
         :param msg:
         :type msg:
         """
-        print ('%s: %s' % (user_name, msg))
+        self._emit(sinks.EVENT, '%s: %s', user_name, msg)
 
     def on_typing_pm(self, data):
         """
@@ -390,7 +894,10 @@ class EzcapechatRTMPProtocol:
         :type data: list
         """
         # data[4] = ?
-        print ('%s is typing a private message.' % data[3])
+        if self.flood_detector is not None:
+            self.flood_detector.typing(data[3])
+            self._check_flood()
+        self._emit(sinks.EVENT, '%s is typing a private message.', data[3])
 
     def on_pm_receive(self, data):
         """
@@ -402,7 +909,69 @@ class EzcapechatRTMPProtocol:
         # data[5] = receiver
         # data[6] = msg color
         # data[7] = ?
-        print ('[PM] %s: %s' % (data[3], data[5]))
+        self._moderate(data[3], data[5], moderation.PM)
+        if self.shared_state is not None:
+            self.shared_state.count(shared.PRIVATE_MESSAGES)
+        self._emit(sinks.EVENT, '[PM] %s: %s', data[3], data[5])
+
+    def _moderate(self, user_name, msg, source):
+        """
+        Check a message and its sender against the moderation rules, if there is a matcher.
+
+        :param user_name: The nick of the sender.
+        :type user_name: str
+        :param msg: The message.
+        :type msg: str
+        :param source: moderation.PUBLIC or moderation.PM
+        :type source: str
+        """
+        if self.matcher is not None:
+            result = self.matcher.check(msg, user_name)
+            if result:
+                self.on_moderation_match(user_name, msg, result, source)
+
+    def _users_changed(self):
+        """ Publish the changed users, and schedule a snapshot. """
+        self._publish_users()
+        self._schedule_snapshot()
+
+    def _publish_users(self):
+        """ Publish the users in shared memory, if there is a shared state. """
+        if self.shared_state is not None:
+            self.shared_state.publish(list(self.users.all.values()))
+
+    def _check_flood(self):
+        """ Evaluate the flood detector if a tick is due, and pass on any alerts. """
+        alerts = self.flood_detector.poll()
+        if alerts:
+            self.on_flood(alerts)
+
+    def on_flood(self, alerts):
+        """
+        Received when users go over a flood threshold.
+
+        :param alerts: The users over a threshold.
+        :type alerts: list of flood.FloodAlert
+        """
+        for alert in alerts:
+            self._emit(sinks.EVENT, 'Flood: %s messages=%s churn=%s typing=%s repeats=%s',
+                       alert.nick, alert.messages, alert.churn, alert.typing, alert.repeats)
+
+    def on_moderation_match(self, user_name, msg, result, source):
+        """
+        Received when a message or its sender matches moderation rules.
+
+        :param user_name: The nick of the sender.
+        :type user_name: str
+        :param msg: The message.
+        :type msg: str
+        :param result: The match result, with the matching rules and the match latency.
+        :type result: moderation.MatchResult
+        :param source: moderation.PUBLIC or moderation.PM
+        :type source: str
+        """
+        self._emit(sinks.EVENT, '[%s] %s matched %s', source, user_name,
+                   [rule.name for rule in result.rules])
 
     def on_removeuser(self, username):
         """
@@ -412,23 +981,49 @@ class EzcapechatRTMPProtocol:
         :type username: str
         """
         self.users.remove(username)
-        print ('%s left the room.' % username)
+        if self.flood_detector is not None:
+            self.flood_detector.leave(username)
+            self._check_flood()
+        if self.shared_state is not None:
+            self.shared_state.count(shared.LEAVES)
+        self._users_changed()
+        self._emit(sinks.EVENT, '%s left the room.', username)
 
     def on_status_update(self, data):
         """
         Received when a user changes their status. E.g /afk or /back.
 
-        :param data:
+        :param data: The status update, data[3] is the user nick.
         :type data: list
         """
-        # TODO: Update User/Client object with this info
-        print ('Status Update: %s' % data)
+        # the layout is not known for sure. the fields are only applied if the packet
+        # matches the joinuser layout, data[4] = mod level, data[5] = status, data[6] = user id.
+        nick = data[3]
+        if nick == self.users.client.nick:
+            _user = self.users.client
+        else:
+            _user = self.users.all.get(nick)
+        if _user is None or len(data) < 7 or str(data[6]) != str(_user.id):
+            log.debug('status update of unknown layout: %s' % data)
+        else:
+            user_data = {'st': data[5]}
+            # keep the mod level, unless the packet clearly carries one.
+            ml = data[4]
+            if isinstance(ml, (int, float)) and not isinstance(ml, bool) and ml >= 0 and ml == int(ml):
+                user_data['ml'] = data[4]
+            if _user is self.users.client:
+                # add_client_data would reset the fields not in the update.
+                for key in user_data:
+                    setattr(_user, key, user.intern_string(user_data[key]))
+            elif self.users.update(nick, user_data) is not None:
+                self._users_changed()
+        self._emit(sinks.EVENT, 'Status Update: %s', data)
 
     def on_connectin_ok(self):
         """
 
         """
-        print ('ConnectionOk: The connection to the room was established.')
+        self._emit(sinks.EVENT, 'ConnectionOk: The connection to the room was established.')
 
     def on_yt_video_queue_add(self, data):
         """
@@ -439,24 +1034,152 @@ class EzcapechatRTMPProtocol:
         """
         # video_time = data[6]
         # queue number? = data[7]
-        print ('%s added %s (%s) to the video queue.' % (data[3], data[5], data[4]))
+        track = media.Track(int(data[7]), data[4], data[5], data[6], data[3])
+        if not self.media.add(track):
+            self._sync_media()
+        self._schedule_snapshot()
+        self._emit(sinks.EVENT, '%s added %s (%s) to the video queue.', data[3], data[5], data[4])
 
     def on_yt_video_current(self, data):
         # offset? = data[5]
         # queue number? = data[6]
-        print ('Current video: %s (%s)' % (data[4], data[3]))
+        if not self.media.play(int(data[6]), data[3], data[4], data[5]):
+            self._sync_media()
+        self._schedule_snapshot()
+        self._emit(sinks.EVENT, 'Current video: %s (%s)', data[4], data[3])
 
     def on_yt_video_queue(self, data):
         # hmm. what*?.
-        json_data = json.loads(data[3])
-        print ('ytVideoQueue: %s' % json_data['c'])
+        items = None
+        try:
+            items = json.loads(data[3])['c']
+            self.media.sync(media.parse_queue(items))
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning('failed to parse the video queue: %s' % e)
+            self.media.sync_failed()
+        else:
+            self._schedule_snapshot()
+        self._emit(sinks.EVENT, 'ytVideoQueue: %s', items)
+
+    def _sync_media(self):
+        """ Request the full video queue, if the media queue missed an event and no request is pending. """
+        if self.media.request_sync():
+            self.send_tp_get_queue()
 
     # Message construction.
+    @property
+    def send_queue_stats(self):
+        """
+        The metrics of the outbound message queue.
+
+        :return: The send queue metrics.
+        :rtype: outbound.SendQueueStats
+        """
+        return self._outbound.stats
+
+    def _send(self, priority, build, *args):
+        """
+        Queue a message for the writer thread.
+
+        :param priority: outbound.CONTROL, outbound.NORMAL or outbound.CHAT
+        :type priority: int
+        :param build: The name of the method returning the process name and parameters
+                      of the message, called with args when sent.
+        :type build: str
+        :return: True if queued, False if dropped.
+        :rtype: bool
+        """
+        return self._outbound.put(priority, build, args)
+
+    def _send_chat(self, build, args, dedup=None):
+        """
+        Queue a chat message with the next message counter, which also identifies it in the queue.
+
+        :param build: The name of the method building the message, called with args and the counter.
+        :type build: str
+        :param args: The build method arguments.
+        :type args: tuple
+        :param dedup: Identifies the content, a repeated send within SEND_DEDUP_WINDOW is ignored.
+        :type dedup: tuple | None
+        :return: True if queued, False if dropped or a repeated send.
+        :rtype: bool
+        """
+        counter = self._next_msg_counter()
+        return self._outbound.put(outbound.CHAT, build, args + (counter,), key=counter, dedup=dedup)
+
+    def _build(self, build, *args):
+        """
+        Build a queued message, called by the writer thread.
+
+        :param build: The name of the build method.
+        :type build: str
+        :return: The process name and parameters.
+        :rtype: tuple
+        """
+        return getattr(self, build)(*args)
+
+    def _on_send_result(self, build, args, error):
+        """
+        Received from the writer thread when a queued message was sent or expired.
+
+        :param build: The name of the build method.
+        :type build: str
+        :param args: The build method arguments.
+        :type args: tuple
+        :param error: None if sent, else the reason it was not.
+        :type error: str | None
+        """
+        if build == '_broadcast_pm_message':
+            broadcast = self._broadcasts.get(args[0])
+            if broadcast is not None:
+                if error is None:
+                    broadcast.mark_sent(args[1])
+                else:
+                    broadcast.mark_failed(args[1], error)
+                self._broadcast_done(broadcast)
+
+    def _joined(self, event_data):
+        """
+        The room accepted the connection, send the pending messages. A dispatcher handler.
+
+        :param event_data: The connectionOK event data.
+        :type event_data: list
+        """
+        if self.lifecycle.is_open:
+            self._outbound.resume()
+            self.lifecycle.transition(lifecycle.JOINED)
+
+    def _call(self, process_name, parameters):
+        """
+        Send a message on the connection, called by the writer thread.
+
+        :param process_name: The process name.
+        :type process_name: str
+        :param parameters: The message parameters.
+        :type parameters: list
+        """
+        self.connection.call(process_name, parameters)
+
+    def _next_msg_counter(self):
+        """
+        Get the message counter for a chat message, and advance it.
+
+        :return: The message counter.
+        :rtype: int
+        """
+        with self._msg_counter_lock:
+            counter = self._msg_counter
+            self._msg_counter += 1
+            return counter
+
     def send_connection_ok(self):
         """
 
         """
-        self.connection.call(
+        self._send(outbound.CONTROL, '_connection_ok_message')
+
+    def _connection_ok_message(self):
+        return (
             'connectionOK',
             [
                 self._room_id,
@@ -468,12 +1191,16 @@ class EzcapechatRTMPProtocol:
 
     def send_public(self, msg):
         """
+        Send a public message, split in to pieces if longer than MAX_MSG_LENGTH.
 
-
-        :param msg:
-        :type msg:
+        :param msg: The message.
+        :type msg: str
         """
-        self.connection.call(
+        for part, chunk in enumerate(string_util.chunk_string(msg, config.MAX_MSG_LENGTH)):
+            self._send_chat('_public_message', (chunk,), dedup=('_public_message', chunk, part))
+
+    def _public_message(self, msg, counter):
+        return (
             'send_public',
             [
                 self._room_id,
@@ -481,14 +1208,24 @@ class EzcapechatRTMPProtocol:
                 self.users.client.nick,
                 msg,
                 '0',
-                '#dddddd',         # text color.
-                '3',               # text sizes (0,1,2 or 3)
-                self._msg_counter  # message counter.
+                '#dddddd',                  # text color.
+                '3',                        # text sizes (0,1,2 or 3)
+                counter                     # message counter.
             ]
         )
 
     def send_secure_message(self, msg):
-        self.connection.call(
+        """
+        Send a secure message, split in to pieces if longer than MAX_MSG_LENGTH.
+
+        :param msg: The message.
+        :type msg: str
+        """
+        for part, chunk in enumerate(string_util.chunk_string(msg, config.MAX_MSG_LENGTH)):
+            self._send_chat('_secure_message', (chunk,), dedup=('_secure_message', chunk, part))
+
+    def _secure_message(self, msg, counter):
+        return (
             'secure_message',
             [
                 self._room_id,
@@ -497,29 +1234,113 @@ class EzcapechatRTMPProtocol:
                 msg,
                 '0',            # text size?
                 100,            # ?
-                self._msg_counter
+                counter
             ]
         )
 
-    def send_tp_get_queue(self):
+    def send_pm(self, nick, msg):
         """
+        Send a private message to a user, split in to pieces if longer than MAX_MSG_LENGTH.
 
+        :param nick: The nick of the user.
+        :type nick: str
+        :param msg: The message.
+        :type msg: str
         """
-        self.connection.call(
-            'tpGetQueue',
+        for part, chunk in enumerate(string_util.chunk_string(msg, config.MAX_MSG_LENGTH)):
+            self._send_chat('_pm_message', (chunk, nick), dedup=('_pm_message', chunk, nick, part))
+
+    def _pm_message(self, msg, nick, counter):
+        # based on the pmReceive parameters.
+        return (
+            'send_pm',
             [
                 self._room_id,
                 self.users.client.key,
-                self.users.client.nick
+                self.users.client.nick,
+                nick,                       # receiver?
+                msg,
+                '#dddddd',                  # text color.
+                counter
             ]
         )
 
+    def broadcast_pm(self, msg, recipients=None, on_progress=None):
+        """
+        Send a private message to many users, paced by the send queue.
+
+        The parts of the message shared by all recipients are encoded once.
+        A recipient fails if the message was dropped or expired in the
+        queue, or if the recipient left the room before it was sent.
+
+        :param msg: The message, at most MAX_MSG_LENGTH long.
+        :type msg: str
+        :param recipients: Users or nicks, E.g self.users.mods, defaults to all users but the client.
+        :type recipients: list | dict | None
+        :param on_progress: Callable taking the broadcast, called from the writer thread after each recipient.
+        :type on_progress: callable | None
+        :return: The broadcast, tracking the progress and the failed recipients.
+        :rtype: outbound.Broadcast
+        """
+        if recipients is None:
+            recipients = self.users.all
+        nicks = []
+        seen = {self.users.client.nick}
+        for recipient in list(recipients):
+            if isinstance(recipient, user.User):
+                recipient = recipient.nick
+            if recipient not in seen:
+                seen.add(recipient)
+                nicks.append(recipient)
+
+        msg = msg[:config.MAX_MSG_LENGTH]
+        broadcast = outbound.Broadcast(next(self._broadcast_ids), msg, nicks, on_progress)
+        if not broadcast.is_done:
+            self._broadcasts[broadcast.id] = broadcast
+            for nick in nicks:
+                if not self._send_chat('_broadcast_pm_message', (broadcast.id, nick)):
+                    broadcast.mark_failed(nick, 'dropped')
+        self._emit(sinks.EVENT, 'Broadcast %s queued for %s users.', broadcast.id, len(nicks))
+        self._broadcast_done(broadcast)
+        return broadcast
+
+    def _broadcast_pm_message(self, broadcast_id, nick, counter):
+        broadcast = self._broadcasts.get(broadcast_id)
+        if broadcast is None:
+            return None
+        if nick not in self.users.all:
+            broadcast.mark_failed(nick, 'left')
+            self._broadcast_done(broadcast)
+            return None
+
+        client = self.users.client
+        sender, body = broadcast.encoded(
+            (self._room_id, client.key, client.nick),
+            lambda: (writer.EncodedElements([self._room_id, client.key, client.nick]),
+                     writer.EncodedElements([broadcast.msg, '#dddddd'])))
+        return 'send_pm', [sender, nick, body, counter]
+
+    def _broadcast_done(self, broadcast):
+        """ Forget a broadcast once all recipients are done. """
+        if broadcast.is_done and self._broadcasts.pop(broadcast.id, None) is not None:
+            self._emit(sinks.EVENT, 'Broadcast %s done, sent: %s failed: %s',
+                       broadcast.id, len(broadcast.sent), len(broadcast.failed))
+
+    def send_tp_get_queue(self):
+        """
+
+        """
+        self._send(outbound.NORMAL, '_room_request', 'tpGetQueue')
+
     def send_tp_get_current(self):
         """
 
         """
-        self.connection.call(
-            'tpGetCurrent',
+        self._send(outbound.NORMAL, '_room_request', 'tpGetCurrent')
+
+    def _room_request(self, process_name):
+        return (
+            process_name,
             [
                 self._room_id,
                 self.users.client.key,
@@ -529,7 +1350,10 @@ class EzcapechatRTMPProtocol:
 
     def send_change_topic(self, new_topic):
         # based on the info from the decompiled SWF.
-        self.connection.call(
+        self._send(outbound.NORMAL, '_change_topic_message', new_topic)
+
+    def _change_topic_message(self, new_topic):
+        return (
             'change_topic',
             [
                 self._room_id,
@@ -0,0 +1,308 @@
+""" Sliding window flood and spam detection for the users of a room. """
+import collections
+import threading
+import time
+
+import user
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# counters kept for each user.
+MESSAGES = 0    # public messages.
+CHURN = 1       # joins and leaves.
+TYPING = 2      # typing a private message events.
+
+# a user going over a threshold.
+FloodAlert = collections.namedtuple('FloodAlert', ('nick', 'messages', 'churn', 'typing', 'repeats'))
+
+
+class _ArrayCounters:
+    """ Per user slot ring of time bucket counters, in a numpy array. """
+    def __init__(self, slots, buckets):
+        self._counts = numpy.zeros((3, slots, buckets), dtype=numpy.int32)
+
+    def add(self, counter, slot, bucket):
+        self._counts[counter, slot, bucket] += 1
+
+    def clear_bucket(self, bucket):
+        self._counts[:, :, bucket] = 0
+
+    def clear_slot(self, slot):
+        self._counts[:, slot, :] = 0
+
+    def totals(self):
+        return self._counts.sum(axis=2)
+
+
+class _ListCounters:
+    """ Per user slot ring of time bucket counters, in lists, when numpy is not installed. """
+    def __init__(self, slots, buckets):
+        self._buckets = buckets
+        self._counts = [[[0] * buckets for _ in range(slots)] for _ in range(3)]
+
+    def add(self, counter, slot, bucket):
+        self._counts[counter][slot][bucket] += 1
+
+    def clear_bucket(self, bucket):
+        for counter in self._counts:
+            for row in counter:
+                row[bucket] = 0
+
+    def clear_slot(self, slot):
+        for counter in self._counts:
+            counter[slot] = [0] * self._buckets
+
+    def totals(self):
+        return [[sum(row) for row in counter] for counter in self._counts]
+
+
+class FloodDetector:
+    """
+    Detects users flooding a room with messages, joins/leaves or PM typing,
+    or repeating the same message.
+
+    Each user is given a slot in preallocated arrays of counters per time bucket.
+    The window is a ring of buckets, and all users are evaluated in one
+    vectorized pass per tick when numpy is installed, else in a python loop.
+    """
+    def __init__(self, slots=1024, window=10, buckets=10, max_messages=8,
+                 max_churn=6, max_typing=10, max_repeats=3):
+        """
+        Initialize the FloodDetector.
+
+        :param slots: The max number of users tracked, the least recently seen user is replaced when full.
+        :type slots: int
+        :param window: The window length in seconds.
+        :type window: int | float
+        :param buckets: The number of time buckets in the window.
+        :type buckets: int
+        :param max_messages: Max public messages of a user in the window.
+        :type max_messages: int
+        :param max_churn: Max joins and leaves of a user in the window.
+        :type max_churn: int
+        :param max_typing: Max typing PM events of a user in the window.
+        :type max_typing: int
+        :param max_repeats: Max consecutive repeats of the same message by a user.
+        :type max_repeats: int
+        """
+        self.slots = slots
+        self.window = float(window)
+        self.buckets = buckets
+        self.max_messages = max_messages
+        self.max_churn = max_churn
+        self.max_typing = max_typing
+        self.max_repeats = max_repeats
+
+        self._bucket_time = self.window / buckets
+        self._bucket = None         # absolute number of the current bucket.
+        self._last_tick = 0.0
+        self._lock = threading.Lock()
+
+        self._slot_nicks = [None] * slots
+        self._nick_slots = {}
+        self._free = list(range(slots - 1, -1, -1))
+
+        # evaluate with numpy if installed.
+        self._vectorized = numpy is not None
+        if self._vectorized:
+            self._counters = _ArrayCounters(slots, buckets)
+            self._last_seen = numpy.zeros(slots, dtype=numpy.float64)
+            self._last_hash = numpy.zeros(slots, dtype=numpy.int64)
+            self._repeats = numpy.zeros(slots, dtype=numpy.int32)
+            self._flagged = numpy.zeros(slots, dtype=bool)
+        else:
+            self._counters = _ListCounters(slots, buckets)
+            self._last_seen = [0.0] * slots
+            self._last_hash = [0] * slots
+            self._repeats = [0] * slots
+            self._flagged = [False] * slots
+
+    @property
+    def tracked(self):
+        """
+        The number of users tracked.
+
+        :return: The number of users with a slot.
+        :rtype: int
+        """
+        return len(self._nick_slots)
+
+    def message(self, nick, msg, now=None):
+        """
+        Record a public message.
+
+        :param nick: The nick of the sender.
+        :type nick: str
+        :param msg: The message.
+        :type msg: str
+        :param now: The time, defaults to time.time()
+        :type now: float | None
+        """
+        msg_hash = hash(user.casefold(msg)) & 0x7fffffffffffffff
+        with self._lock:
+            slot = self._record(MESSAGES, nick, now)
+            if self._last_hash[slot] == msg_hash:
+                self._repeats[slot] += 1
+            else:
+                self._last_hash[slot] = msg_hash
+                self._repeats[slot] = 0
+
+    def join(self, nick, now=None):
+        """
+        Record a user joining the room.
+
+        :param nick: The nick of the user.
+        :type nick: str
+        :param now: The time, defaults to time.time()
+        :type now: float | None
+        """
+        with self._lock:
+            self._record(CHURN, nick, now)
+
+    def leave(self, nick, now=None):
+        """
+        Record a user leaving the room.
+
+        :param nick: The nick of the user.
+        :type nick: str
+        :param now: The time, defaults to time.time()
+        :type now: float | None
+        """
+        with self._lock:
+            self._record(CHURN, nick, now)
+
+    def typing(self, nick, now=None):
+        """
+        Record a user typing a private message.
+
+        :param nick: The nick of the user.
+        :type nick: str
+        :param now: The time, defaults to time.time()
+        :type now: float | None
+        """
+        with self._lock:
+            self._record(TYPING, nick, now)
+
+    def poll(self, now=None):
+        """
+        Tick if a bucket length has passed since the last tick.
+
+        :param now: The time, defaults to time.time()
+        :type now: float | None
+        :return: A list of FloodAlert for the users newly over a threshold.
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+        if now - self._last_tick < self._bucket_time:
+            return []
+        return self.tick(now)
+
+    def tick(self, now=None):
+        """
+        Evaluate all users, and release the slots of users not seen for a window.
+
+        A user is reported once when going over a threshold, and again
+        only after having been under all thresholds.
+
+        :param now: The time, defaults to time.time()
+        :type now: float | None
+        :return: A list of FloodAlert for the users newly over a threshold.
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._last_tick = now
+            self._advance(now)
+            if self._vectorized:
+                alerts = self._evaluate_arrays()
+            else:
+                alerts = self._evaluate_lists()
+            self._release_idle(now - self.window)
+            return alerts
+
+    def _evaluate_arrays(self):
+        """ Evaluate all slots with numpy. Must hold the lock. """
+        totals = self._counters.totals()
+        over = ((totals[MESSAGES] > self.max_messages) | (totals[CHURN] > self.max_churn) |
+                (totals[TYPING] > self.max_typing) | (self._repeats >= self.max_repeats))
+        new = over & ~self._flagged
+        self._flagged = over
+        return [self._alert(slot, totals[MESSAGES][slot], totals[CHURN][slot], totals[TYPING][slot])
+                for slot in numpy.nonzero(new)[0] if self._slot_nicks[slot] is not None]
+
+    def _evaluate_lists(self):
+        """ Evaluate all slots in python. Must hold the lock. """
+        totals = self._counters.totals()
+        alerts = []
+        for slot in range(self.slots):
+            over = (totals[MESSAGES][slot] > self.max_messages or totals[CHURN][slot] > self.max_churn or
+                    totals[TYPING][slot] > self.max_typing or self._repeats[slot] >= self.max_repeats)
+            if over and not self._flagged[slot] and self._slot_nicks[slot] is not None:
+                alerts.append(self._alert(slot, totals[MESSAGES][slot], totals[CHURN][slot], totals[TYPING][slot]))
+            self._flagged[slot] = over
+        return alerts
+
+    def _alert(self, slot, messages, churn, typing):
+        return FloodAlert(self._slot_nicks[slot], int(messages), int(churn), int(typing), int(self._repeats[slot]))
+
+    def _record(self, counter, nick, now):
+        """ Count an event of a user in the current bucket. Must hold the lock. """
+        if now is None:
+            now = time.time()
+        self._advance(now)
+
+        slot = self._nick_slots.get(nick)
+        if slot is None:
+            slot = self._assign(nick)
+        self._counters.add(counter, slot, self._bucket % self.buckets)
+        self._last_seen[slot] = now
+        return slot
+
+    def _advance(self, now):
+        """ Move to the bucket of a time, clearing the buckets passed. Must hold the lock. """
+        bucket = int(now / self._bucket_time)
+        if self._bucket is None:
+            self._bucket = bucket
+        elif bucket > self._bucket:
+            for b in range(max(self._bucket + 1, bucket - self.buckets + 1), bucket + 1):
+                self._counters.clear_bucket(b % self.buckets)
+            self._bucket = bucket
+
+    def _assign(self, nick):
+        """ Give a nick a slot, replacing the least recently seen user if full. Must hold the lock. """
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._vectorized:
+                slot = int(numpy.argmin(self._last_seen))
+            else:
+                slot = min(range(self.slots), key=self._last_seen.__getitem__)
+            self._clear(slot)
+        self._slot_nicks[slot] = nick
+        self._nick_slots[nick] = slot
+        return slot
+
+    def _clear(self, slot):
+        """ Release a slot. Must hold the lock. """
+        del self._nick_slots[self._slot_nicks[slot]]
+        self._slot_nicks[slot] = None
+        self._counters.clear_slot(slot)
+        self._last_seen[slot] = 0.0
+        self._last_hash[slot] = 0
+        self._repeats[slot] = 0
+        self._flagged[slot] = False
+
+    def _release_idle(self, since):
+        """ Release the slots of users not seen since a time. Must hold the lock. """
+        if self._vectorized:
+            idle = numpy.nonzero((self._last_seen > 0) & (self._last_seen < since))[0]
+        else:
+            idle = [slot for slot in self._nick_slots.values() if self._last_seen[slot] < since]
+        for slot in idle:
+            self._clear(slot)
+            self._free.append(int(slot))
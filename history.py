@@ -0,0 +1,238 @@
+""" Bounded public message history of a room. """
+import array
+import bisect
+import collections
+import threading
+
+# a message from the history.
+Message = collections.namedtuple('Message', ('timestamp', 'nick', 'msg'))
+
+
+class _TimeView:
+    """ Sequence view of the history timestamps by sequence number, for bisect. """
+    def __init__(self, history, first):
+        self._history = history
+        self._first = first
+
+    def __len__(self):
+        return self._history._seq - self._first
+
+    def __getitem__(self, i):
+        return self._history._times[(self._first + i) % self._history.capacity]
+
+
+class MessageHistory:
+    """
+    A fixed capacity ring of the latest messages in a room.
+
+    Timestamps and nicks are kept in compact arrays, with the nicks stored as
+    small ids. When the ring is full the oldest message is overwritten, so the
+    memory used does not grow over long sessions. Nicks are released when
+    their last message leaves the ring.
+
+    Messages are kept in the order received. A timestamp older than the
+    previous one is stored as the previous one, so time range lookups can bisect.
+    """
+    def __init__(self, capacity=1000):
+        """
+        Initialize the MessageHistory.
+
+        :param capacity: The max number of messages kept.
+        :type capacity: int
+        """
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+
+        self.capacity = capacity
+        self._times = array.array('d', [0.0]) * capacity
+        self._nicks = array.array('i', [0]) * capacity
+        self._msgs = [None] * capacity
+        self._seq = 0                   # sequence number of the next message.
+
+        self._nick_ids = {}             # nick: nick id
+        self._id_nicks = {}             # nick id: nick
+        self._free_ids = []
+        self._by_nick = {}              # nick id: deque of sequence numbers
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._seq, self.capacity)
+
+    @property
+    def total(self):
+        """
+        The number of messages added, including overwritten messages.
+
+        :return: The total number of messages.
+        :rtype: int
+        """
+        return self._seq
+
+    @property
+    def nicks(self):
+        """
+        The nicks with messages in the history.
+
+        :return: A list of nicks.
+        :rtype: list
+        """
+        return list(self._nick_ids)
+
+    def add(self, timestamp, nick, msg):
+        """
+        Add a message, overwriting the oldest if the history is full.
+
+        :param timestamp: The server timestamp of the message.
+        :type timestamp: int | float
+        :param nick: The nick of the user sending the message.
+        :type nick: str
+        :param msg: The message.
+        :type msg: str
+        """
+        with self._lock:
+            seq = self._seq
+            slot = seq % self.capacity
+            if seq >= self.capacity:
+                self._evict(slot)
+
+            if seq > 0:
+                previous = self._times[(seq - 1) % self.capacity]
+                if timestamp < previous:
+                    timestamp = previous
+
+            nick_id = self._nick_ids.get(nick)
+            if nick_id is None:
+                nick_id = self._new_nick_id(nick)
+
+            self._times[slot] = timestamp
+            self._nicks[slot] = nick_id
+            self._msgs[slot] = msg
+            self._by_nick[nick_id].append(seq)
+            self._seq = seq + 1
+
+    def latest(self, count=None):
+        """
+        The latest messages.
+
+        :param count: The max number of messages, None for all.
+        :type count: int | None
+        :return: A list of Message, oldest first.
+        :rtype: list
+        """
+        with self._lock:
+            first = self._first()
+            if count is not None:
+                first = max(first, self._seq - count)
+            return [self._message(seq) for seq in range(first, self._seq)]
+
+    def by_user(self, nick, count=None):
+        """
+        The messages of a user.
+
+        :param nick: The nick of the user.
+        :type nick: str
+        :param count: The max number of messages, None for all.
+        :type count: int | None
+        :return: A list of Message, oldest first.
+        :rtype: list
+        """
+        with self._lock:
+            nick_id = self._nick_ids.get(nick)
+            if nick_id is None:
+                return []
+            seqs = self._by_nick[nick_id]
+            if count is not None and count < len(seqs):
+                seqs = list(seqs)[len(seqs) - count:]
+            return [self._message(seq) for seq in seqs]
+
+    def last_message(self, nick):
+        """
+        The latest message of a user.
+
+        :param nick: The nick of the user.
+        :type nick: str
+        :return: The message, or None if the user has no messages in the history.
+        :rtype: Message | None
+        """
+        with self._lock:
+            nick_id = self._nick_ids.get(nick)
+            if nick_id is None:
+                return None
+            return self._message(self._by_nick[nick_id][-1])
+
+    def between(self, start, end=None, nick=None):
+        """
+        The messages in a time range, optionally from one user.
+
+        :param start: The earliest timestamp, inclusive.
+        :type start: int | float
+        :param end: The latest timestamp, inclusive, None for no limit.
+        :type end: int | float | None
+        :param nick: Only messages of this nick.
+        :type nick: str | None
+        :return: A list of Message, oldest first.
+        :rtype: list
+        """
+        with self._lock:
+            if nick is not None:
+                nick_id = self._nick_ids.get(nick)
+                if nick_id is None:
+                    return []
+                seqs = self._by_nick[nick_id]
+                return [self._message(seq) for seq in seqs
+                        if self._in_range(self._times[seq % self.capacity], start, end)]
+
+            first = self._first()
+            seq = first + bisect.bisect_left(_TimeView(self, first), start)
+            messages = []
+            while seq < self._seq:
+                if end is not None and self._times[seq % self.capacity] > end:
+                    break
+                messages.append(self._message(seq))
+                seq += 1
+            return messages
+
+    def clear(self):
+        """ Remove all messages. """
+        with self._lock:
+            self._msgs = [None] * self.capacity
+            self._seq = 0
+            self._nick_ids.clear()
+            self._id_nicks.clear()
+            del self._free_ids[:]
+            self._by_nick.clear()
+
+    @staticmethod
+    def _in_range(timestamp, start, end):
+        return timestamp >= start and (end is None or timestamp <= end)
+
+    def _first(self):
+        """ The sequence number of the oldest message. Must hold the lock. """
+        return max(0, self._seq - self.capacity)
+
+    def _message(self, seq):
+        """ The message with a sequence number. Must hold the lock. """
+        slot = seq % self.capacity
+        return Message(self._times[slot], self._id_nicks[self._nicks[slot]], self._msgs[slot])
+
+    def _new_nick_id(self, nick):
+        """ Assign an id to a nick. Must hold the lock. """
+        if self._free_ids:
+            nick_id = self._free_ids.pop()
+        else:
+            nick_id = len(self._nick_ids)
+        self._nick_ids[nick] = nick_id
+        self._id_nicks[nick_id] = nick
+        self._by_nick[nick_id] = collections.deque()
+        return nick_id
+
+    def _evict(self, slot):
+        """ Drop the oldest message before its slot is overwritten. Must hold the lock. """
+        nick_id = self._nicks[slot]
+        seqs = self._by_nick[nick_id]
+        seqs.popleft()
+        if not seqs:
+            del self._by_nick[nick_id]
+            del self._nick_ids[self._id_nicks.pop(nick_id)]
+            self._free_ids.append(nick_id)
@@ -0,0 +1,220 @@
+""" Connection lifecycle states of a room connection, with blocking and asyncio waits. """
+import logging
+import threading
+import timeit
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+log = logging.getLogger(__name__)
+
+# connection states, in the order entered.
+CONNECTING = 'connecting'           # loading the room params and opening the socket.
+HANDSHAKEN = 'handshaken'           # the rtmp handshake is done.
+RTMP_CONNECTED = 'rtmp-connected'   # the rtmp connect was sent, waiting for the room to accept us.
+JOINED = 'joined'                   # the room accepted the connection (connectionOK).
+CLOSING = 'closing'                 # disconnecting.
+CLOSED = 'closed'                   # not connected, the initial state.
+
+STATES = (CONNECTING, HANDSHAKEN, RTMP_CONNECTED, JOINED, CLOSING, CLOSED)
+
+# states in which the connection is read from.
+OPEN = (HANDSHAKEN, RTMP_CONNECTED, JOINED)
+
+
+def _states(states):
+    """ A state or a tuple of states, as a tuple. """
+    if isinstance(states, tuple):
+        return states
+    return (states,)
+
+
+class Lifecycle:
+    """
+    The current state of a connection.
+
+    Every state has a threading.Event set while it is the current state.
+    wait() blocks until one of the given states is entered, and wait_async()
+    returns an asyncio future for the same, resolved on its own event loop.
+
+    The time each state was entered is kept per connect attempt,
+    E.g elapsed(CONNECTING, JOINED) is the time it took to join.
+    """
+    def __init__(self, on_change=None):
+        """
+        Initialize the Lifecycle in the CLOSED state.
+
+        :param on_change: Callable taking the previous and the new state,
+                          called on the thread making the transition.
+        :type on_change: callable | None
+        """
+        self.on_change = on_change
+        self._state = CLOSED
+        self._entered = {CLOSED: timeit.default_timer()}
+        self._events = dict((state, threading.Event()) for state in STATES)
+        self._events[CLOSED].set()
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    @property
+    def state(self):
+        """
+        The current state.
+
+        :return: One of STATES.
+        :rtype: str
+        """
+        return self._state
+
+    @property
+    def is_open(self):
+        """
+        Is the connection open for reading.
+
+        :return: True if handshaken, rtmp connected or joined.
+        :rtype: bool
+        """
+        return self._state in OPEN
+
+    def event(self, state):
+        """
+        The event of a state.
+
+        :param state: One of STATES.
+        :type state: str
+        :return: An event set while the state is the current state.
+        :rtype: threading.Event
+        """
+        return self._events[state]
+
+    def entered(self, state):
+        """
+        The time a state was entered in the current connect attempt.
+
+        :param state: One of STATES.
+        :type state: str
+        :return: The timeit.default_timer() time, or None if not entered.
+        :rtype: float | None
+        """
+        return self._entered.get(state)
+
+    def elapsed(self, start, end):
+        """
+        The time between entering two states in the current connect attempt.
+
+        :param start: The first state.
+        :type start: str
+        :param end: The later state.
+        :type end: str
+        :return: The time in seconds, or None if either state was not entered.
+        :rtype: float | None
+        """
+        start_time = self._entered.get(start)
+        end_time = self._entered.get(end)
+        if start_time is None or end_time is None:
+            return None
+        return end_time - start_time
+
+    def transition(self, state):
+        """
+        Enter a state, waking the waiters of the state.
+
+        Entering CONNECTING starts a new connect attempt,
+        forgetting the times of the previous attempt.
+
+        :param state: One of STATES.
+        :type state: str
+        """
+        if state not in self._events:
+            raise ValueError('unknown state: %s' % state)
+
+        with self._cond:
+            previous = self._state
+            if state == previous:
+                return
+            if state == CONNECTING:
+                self._entered.clear()
+            self._entered[state] = timeit.default_timer()
+            self._state = state
+            self._events[previous].clear()
+            self._events[state].set()
+            self._cond.notify_all()
+
+            waiters = [waiter for waiter in self._async_waiters if state in waiter[0]]
+            for waiter in waiters:
+                self._async_waiters.remove(waiter)
+
+        log.debug('state: %s -> %s' % (previous, state))
+        for _, loop, future in waiters:
+            loop.call_soon_threadsafe(self._resolve, future, state)
+        if self.on_change is not None:
+            self.on_change(previous, state)
+
+    def wait(self, states, timeout=None):
+        """
+        Block until a state is entered, or return at once if it is the current state.
+
+        :param states: A state, or a tuple of states.
+        :type states: str | tuple
+        :param timeout: Max seconds to wait, None to wait forever.
+        :type timeout: int | float | None
+        :return: The state entered, or None on timeout.
+        :rtype: str | None
+        """
+        states = _states(states)
+        deadline = None
+        if timeout is not None:
+            deadline = timeit.default_timer() + timeout
+
+        with self._cond:
+            while self._state not in states:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - timeit.default_timer()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            return self._state
+
+    def wait_async(self, states, loop=None):
+        """
+        An awaitable resolved when a state is entered, E.g state = await lifecycle.wait_async(JOINED)
+
+        :param states: A state, or a tuple of states.
+        :type states: str | tuple
+        :param loop: The event loop to resolve on, defaults to the current event loop.
+        :type loop: asyncio.AbstractEventLoop | None
+        :return: A future resolved with the state entered.
+        :rtype: asyncio.Future
+        """
+        if asyncio is None:
+            raise RuntimeError('asyncio is not available')
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        states = _states(states)
+        future = loop.create_future()
+        with self._cond:
+            if self._state in states:
+                future.set_result(self._state)
+            else:
+                self._async_waiters.append((states, loop, future))
+                # a cancelled future is never resolved by a transition, forget it when done.
+                future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        """ Forget the waiter of a done future. """
+        with self._cond:
+            self._async_waiters = [waiter for waiter in self._async_waiters if waiter[2] is not future]
+
+    @staticmethod
+    def _resolve(future, state):
+        if not future.done():
+            future.set_result(state)
+
+    def __repr__(self):
+        return '<Lifecycle state=%s>' % self._state
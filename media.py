@@ -0,0 +1,272 @@
+""" Incremental model of the YouTube media queue of a room. """
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# a track in the media queue.
+Track = collections.namedtuple('Track', ('number', 'video_id', 'title', 'duration', 'nick'))
+
+
+def parse_queue(items):
+    """
+    Parse the tracks of a full queue, the c list of a ytVideoQueue event.
+
+    Each item is expected in the order of the ytVideoQueueAdd parameters,
+    [nick, video id, title, video time, queue number]
+
+    :param items: The queue items.
+    :type items: list
+    :return: A list of Track, in queue order.
+    :rtype: list
+    """
+    tracks = []
+    for item in items:
+        nick, video_id, title, duration, number = item[:5]
+        tracks.append(Track(int(number), video_id, title, duration, nick))
+    return tracks
+
+
+class MediaQueue:
+    """
+    The media queue of a room, kept up to date from the queue events.
+
+    Added tracks and track changes are applied as they arrive. The queue
+    numbers are expected to increase by one per added track, so a missing
+    number means an event was missed, and the queue needs a resync from a
+    full ytVideoQueue. request_sync() tells when to ask for one.
+
+    A full queue that could not be parsed is reported with sync_failed(),
+    each failure doubles the wait before requesting again, and after
+    max_sync_failures in a row no more syncs are requested.
+    """
+    def __init__(self, sync_timeout=10.0, max_sync_failures=3):
+        """
+        Initialize the MediaQueue, needing a sync.
+
+        :param sync_timeout: Seconds to wait for a requested sync before requesting again.
+        :type sync_timeout: int | float
+        :param max_sync_failures: Failed syncs in a row before no more syncs are requested.
+        :type max_sync_failures: int
+        """
+        self.sync_timeout = sync_timeout
+        self.max_sync_failures = max_sync_failures
+        self.syncs = 0
+        self.gaps = 0
+        self.sync_failures = 0
+
+        self._tracks = collections.OrderedDict()    # queue number: Track
+        self._current = None
+        self._started = None                        # time.time() the current track started.
+        self._last_number = None                    # the highest queue number seen.
+        self._in_sync = False
+        self._sync_requested = None
+        self._failures = 0                          # failed syncs in a row.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    @property
+    def current(self):
+        """
+        The track playing.
+
+        :return: The current track, or None if not known.
+        :rtype: Track | None
+        """
+        return self._current
+
+    @property
+    def position(self):
+        """
+        The estimated play position of the current track.
+
+        :return: Seconds since the start of the track, or None if not known.
+        :rtype: float | None
+        """
+        started = self._started
+        if started is None:
+            return None
+        return time.time() - started
+
+    @property
+    def queue(self):
+        """
+        The tracks waiting to be played.
+
+        :return: A list of Track, in play order.
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._tracks.values())
+
+    @property
+    def in_sync(self):
+        """
+        Is the queue known to be complete.
+
+        :return: True if no event was missed since the last sync.
+        :rtype: bool
+        """
+        return self._in_sync
+
+    def add(self, track):
+        """
+        Apply a track added to the queue.
+
+        :param track: The track added.
+        :type track: Track
+        :return: False if an event was missed, and the queue needs a sync.
+        :rtype: bool
+        """
+        with self._lock:
+            if track.number in self._tracks:
+                return self._in_sync
+            if self._last_number is not None and track.number != self._last_number + 1:
+                self._gap('add %s after %s' % (track.number, self._last_number))
+            self._tracks[track.number] = track
+            self._see(track.number)
+            return self._in_sync
+
+    def play(self, number, video_id, title, offset=0):
+        """
+        Apply a change of the current track, removing it and the tracks before it from the queue.
+
+        :param number: The queue number of the track.
+        :type number: int
+        :param video_id: The video id.
+        :type video_id: str
+        :param title: The video title.
+        :type title: str
+        :param offset: Seconds in to the track.
+        :type offset: int | float
+        :return: False if an event was missed, and the queue needs a sync.
+        :rtype: bool
+        """
+        with self._lock:
+            track = self._tracks.get(number)
+            if track is None:
+                if self._in_sync and (self._last_number is None or number > self._last_number):
+                    self._gap('playing %s not in the queue' % number)
+                track = Track(number, video_id, title, None, None)
+
+            while self._tracks:
+                first = next(iter(self._tracks))
+                if first > number:
+                    break
+                del self._tracks[first]
+
+            self._current = track
+            self._started = time.time() - (offset or 0)
+            self._see(number)
+            return self._in_sync
+
+    def sync(self, tracks, current=None):
+        """
+        Replace the queue with a full queue.
+
+        :param tracks: The queued tracks, in queue order.
+        :type tracks: list of Track
+        :param current: The current track, None to keep the current track.
+        :type current: Track | None
+        """
+        with self._lock:
+            self._tracks = collections.OrderedDict((track.number, track) for track in tracks)
+            if current is not None:
+                self._current = current
+            numbers = list(self._tracks)
+            if self._current is not None:
+                numbers.append(self._current.number)
+            self._last_number = max(numbers) if numbers else self._last_number
+            self._in_sync = True
+            self._sync_requested = None
+            self._failures = 0
+            self.syncs += 1
+
+    def sync_failed(self):
+        """ A requested full queue could not be parsed, back off before requesting again. """
+        with self._lock:
+            self._failures += 1
+            self.sync_failures += 1
+            if self._failures == self.max_sync_failures:
+                log.warning('media queue sync failed %s times, not requesting more syncs' % self._failures)
+
+    def snapshot(self):
+        """
+        The current track and queue, for restoring after a restart.
+
+        :return: A JSON serializable dictionary.
+        :rtype: dict
+        """
+        with self._lock:
+            current = list(self._current) if self._current is not None else None
+            return {'current': current, 'started': self._started, 'last_number': self._last_number,
+                    'tracks': [list(track) for track in self._tracks.values()]}
+
+    def restore(self, state):
+        """
+        Replace the queue with a snapshot.
+
+        The restored queue may be stale, so it is not in sync,
+        and the first queue event requests a full queue.
+
+        :param state: A dictionary from snapshot.
+        :type state: dict
+        """
+        with self._lock:
+            self._tracks = collections.OrderedDict((track[0], Track(*track)) for track in state['tracks'])
+            self._current = Track(*state['current']) if state['current'] is not None else None
+            self._started = state['started']
+            self._last_number = state['last_number']
+            self._in_sync = False
+            self._sync_requested = None
+
+    def request_sync(self):
+        """
+        Should a full queue be requested now.
+
+        True once per missed event, and again if the sync did not arrive within sync_timeout,
+        doubled for every failed sync in a row. False after max_sync_failures failed syncs.
+
+        :return: True if the caller should request the full queue.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._in_sync or self._failures >= self.max_sync_failures:
+                return False
+            now = time.time()
+            timeout = self.sync_timeout * 2 ** self._failures
+            if self._sync_requested is not None and now - self._sync_requested < timeout:
+                return False
+            self._sync_requested = now
+            return True
+
+    def clear(self):
+        """ Forget the queue, E.g when reconnecting. """
+        with self._lock:
+            self._tracks.clear()
+            self._current = None
+            self._started = None
+            self._last_number = None
+            self._in_sync = False
+            self._sync_requested = None
+            self._failures = 0
+
+    def _see(self, number):
+        """ Note a queue number. Must hold the lock. """
+        if self._last_number is None or number > self._last_number:
+            self._last_number = number
+
+    def _gap(self, reason):
+        """ An event was missed. Must hold the lock. """
+        if self._in_sync:
+            log.info('media queue out of sync: %s' % reason)
+            self.gaps += 1
+        self._in_sync = False
+
+    def __repr__(self):
+        return '<MediaQueue current=%s queued=%s in_sync=%s>' % \
+               (self._current.video_id if self._current else None, len(self._tracks), self._in_sync)
@@ -0,0 +1,427 @@
+""" Moderation matcher checking messages and nicks against a rule set. """
+import collections
+import logging
+import os
+import re
+import threading
+import timeit
+
+import user
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+log = logging.getLogger(__name__)
+
+# rule kinds.
+PHRASE = 'phrase'   # a case insensitive phrase anywhere in a message.
+REGEX = 'regex'     # a regular expression searched in a message.
+NICK = 'nick'       # a regular expression searched in a nick.
+
+KINDS = (PHRASE, REGEX, NICK)
+
+# message sources.
+PUBLIC = 'public'
+PM = 'pm'
+
+
+class RuleError(Exception):
+    """ Raised when a rule can not be parsed or compiled. """
+    pass
+
+
+# a moderation rule.
+Rule = collections.namedtuple('Rule', ('kind', 'pattern', 'name'))
+
+
+def parse_rules(lines):
+    """
+    Parse rules from lines of text.
+
+    Each line is a rule in the form kind:pattern, E.g phrase:buy followers
+    Empty lines and lines starting with # are ignored.
+
+    :param lines: The lines.
+    :type lines: list
+    :return: A list of Rule.
+    :rtype: list
+    """
+    rules = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        kind, sep, pattern = line.partition(':')
+        kind = kind.strip()
+        if not sep or kind not in KINDS or not pattern:
+            raise RuleError('invalid rule on line %s: %s' % (number, line))
+        rules.append(Rule(kind, pattern, '%s:%s' % (kind, pattern)))
+    return rules
+
+
+class _Automaton:
+    """ Aho-Corasick automaton finding all phrases in a text in one pass. """
+    def __init__(self, phrases):
+        """
+        Build the automaton.
+
+        :param phrases: A list of (casefolded phrase, value) tuples.
+        :type phrases: list
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for phrase, value in phrases:
+            state = 0
+            for char in phrase:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] += (value,)
+
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._out[next_state] += self._out[fail]
+
+    def search(self, text):
+        """
+        Find the phrases in a casefolded text.
+
+        :return: A set of the values of the phrases found.
+        :rtype: set
+        """
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class _NativeAutomaton:
+    """ Aho-Corasick automaton using the pyahocorasick extension. """
+    def __init__(self, phrases):
+        values = collections.defaultdict(list)
+        for phrase, value in phrases:
+            values[phrase].append(value)
+
+        self._automaton = ahocorasick.Automaton()
+        for phrase in values:
+            self._automaton.add_word(phrase, tuple(values[phrase]))
+        self._automaton.make_automaton()
+
+    def search(self, text):
+        found = set()
+        if len(self._automaton):
+            for _, values in self._automaton.iter(text):
+                found.update(values)
+        return found
+
+
+def _compile(pattern):
+    """ Compile a pattern, raising re.error for any compile failure. """
+    try:
+        return re.compile(pattern, re.IGNORECASE | re.UNICODE)
+    except (AssertionError, OverflowError, ValueError) as e:
+        # E.g too many groups in python 2.
+        raise re.error(str(e))
+
+
+class _Regexes:
+    """
+    Regular expression rules, each matching rule is reported.
+
+    The rules without groups are combined in one alternation, only used to skip
+    texts matching none of them, as most texts match no rule. The rules with
+    groups or backreferences are always searched on their own, since combining
+    would renumber their groups.
+    """
+    def __init__(self, rules):
+        """
+        Compile the rules.
+
+        :param rules: A list of (index, Rule) tuples.
+        :type rules: list
+        """
+        self._plain = []
+        self._grouped = []
+        for index, rule in rules:
+            try:
+                regex = _compile(rule.pattern)
+            except re.error as e:
+                raise RuleError('invalid pattern in rule %s: %s' % (rule.name, e))
+            if regex.groups:
+                self._grouped.append((index, regex))
+            else:
+                self._plain.append((index, regex))
+
+        self._prefilter = None
+        if len(self._plain) > 1:
+            try:
+                self._prefilter = _compile('|'.join('(?:%s)' % regex.pattern for _, regex in self._plain))
+            except re.error as e:
+                # E.g inline flags, only allowed at the start of a pattern. search each rule instead.
+                log.debug('not combining regex rules: %s' % e)
+
+    def search(self, text):
+        """
+        Find the rules matching a text.
+
+        :return: A set of the indexes of the matching rules.
+        :rtype: set
+        """
+        found = set()
+        if self._prefilter is None or self._prefilter.search(text):
+            for index, regex in self._plain:
+                if regex.search(text):
+                    found.add(index)
+        for index, regex in self._grouped:
+            if regex.search(text):
+                found.add(index)
+        return found
+
+
+class RuleSet:
+    """
+    A compiled, immutable set of rules.
+
+    Phrase rules are matched by one Aho-Corasick automaton. Regex and nick rules
+    are skipped at once when their combined regex finds nothing, else each is searched.
+    """
+    def __init__(self, rules):
+        """
+        Compile the rules.
+
+        :param rules: A list of Rule.
+        :type rules: list
+        """
+        self.rules = tuple(rules)
+
+        phrases = []
+        regexes = []
+        nicks = []
+        for index, rule in enumerate(self.rules):
+            if rule.kind == PHRASE:
+                phrases.append((user.casefold(rule.pattern), index))
+            elif rule.kind == REGEX:
+                regexes.append((index, rule))
+            elif rule.kind == NICK:
+                nicks.append((index, rule))
+            else:
+                raise RuleError('unknown rule kind: %s' % rule.kind)
+
+        automaton = _Automaton if ahocorasick is None else _NativeAutomaton
+        self._phrases = automaton(phrases) if phrases else None
+        self._regexes = _Regexes(regexes)
+        self._nicks = _Regexes(nicks)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, msg=None, nick=None):
+        """
+        Find the rules matching a message and/or a nick.
+
+        :param msg: The message.
+        :type msg: str | None
+        :param nick: The nick.
+        :type nick: str | None
+        :return: A list of the matching Rule, in rule set order.
+        :rtype: list
+        """
+        found = set()
+        if msg:
+            if self._phrases is not None:
+                found.update(self._phrases.search(user.casefold(msg)))
+            found.update(self._regexes.search(msg))
+        if nick:
+            found.update(self._nicks.search(nick))
+        return [self.rules[index] for index in sorted(found)]
+
+
+class MatcherStats:
+    """ Class holding the match latency of a matcher. """
+    def __init__(self):
+        self.checked = 0
+        self.matched = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def avg_time(self):
+        """
+        The average time spent matching a message.
+
+        :return: The average time in seconds.
+        :rtype: float
+        """
+        if self.checked == 0:
+            return 0.0
+        return self.total_time / self.checked
+
+    def __repr__(self):
+        return '<MatcherStats checked=%s matched=%s avg=%.6fs max=%.6fs>' % \
+               (self.checked, self.matched, self.avg_time, self.max_time)
+
+
+class MatchResult:
+    """ Class representing the result of checking a message. """
+    def __init__(self, rules, latency):
+        self.rules = rules
+        self.latency = latency
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return '<MatchResult rules=%s latency=%.6fs>' % ([rule.name for rule in self.rules], self.latency)
+
+
+class Matcher:
+    """
+    Checks messages against the current rule set.
+
+    A reload compiles the new rule set on the calling thread, and then
+    replaces the current one, so checks in progress are never paused.
+    """
+    def __init__(self, rules=(), path=None):
+        """
+        Initialize the Matcher.
+
+        :param rules: A list of Rule.
+        :type rules: list
+        :param path: A rules file to load, and reload when it changes.
+        :type path: str | None
+        """
+        self.path = path
+        self.stats = MatcherStats()
+        self._mtime = None
+        self._ruleset = RuleSet(rules)
+        self._lock = threading.Lock()
+        self._watching = None
+        if path is not None:
+            self.reload_file()
+
+    @property
+    def ruleset(self):
+        """
+        The current rule set.
+
+        :return: The rule set.
+        :rtype: RuleSet
+        """
+        return self._ruleset
+
+    def reload(self, rules):
+        """
+        Compile and switch to a new set of rules.
+
+        :param rules: A list of Rule.
+        :type rules: list
+        """
+        ruleset = RuleSet(rules)
+        self._ruleset = ruleset
+        log.info('loaded %s moderation rules' % len(ruleset))
+
+    def reload_file(self):
+        """
+        Load the rules file if it changed since it was last loaded.
+
+        A rules file with errors is logged, and the current rules are kept.
+
+        :return: True if the rules were reloaded.
+        :rtype: bool
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self._mtime:
+                return False
+            with open(self.path) as f:
+                lines = f.readlines()
+        except (IOError, OSError) as e:
+            log.error('failed to read moderation rules from %s: %s' % (self.path, e))
+            return False
+
+        # a broken file is not retried until it changes again.
+        self._mtime = mtime
+        try:
+            self.reload(parse_rules(lines))
+        except RuleError as e:
+            log.error('failed to load moderation rules from %s: %s' % (self.path, e))
+            return False
+        return True
+
+    def watch(self, interval=5.0):
+        """
+        Reload the rules file on a thread whenever it changes.
+
+        :param interval: Seconds between checks of the rules file.
+        :type interval: int | float
+        """
+        if self.path is None:
+            raise ValueError('no rules file to watch')
+        if self._watching is not None:
+            return
+
+        self._watching = threading.Event()
+        stop = self._watching
+
+        def _watch():
+            while not stop.wait(interval):
+                self.reload_file()
+
+        t = threading.Thread(target=_watch, name='ezclib-rules-watch')
+        t.daemon = True
+        t.start()
+
+    def stop_watching(self):
+        """ Stop watching the rules file. """
+        if self._watching is not None:
+            self._watching.set()
+            self._watching = None
+
+    def check(self, msg=None, nick=None):
+        """
+        Check a message and/or nick against the rules.
+
+        :param msg: The message.
+        :type msg: str | None
+        :param nick: The nick.
+        :type nick: str | None
+        :return: The result, with the matching rules and the time spent matching.
+        :rtype: MatchResult
+        """
+        start = timeit.default_timer()
+        rules = self._ruleset.match(msg, nick)
+        latency = timeit.default_timer() - start
+
+        with self._lock:
+            self.stats.checked += 1
+            if rules:
+                self.stats.matched += 1
+            self.stats.total_time += latency
+            if latency > self.stats.max_time:
+                self.stats.max_time = latency
+        return MatchResult(rules, latency)
@@ -0,0 +1,576 @@
+""" Paced outbound message queue with a single writer thread. """
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import timeit
+
+log = logging.getLogger(__name__)
+
+# priority classes, lower is sent first.
+CONTROL = 0     # protocol control messages, E.g connectionOK. Not rate limited.
+NORMAL = 1      # requests, E.g tpGetQueue.
+CHAT = 2        # chat messages.
+
+PRIORITIES = (CONTROL, NORMAL, CHAT)
+
+
+class TokenBucket:
+    """ Token bucket rate limiter. """
+    def __init__(self, rate, burst):
+        """
+        Initialize the TokenBucket, full.
+
+        :param rate: Tokens added per second.
+        :type rate: int | float
+        :param burst: The max number of tokens.
+        :type burst: int
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = timeit.default_timer()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        """
+        The time until a token is available.
+
+        :return: Seconds to wait, 0 if a token is available.
+        :rtype: float
+        """
+        self._refill(timeit.default_timer())
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        """ Take a token, call when delay() is 0. """
+        self._tokens -= 1
+
+
+class SendQueueStats:
+    """ Class holding the metrics of a send queue. """
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.expired = 0
+        self.skipped = 0
+        self.deduplicated = 0
+        self.build_errors = 0
+        self.requeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def avg_wait(self):
+        """
+        The average time a message waited in the queue.
+
+        :return: The average wait in seconds.
+        :rtype: float
+        """
+        if self.sent == 0:
+            return 0.0
+        return self.total_wait / self.sent
+
+    def __repr__(self):
+        return '<SendQueueStats depth=%s max_depth=%s queued=%s sent=%s dropped=%s failed=%s expired=%s ' \
+               'skipped=%s deduplicated=%s build_errors=%s requeued=%s avg_wait=%.6fs max_wait=%.6fs>' % \
+               (self.depth, self.max_depth, self.queued, self.sent, self.dropped, self.failed, self.expired,
+                self.skipped, self.deduplicated, self.build_errors, self.requeued, self.avg_wait, self.max_wait)
+
+
+class SendQueue:
+    """
+    Queue of outbound messages, sent in priority order by one writer thread.
+
+    Messages other than CONTROL take a token from a token bucket, pacing
+    them to the server limits. A message is queued as the name of a build
+    function and its arguments, and built when sent, so a message queued
+    before a reconnect is sent with the data of the new connection.
+
+    While paused, E.g when not connected, only CONTROL messages are sent.
+    A message failing to send is put back in front and the queue paused,
+    except CONTROL messages which belong to the connection they were made for.
+    Messages older than max_age are dropped. A message the builder returns
+    None for is skipped, and a message the builder fails on is dropped,
+    as building it again would fail again.
+
+    A message may be put with a dedup key identifying its content. The keys
+    are not the message counters, those never repeat, so a repeated send is
+    one with the dedup key of a message queued within dedup_window seconds.
+    """
+    def __init__(self, sender, builder, rate=2.0, burst=5, maxsize=500, max_age=300,
+                 path=None, on_result=None, name='ezclib-sender', dedup_window=None):
+        """
+        Initialize the SendQueue, paused.
+
+        :param sender: Callable taking a process name and parameters, E.g RtmpClient.call
+        :type sender: callable
+        :param builder: Callable taking a build name and arguments, returning a (process name, parameters)
+                        tuple, or None to skip the message.
+        :type builder: callable
+        :param rate: Messages per second.
+        :type rate: int | float
+        :param burst: Max messages sent at once after being idle.
+        :type burst: int
+        :param maxsize: Max queued messages, further messages are dropped. CONTROL messages are never dropped.
+        :type maxsize: int
+        :param max_age: Seconds a message may wait before it is dropped, None to keep messages until sent.
+        :type max_age: int | float | None
+        :param path: Keep the pending messages in this file while paused, and load them from it.
+        :type path: str | None
+        :param on_result: Callable taking the build name, arguments and error of a message, called when
+                          the message was sent (error None), expired or failed to build.
+        :type on_result: callable | None
+        :param name: The writer thread name.
+        :type name: str
+        :param dedup_window: Seconds a dedup key is remembered, None to not deduplicate.
+        :type dedup_window: int | float | None
+        """
+        self.sender = sender
+        self.builder = builder
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.path = path
+        self.on_result = on_result
+        self.name = name
+        self.dedup_window = dedup_window
+        self.stats = SendQueueStats()
+
+        self._bucket = TokenBucket(rate, burst)
+        self._heap = []
+        self._counter = itertools.count()
+        self._pending_keys = set()
+        self._dedup_keys = collections.OrderedDict()  # dedup key: time queued, oldest first.
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._paused = True
+
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def is_running(self):
+        """
+        Is the writer thread running.
+
+        :return: True if running.
+        :rtype: bool
+        """
+        return self._running
+
+    @property
+    def pending_keys(self):
+        """
+        The keys of the queued messages.
+
+        :return: A list of keys.
+        :rtype: list
+        """
+        return list(self._pending_keys)
+
+    @property
+    def is_paused(self):
+        """
+        Are only CONTROL messages being sent.
+
+        :return: True if paused.
+        :rtype: bool
+        """
+        return self._paused
+
+    def put(self, priority, build, args=(), key=None, dedup=None):
+        """
+        Queue a message, starting the writer thread if needed.
+
+        :param priority: CONTROL, NORMAL or CHAT.
+        :type priority: int
+        :param build: The name of the build function, passed to the builder with args when sent.
+        :type build: str
+        :param args: The build function arguments.
+        :type args: tuple
+        :param key: A key identifying the message, E.g the message counter, listed in pending_keys.
+        :type key: str | int | None
+        :param dedup: A hashable key identifying the content of the message, E.g the build name and message.
+        :type dedup: tuple | None
+        :return: True if queued, False if dropped or a repeated send.
+        :rtype: bool
+        """
+        with self._cond:
+            if dedup is not None and self._is_repeated(dedup):
+                self.stats.deduplicated += 1
+                log.debug('%s ignored a repeated send: %s' % (self.name, build))
+                return False
+            if priority != CONTROL and len(self._heap) >= self.maxsize:
+                self.stats.dropped += 1
+                log.warning('%s queue full, dropped message' % self.name)
+                return False
+
+            self._push([priority, next(self._counter), time.time(), build, tuple(args), key])
+            self.stats.queued += 1
+            self._cond.notify()
+
+            if self._paused and priority != CONTROL:
+                self._persist()
+            if not self._running:
+                self._start()
+        return True
+
+    def pause(self):
+        """ Send only CONTROL messages, E.g when the connection is lost. """
+        with self._cond:
+            self._paused = True
+            self._persist()
+
+    def resume(self):
+        """ Send all messages again, E.g when the room accepted the connection. """
+        with self._cond:
+            self._paused = False
+            expired = self._expire()
+            self._cond.notify()
+            if self._heap and not self._running:
+                self._start()
+        self._report(expired, 'expired')
+
+    def clear(self):
+        """
+        Remove all queued messages.
+
+        :return: The number of messages removed.
+        :rtype: int
+        """
+        with self._cond:
+            count = len(self._heap)
+            self._heap = []
+            self._pending_keys.clear()
+            self.stats.depth = 0
+            self._persist()
+            return count
+
+    def stop(self, timeout=None):
+        """
+        Stop the writer thread. Queued messages are kept.
+
+        :param timeout: Max seconds to wait for the thread.
+        :type timeout: int | float | None
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            self._persist()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _is_repeated(self, dedup):
+        """ Check a dedup key, remembering it if new. Must hold the condition. """
+        if self.dedup_window is None:
+            return False
+        now = time.time()
+        oldest = now - self.dedup_window
+        while self._dedup_keys:
+            first = next(iter(self._dedup_keys))
+            if self._dedup_keys[first] >= oldest:
+                break
+            del self._dedup_keys[first]
+        if dedup in self._dedup_keys:
+            return True
+        self._dedup_keys[dedup] = now
+        return False
+
+    def _push(self, item):
+        """ Add an item to the heap. Must hold the condition. """
+        heapq.heappush(self._heap, item)
+        if item[5] is not None:
+            self._pending_keys.add(item[5])
+        depth = len(self._heap)
+        self.stats.depth = depth
+        if depth > self.stats.max_depth:
+            self.stats.max_depth = depth
+
+    def _pop(self):
+        """ Take the first item from the heap. Must hold the condition. """
+        item = heapq.heappop(self._heap)
+        self._pending_keys.discard(item[5])
+        self.stats.depth = len(self._heap)
+        return item
+
+    def _expire(self):
+        """ Drop the messages older than max_age, returning them. Must hold the condition. """
+        if self.max_age is None:
+            return []
+        oldest = time.time() - self.max_age
+        expired = [item for item in self._heap if item[2] < oldest]
+        if expired:
+            self._heap = [item for item in self._heap if item[2] >= oldest]
+            heapq.heapify(self._heap)
+            for item in expired:
+                self._pending_keys.discard(item[5])
+            self.stats.expired += len(expired)
+            self.stats.depth = len(self._heap)
+            log.info('%s expired %s messages' % (self.name, len(expired)))
+        return expired
+
+    def _report(self, items, error=None):
+        """ Pass the results of messages to on_result. Must not hold the condition. """
+        if self.on_result is None:
+            return
+        for item in items:
+            try:
+                self.on_result(item[3], item[4], error)
+            except Exception as e:
+                log.error('error in %s result callback: %s' % (self.name, e), exc_info=True)
+
+    def _start(self):
+        """ Start the writer thread. Must hold the condition. """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next(self):
+        """
+        Wait for the next message that may be sent.
+
+        :return: The message, or None when stopped, and a list of the messages expired while waiting.
+        :rtype: tuple
+        """
+        expired = []
+        with self._cond:
+            while self._running:
+                if not self._heap or (self._paused and self._heap[0][0] != CONTROL):
+                    if expired:
+                        return None, expired
+                    self._cond.wait()
+                    continue
+                item = self._heap[0]
+                if self.max_age is not None and item[2] < time.time() - self.max_age:
+                    expired.append(self._pop())
+                    self.stats.expired += 1
+                    continue
+                if item[0] != CONTROL:
+                    delay = self._bucket.delay()
+                    if delay > 0:
+                        # a CONTROL message queued while waiting is sent first.
+                        self._cond.wait(delay)
+                        continue
+                    self._bucket.take()
+                return self._pop(), expired
+            return None, expired
+
+    def _requeue(self, item):
+        """ Put a message that failed to send back in front, and pause. """
+        with self._cond:
+            self._push(item)
+            self.stats.requeued += 1
+            self._paused = True
+            self._persist()
+
+    def _run(self):
+        """ The writer thread loop. """
+        while True:
+            item, expired = self._next()
+            self._report(expired, 'expired')
+            if item is None:
+                if not self._running:
+                    return
+                continue
+
+            priority, _, queued, build, args, key = item
+            try:
+                message = self.builder(build, *args)
+            except Exception as e:
+                with self._cond:
+                    self.stats.build_errors += 1
+                    if not self._heap:
+                        self._persist()
+                log.error('%s failed to build %s: %s' % (self.name, build, e), exc_info=True)
+                self._report([item], 'build failed')
+                continue
+            if message is None:
+                self.stats.skipped += 1
+                continue
+
+            try:
+                self.sender(*message)
+            except Exception as e:
+                self.stats.failed += 1
+                log.error('%s failed to send: %s' % (self.name, e), exc_info=True)
+                if priority != CONTROL:
+                    self._requeue(item)
+                continue
+
+            wait = time.time() - queued
+            with self._cond:
+                self.stats.sent += 1
+                self.stats.total_wait += wait
+                if wait > self.stats.max_wait:
+                    self.stats.max_wait = wait
+                if not self._heap:
+                    self._persist()
+            self._report([item])
+
+    def _persist(self):
+        """ Replace the queue file with the pending messages. Must hold the condition. """
+        if self.path is None:
+            return
+        items = [item for item in self._heap if item[0] != CONTROL]
+        try:
+            if not items:
+                if os.path.isfile(self.path):
+                    os.remove(self.path)
+                return
+            tmp_file = '%s.tmp' % self.path
+            with open(tmp_file, 'w') as f:
+                json.dump(sorted(items), f)
+            if os.name == 'nt' and os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(tmp_file, self.path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            log.warning('%s could not write queue file: %s' % (self.name, e))
+
+    def _load(self):
+        """ Queue the messages from the queue file. """
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                items = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning('%s could not read queue file: %s' % (self.name, e))
+            return
+        with self._cond:
+            for priority, _, queued, build, args, key in items:
+                self._push([priority, next(self._counter), queued, build, tuple(args), key])
+            expired = self._expire()
+        self._report(expired, 'expired')
+
+
+class Broadcast:
+    """
+    Tracks the delivery of one message to many recipients.
+
+    The progress is updated by the writer thread. Use wait() to block
+    until done, or on_progress to be called after each recipient.
+    """
+    def __init__(self, broadcast_id, msg, recipients, on_progress=None):
+        """
+        Initialize the Broadcast.
+
+        :param broadcast_id: The broadcast id.
+        :type broadcast_id: int
+        :param msg: The message.
+        :type msg: str
+        :param recipients: The recipient nicks.
+        :type recipients: list
+        :param on_progress: Callable taking the Broadcast, called after each recipient is done.
+        :type on_progress: callable | None
+        """
+        self.id = broadcast_id
+        self.msg = msg
+        self.recipients = list(recipients)
+        self.on_progress = on_progress
+        self.sent = []
+        self.failed = {}
+        self.started = time.time()
+        self.finished = None
+
+        self._pending = set(self.recipients)
+        self._encoded = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if not self._pending:
+            self._finish()
+
+    @property
+    def progress(self):
+        """
+        The share of recipients done, sent to or failed.
+
+        :return: A float from 0.0 to 1.0
+        :rtype: float
+        """
+        if not self.recipients:
+            return 1.0
+        return float(len(self.sent) + len(self.failed)) / len(self.recipients)
+
+    @property
+    def is_done(self):
+        """
+        Are all recipients done.
+
+        :return: True if done.
+        :rtype: bool
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for all recipients to be done.
+
+        :param timeout: Max seconds to wait.
+        :type timeout: int | float | None
+        :return: True if done.
+        :rtype: bool
+        """
+        return self._done.wait(timeout)
+
+    def encoded(self, key, encode):
+        """
+        The encoded parts shared by all recipients, encoded once per key.
+
+        :param key: The data the encoded parts depend on, E.g the connection details.
+        :type key: tuple
+        :param encode: Callable returning the encoded parts.
+        :type encode: callable
+        :return: The encoded parts.
+        """
+        encoded = self._encoded
+        if encoded is None or encoded[0] != key:
+            encoded = (key, encode())
+            self._encoded = encoded
+        return encoded[1]
+
+    def mark_sent(self, nick):
+        """ Mark a recipient as sent to. """
+        self._done_with(nick, self.sent.append, nick)
+
+    def mark_failed(self, nick, reason):
+        """ Mark a recipient as failed, with the reason. """
+        self._done_with(nick, self.failed.__setitem__, nick, reason)
+
+    def _done_with(self, nick, record, *args):
+        with self._lock:
+            if nick not in self._pending:
+                return
+            self._pending.discard(nick)
+            record(*args)
+            if not self._pending:
+                self._finish()
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def _finish(self):
+        self.finished = time.time()
+        self._done.set()
+
+    def __repr__(self):
+        return '<Broadcast %s sent=%s failed=%s pending=%s>' % \
+               (self.id, len(self.sent), len(self.failed), len(self._pending))
@@ -1,9 +1,18 @@
+import json
 import logging
+import os
+import threading
+import time
+
 import util.web
+from util.file_lock import FileLock
 
 
 log = logging.getLogger(__name__)
 
+# retry policy for the login page and login post requests.
+RETRY_POLICY = util.web.RetryPolicy(attempts=3, timeout=10, backoff=0.5, max_backoff=4, deadline=25, hedge_after=4)
+
 
 class Account:
     """
@@ -29,7 +38,7 @@ class Account:
         self._password = u'' + password
         self._proxy = proxy
 
-        response = util.web.get(url=self._login_page_url, proxy=self._proxy)
+        response = util.web.get(url=self._login_page_url, proxy=self._proxy, retry=RETRY_POLICY)
         if response.error is None:
             self._html_source = response.content
             self._set_n_key()
@@ -73,7 +82,8 @@ class Account:
 
             log.debug('login form_data: %s' % form_data)
             response = util.web.post(url=self._login_post_url, post_data=form_data,
-                                     referer=self._login_page_url, follow_redirect=True, proxy=self._proxy)
+                                     referer=self._login_page_url, follow_redirect=True, proxy=self._proxy,
+                                     retry=RETRY_POLICY)
             log.debug('login response: %s' % response)
             if response.error is None:
                 self._html_source = response.content
@@ -88,3 +98,219 @@ class Account:
         pattern = 'n = \''
         if pattern in self._html_source:
             self._n_key = self._html_source.split(pattern)[1].split('\';')[0]
+
+
+class LoginSession:
+    """ Class representing the result of a login, shared between connections. """
+    def __init__(self, email, n_key, cookies, login_time=None):
+        """
+        Initialize the LoginSession.
+
+        :param email: The account email.
+        :type email: str
+        :param n_key: The n_key MD5 hash key.
+        :type n_key: str
+        :param cookies: The session cookies, as exported by util.web.get_cookies
+        :type cookies: list
+        :param login_time: Unix time stamp of the login.
+        :type login_time: int | float
+        """
+        self.email = email
+        self.n_key = n_key
+        self.cookies = cookies
+        self.login_time = login_time or time.time()
+
+    @property
+    def is_expired(self):
+        """
+        Check if any of the session cookies has expired.
+
+        :return: True if expired, else False.
+        :rtype: bool
+        """
+        timestamp = int(time.time())
+        for cookie in self.cookies:
+            if cookie['expires'] is not None and timestamp > cookie['expires']:
+                return True
+        return False
+
+    def to_dict(self):
+        """
+        The session as a dictionary, for the cache file.
+
+        :return: The session data.
+        :rtype: dict
+        """
+        return {
+            'n_key': self.n_key,
+            'cookies': self.cookies,
+            'login_time': self.login_time
+        }
+
+
+class LoginBroker:
+    """
+    Performs the login once per account and hands out the
+    resulting n_key and cookies to every connection asking for it.
+
+    If a cache file is provided, the login is also shared between
+    processes, coordinated through a lock file next to the cache file.
+    """
+    _cookie_domain = 'ezcapechat.com'
+
+    def __init__(self, cache_file=None):
+        """
+        Initialize the LoginBroker.
+
+        :param cache_file: Path to a file used to share logins between processes.
+        :type cache_file: str | None
+        """
+        self._cache_file = cache_file
+        self._sessions = {}
+        self._page_n_keys = {}      # email: n_key of the login page, after a failed login.
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.login_count = 0
+
+    def _account_lock(self, email):
+        """ Get the thread lock for an account. """
+        with self._locks_lock:
+            if email not in self._locks:
+                self._locks[email] = threading.Lock()
+            return self._locks[email]
+
+    def _read_cache(self):
+        """ Read the sessions from the cache file. """
+        if os.path.isfile(self._cache_file):
+            try:
+                with open(self._cache_file, 'r') as cf:
+                    return json.load(cf)
+            except (IOError, ValueError) as e:
+                log.warning('could not read login cache file: %s' % e)
+        return {}
+
+    def _write_cache(self, cache):
+        """ Replace the cache file with the sessions in cache. """
+        tmp_file = '%s.tmp' % self._cache_file
+        with open(tmp_file, 'w') as cf:
+            json.dump(cache, cf)
+        if os.name == 'nt' and os.path.isfile(self._cache_file):
+            os.remove(self._cache_file)
+        os.rename(tmp_file, self._cache_file)
+
+    def _login(self, email, password, proxy):
+        """ Login with an Account and create a LoginSession from it. """
+        account = Account(email, password, proxy=proxy)
+        if not account.is_logged_in:
+            account.login()
+            self.login_count += 1
+        if account.is_logged_in:
+            log.info('logged in: %s' % email)
+            self._page_n_keys.pop(email, None)
+            return LoginSession(email, account.n_key, util.web.get_cookies(self._cookie_domain))
+        log.warning('login failed: %s' % email)
+        self._page_n_keys[email] = account.n_key
+        return None
+
+    def _get_session(self, email, password, proxy, stale_n_key):
+        """
+        Get a valid session, performing a login if needed.
+        Must be called while holding the account lock.
+        """
+        session = self._sessions.get(email)
+        if session is not None and not session.is_expired and session.n_key != stale_n_key:
+            return session
+
+        cache = None
+        if self._cache_file is not None:
+            cache = self._read_cache()
+            if email in cache:
+                session = LoginSession(email, **cache[email])
+                if not session.is_expired and session.n_key != stale_n_key:
+                    log.debug('using login session from cache file for: %s' % email)
+                    util.web.set_cookies(session.cookies)
+                    self._sessions[email] = session
+                    return session
+
+        session = self._login(email, password, proxy)
+        if session is None:
+            self._sessions.pop(email, None)
+        else:
+            self._sessions[email] = session
+
+        if cache is not None:
+            if session is None:
+                cache.pop(email, None)
+            else:
+                cache[email] = session.to_dict()
+            self._write_cache(cache)
+
+        return session
+
+    def _acquire(self, email, password, proxy, stale_n_key):
+        """ Get a session while holding the account and file locks. """
+        with self._account_lock(email):
+            if self._cache_file is None:
+                return self._get_session(email, password, proxy, stale_n_key)
+            with FileLock('%s.lock' % self._cache_file):
+                return self._get_session(email, password, proxy, stale_n_key)
+
+    def acquire(self, email, password, proxy=None):
+        """
+        Get the login session for an account, logging in only
+        if no valid session exists for it yet.
+
+        :param email: Login email.
+        :type email: str
+        :param password: Login password.
+        :type password: str
+        :param proxy: Use a proxy for the login requests.
+        :type proxy: str
+        :return: The login session, or None if the login failed.
+        :rtype: LoginSession | None
+        """
+        return self._acquire(email, password, proxy, None)
+
+    def refresh(self, email, password, stale_n_key, proxy=None):
+        """
+        Refresh an expired login session.
+
+        Several connections may report the same stale session,
+        only the first one to do so will cause a new login. The
+        others will receive the session created by the first one.
+
+        :param email: Login email.
+        :type email: str
+        :param password: Login password.
+        :type password: str
+        :param stale_n_key: The n_key of the expired session.
+        :type stale_n_key: str
+        :param proxy: Use a proxy for the login requests.
+        :type proxy: str
+        :return: The login session, or None if the login failed.
+        :rtype: LoginSession | None
+        """
+        return self._acquire(email, password, proxy, stale_n_key)
+
+    def page_n_key(self, email):
+        """
+        The n_key of the login page, from the last failed login of an account.
+
+        A connection can still use it to join as a guest.
+
+        :param email: Login email.
+        :type email: str
+        :return: The n_key, or None if the last login did not fail.
+        :rtype: str | None
+        """
+        return self._page_n_keys.get(email)
+
+    def invalidate(self, email):
+        """
+        Forget the login session of an account in this process.
+
+        :param email: Login email.
+        :type email: str
+        """
+        with self._account_lock(email):
+            self._sessions.pop(email, None)
@@ -0,0 +1,261 @@
+""" Worker pool running event handlers off the socket reader thread. """
+import collections
+import logging
+import threading
+import timeit
+
+log = logging.getLogger(__name__)
+
+# backpressure policies, used when a room queue is full.
+BLOCK = 'block'                 # the reader waits for room in the queue.
+DROP_OLDEST = 'drop_oldest'     # the oldest unprotected event is dropped.
+COALESCE = 'coalesce'           # coalescable events replace a queued event of the same key, else block.
+
+POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+
+class QueueStats:
+    """ Class holding the metrics of a room queue. """
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def avg_wait(self):
+        """
+        The average time an event waited in the queue.
+
+        :return: The average wait in seconds.
+        :rtype: float
+        """
+        if self.processed == 0:
+            return 0.0
+        return self.total_wait / self.processed
+
+    def __repr__(self):
+        return '<QueueStats depth=%s max_depth=%s enqueued=%s processed=%s dropped=%s ' \
+               'coalesced=%s blocked=%s avg_wait=%.6fs max_wait=%.6fs>' % \
+               (self.depth, self.max_depth, self.enqueued, self.processed, self.dropped,
+                self.coalesced, self.blocked, self.avg_wait, self.max_wait)
+
+
+class RoomQueue:
+    """
+    A bounded event queue for one room.
+
+    The events of a room are handled one at a time, in the order they were put,
+    while the events of other rooms are handled concurrently by the pool.
+    """
+    def __init__(self, pool, name, maxsize, policy, protected=(), coalescable=()):
+        """
+        Initialize the RoomQueue. Use WorkerPool.queue() to create one.
+
+        :param pool: The worker pool handling the events.
+        :type pool: WorkerPool
+        :param name: The room name.
+        :type name: str
+        :param maxsize: The max number of queued events.
+        :type maxsize: int
+        :param policy: The backpressure policy.
+        :type policy: str
+        :param protected: Event keys never dropped by DROP_OLDEST.
+        :type protected: tuple | set
+        :param coalescable: Event keys where only the latest queued event matters.
+        :type coalescable: tuple | set
+        """
+        if policy not in POLICIES:
+            raise ValueError('unknown backpressure policy: %s' % policy)
+
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.protected = frozenset(protected)
+        self.coalescable = frozenset(coalescable)
+        self.stats = QueueStats()
+
+        self._pool = pool
+        self._items = collections.deque()
+        self._latest = {}
+        self._scheduled = False
+        self._not_full = threading.Condition(pool.lock)
+
+    def put(self, key, func, *args):
+        """
+        Queue an event handler call.
+
+        :param key: The event key, E.g the command name.
+        :type key: str | int
+        :param func: The function handling the event.
+        :type func: callable
+        :param args: The arguments for func.
+        """
+        with self._pool.lock:
+            # coalesce only under backpressure, else the events keep their order.
+            if self.policy == COALESCE and key in self._latest and len(self._items) >= self.maxsize:
+                item = self._latest[key]
+                item[1] = func
+                item[2] = args
+                self.stats.coalesced += 1
+                return
+
+            if len(self._items) >= self.maxsize:
+                if self.policy != DROP_OLDEST or not self._drop_oldest():
+                    self.stats.blocked += 1
+                    while len(self._items) >= self.maxsize:
+                        self._not_full.wait()
+
+            item = [key, func, args, timeit.default_timer()]
+            self._items.append(item)
+            if key in self.coalescable:
+                self._latest[key] = item
+
+            depth = len(self._items)
+            self.stats.enqueued += 1
+            self.stats.depth = depth
+            if depth > self.stats.max_depth:
+                self.stats.max_depth = depth
+
+            if not self._scheduled:
+                self._scheduled = True
+                self._pool.schedule(self)
+
+    def _drop_oldest(self):
+        """ Drop the oldest unprotected event. Must hold the pool lock. """
+        for item in self._items:
+            if item[0] not in self.protected:
+                self._items.remove(item)
+                if self._latest.get(item[0]) is item:
+                    del self._latest[item[0]]
+                self.stats.dropped += 1
+                log.debug('%s queue full, dropped: %s' % (self.name, item[0]))
+                return True
+        return False
+
+    def _pop(self):
+        """ Take the next event. Must hold the pool lock. """
+        item = self._items.popleft()
+        if self._latest.get(item[0]) is item:
+            del self._latest[item[0]]
+        self.stats.depth = len(self._items)
+        self._not_full.notify()
+        return item
+
+    def _run_next(self):
+        """ Run the next event, called by a worker. """
+        with self._pool.lock:
+            key, func, args, queued = self._pop()
+
+        wait = timeit.default_timer() - queued
+        try:
+            func(*args)
+        except Exception as e:
+            log.error('error handling %s for %s: %s' % (key, self.name, e), exc_info=True)
+
+        with self._pool.lock:
+            self.stats.processed += 1
+            self.stats.total_wait += wait
+            if wait > self.stats.max_wait:
+                self.stats.max_wait = wait
+            if self._items:
+                self._pool.schedule(self)
+            else:
+                self._scheduled = False
+
+
+class WorkerPool:
+    """
+    A pool of worker threads handling the events of one or more room queues.
+    """
+    def __init__(self, workers=4):
+        """
+        Initialize the WorkerPool.
+
+        :param workers: The number of worker threads.
+        :type workers: int
+        """
+        self.workers = workers
+        self.lock = threading.Lock()
+        self._ready = collections.deque()
+        self._has_ready = threading.Condition(self.lock)
+        self._threads = []
+        self._running = False
+
+    @property
+    def is_running(self):
+        """
+        Are the worker threads running.
+
+        :return: True if running.
+        :rtype: bool
+        """
+        return self._running
+
+    def queue(self, name, maxsize=1000, policy=BLOCK, protected=(), coalescable=()):
+        """
+        Create a room queue handled by this pool, starting the pool if needed.
+
+        :param name: The room name.
+        :type name: str
+        :param maxsize: The max number of queued events.
+        :type maxsize: int
+        :param policy: The backpressure policy, BLOCK, DROP_OLDEST or COALESCE.
+        :type policy: str
+        :param protected: Event keys never dropped by DROP_OLDEST.
+        :type protected: tuple | set
+        :param coalescable: Event keys where only the latest queued event matters.
+        :type coalescable: tuple | set
+        :return: The room queue.
+        :rtype: RoomQueue
+        """
+        if not self._running:
+            self.start()
+        return RoomQueue(self, name, maxsize, policy, protected, coalescable)
+
+    def schedule(self, room_queue):
+        """ Mark a room queue as ready for a worker. Must hold the lock. """
+        self._ready.append(room_queue)
+        self._has_ready.notify()
+
+    def start(self):
+        """ Start the worker threads. """
+        with self.lock:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='ezclib-worker-%s' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker threads, once the ready queues are handled.
+
+        :param timeout: Max seconds to wait for each thread.
+        :type timeout: int | float | None
+        """
+        with self.lock:
+            self._running = False
+            self._has_ready.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _work(self):
+        """ The worker thread loop. """
+        while True:
+            with self.lock:
+                while not self._ready and self._running:
+                    self._has_ready.wait()
+                if not self._ready:
+                    return
+                room_queue = self._ready.popleft()
+            room_queue._run_next()
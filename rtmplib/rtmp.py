@@ -24,11 +24,19 @@ class FileDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
     Provides a wrapper for a file object that enables reading and writing of raw
     data types for the file.
     """
-    def __init__(self, fileobject):
+    def __init__(self, fileobject, pending=''):
         self.fileobject = fileobject
+        # bytes already received on the socket, E.g during proxy negotiation.
+        self._pending = pending
         pyamf.util.pure.DataTypeMixIn.__init__(self)
 
     def read(self, length):
+        if self._pending:
+            data = self._pending[:length]
+            self._pending = self._pending[length:]
+            if len(data) < length:
+                data += self.fileobject.read(length - len(data))
+            return data
         return self.fileobject.read(length)
 
     def write(self, data):
@@ -53,6 +61,10 @@ class RtmpClient:
         self.page_url = kwargs.get('page_url', u'')
         self.swf_url = kwargs.get('swf_url', u'')
         self.proxy = kwargs.get('proxy', '')
+        self.proxies = kwargs.get('proxies', [])
+        self.race_stagger = kwargs.get('race_stagger', 0.3)
+        self.on_proxy_result = kwargs.get('on_proxy_result', None)
+        self.on_handshake = kwargs.get('on_handshake', None)
         self.is_win = kwargs.get('is_win', False)
         self.handle = kwargs.get('handle', True)
         self.flash_version = kwargs.get('flash_version', 'WIN 26,0,0,137')
@@ -238,32 +250,64 @@ class RtmpClient:
         :param connect_params: A list or dict containing application specific connect parameters
         :type connect_params: list | dict
         """
-        if self.proxy:
-            parts = self.proxy.split(':')
-            ip = parts[0]
-            port = int(parts[1])
-
-            ps = socks.socksocket()
-            ps.set_proxy(socks.HTTP, addr=ip, port=port)
-            self.socket = ps
+        if self.proxies:
+            candidates = [self._parse_proxy(proxy) for proxy in self.proxies]
+
+            def _on_result(candidate, error, latency):
+                if self.on_proxy_result is not None:
+                    self.on_proxy_result(self.proxies[candidates.index(candidate)], error, latency)
+
+            self.socket, candidate = socks.race_connect((self.ip, self.port), candidates,
+                                                        stagger=self.race_stagger, on_result=_on_result)
+            self.proxy = self.proxies[candidates.index(candidate)]
+            log.info('connected through: %s' % self.proxy)
         else:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.proxy:
+                ps = socks.socksocket()
+                ps.set_proxy(*self._parse_proxy(self.proxy))
+                self.socket = ps
+            else:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+            self.socket.connect((self.ip, self.port))
 
-        self.socket.connect((self.ip, self.port))
+        pending = ''
+        if isinstance(self.socket, socks.socksocket):
+            pending = self.socket.pending_data()
         self.file = self.socket.makefile()
-        self.stream = FileDataTypeMixIn(self.file)
+        self.stream = FileDataTypeMixIn(self.file, pending)
 
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         if self.is_win:
             self.socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 10000, 3000))
 
         self.handshake()
+        if self.on_handshake is not None:
+            self.on_handshake()
 
         self.reader = reader.RtmpReader(self.stream)
         self.writer = writer.RtmpWriter(self.stream)
 
         self._connect_rtmp(connect_params)
 
+    @staticmethod
+    def _parse_proxy(proxy):
+        """ Parse a proxy string in to socksocket.set_proxy arguments.
+
+        :param proxy: The proxy as scheme://host:port or host:port (HTTP), or None for no proxy.
+        :type proxy: str | None
+        :return: A tuple of proxy type, address and port, or None for no proxy.
+        :rtype: tuple | None
+        """
+        if not proxy:
+            return None
+        proxy_type = socks.HTTP
+        if '://' in proxy:
+            scheme, proxy = proxy.split('://', 1)
+            proxy_type = socks.PROXY_TYPES[scheme.upper()]
+        ip, port = proxy.rsplit(':', 1)
+        return proxy_type, ip, int(port)
+
     def shutdown(self):
         """ Closes the socket connection. """
         try:
@@ -56,10 +56,20 @@ __version__ = "1.5.6"
 
 import socket
 import struct
+import threading
+import time
 from errno import EOPNOTSUPP, EINVAL, EAGAIN
 from io import BytesIO
 from os import SEEK_CUR
-from collections import Callable
+try:
+    from collections.abc import Callable
+except ImportError:
+    from collections import Callable
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 PROXY_TYPE_SOCKS4 = SOCKS4 = 1
 PROXY_TYPE_SOCKS5 = SOCKS5 = 2
@@ -202,6 +212,164 @@ def create_connection(dest_pair, proxy_type=None, proxy_addr=None,
     return sock
 
 
+def race_connect(dest_pair, proxies, stagger=0.3, timeout=10, on_result=None):
+    """race_connect(dest_pair, proxies[, stagger[, timeout[, on_result]]]) -> (socket, proxy)
+
+    Connects to dest_pair through several candidate proxies, in the
+    style of Happy Eyeballs (RFC6555). The candidates are started in
+    order, each one stagger seconds after the previous, or at once if
+    all started candidates have failed. The first candidate to finish
+    the proxy negotiation wins, the other connections are closed.
+
+    dest_pair - 2-tuple of (IP/hostname, port).
+    proxies - List of candidates, each a tuple of socksocket.set_proxy()
+    arguments (proxy_type, addr, port[, rdns[, username, password]]),
+    or None for a direct connection.
+    stagger - Seconds between the start of each candidate.
+    timeout - Connect timeout in seconds, for each candidate, so a proxy
+    that never answers can not hang the race. None for no timeout.
+    on_result - Optional callable(proxy, error, latency) called for each
+    candidate failing before the race is won, and for the winner with
+    error None. Candidates still negotiating when the race is won are
+    not reported.
+
+    Returns the connected blocking socket and the winning candidate.
+    Raises ProxyConnectionError if all candidates failed.
+    """
+    if not proxies:
+        raise GeneralProxyError("No proxy candidates to connect through")
+
+    results = queue.Queue()
+    sockets = [None] * len(proxies)
+
+    def _attempt(index, proxy):
+        start = time.time()
+        sock = socksocket()
+        sockets[index] = sock
+        if isinstance(timeout, (int, float)):
+            sock.settimeout(timeout)
+        try:
+            if proxy is not None:
+                sock.set_proxy(*proxy)
+            sock.connect(dest_pair)
+        except (socket.error, ProxyError) as error:
+            sock.close()
+            results.put((index, None, error, time.time() - start))
+        else:
+            results.put((index, sock, None, time.time() - start))
+
+    started = 0
+    finished = 0
+    next_start = time.time()
+    winner = None
+    errors = []
+    while finished < len(proxies):
+        if started < len(proxies) and (started == finished or time.time() >= next_start):
+            t = threading.Thread(target=_attempt, args=(started, proxies[started]))
+            t.daemon = True
+            t.start()
+            started += 1
+            next_start = time.time() + stagger
+
+        wait = None
+        if started < len(proxies):
+            wait = max(next_start - time.time(), 0)
+        try:
+            index, sock, error, latency = results.get(timeout=wait)
+        except queue.Empty:
+            continue
+
+        finished += 1
+        if on_result is not None:
+            on_result(proxies[index], error, latency)
+        if sock is not None:
+            winner = index, sock
+            break
+        errors.append("{0}: {1}".format(proxies[index], error))
+
+    if winner is None:
+        raise ProxyConnectionError("All proxy candidates failed: " + "; ".join(errors))
+
+    def _close_losers(pending):
+        # wait for the candidates still negotiating, and close them.
+        # a candidate stuck without a timeout is left, its socket is already shut down.
+        for _ in range(pending):
+            try:
+                _, loser, _, _ = results.get(timeout=(timeout or 10) * 2)
+            except queue.Empty:
+                return
+            if loser is not None:
+                loser.close()
+
+    pending = started - finished
+    if pending:
+        for i, loser in enumerate(sockets):
+            if loser is not None and i != winner[0]:
+                try:
+                    loser.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        t = threading.Thread(target=_close_losers, args=(pending,))
+        t.daemon = True
+        t.start()
+
+    index, sock = winner
+    sock.settimeout(None)
+    return sock, proxies[index]
+
+
+class _RecvBuffer(object):
+    """
+    A single receive buffer used during proxy negotiation.
+
+    Replies are received straight in to the buffer with recv_into() and
+    parsed in place. Any bytes received after the end of the negotiation
+    are kept, and handed over to the reader of the tunneled stream.
+    """
+    def __init__(self, sock, size=512):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def _recv(self):
+        """Receive once in to the free end of the buffer."""
+        if self.end == len(self.buf):
+            if self.start > 0:
+                # compact, the parsed bytes are no longer needed.
+                self.buf[:self.end - self.start] = self.buf[self.start:self.end]
+                self.end -= self.start
+                self.start = 0
+            else:
+                self.buf.extend(bytearray(len(self.buf)))
+        count = self.sock.recv_into(memoryview(self.buf)[self.end:])
+        if not count:
+            raise GeneralProxyError("Connection closed unexpectedly")
+        self.end += count
+
+    def read(self, count):
+        """Read EXACTLY count bytes, receiving more if needed."""
+        while self.end - self.start < count:
+            self._recv()
+        data = bytes(self.buf[self.start:self.start + count])
+        self.start += count
+        return data
+
+    def read_until(self, delimiter, limit=65536):
+        """Read up to and including delimiter, receiving more if needed."""
+        while True:
+            index = self.buf.find(delimiter, self.start, self.end)
+            if index != -1:
+                return self.read(index + len(delimiter) - self.start)
+            if self.end - self.start > limit:
+                raise GeneralProxyError("Proxy server sent too much data")
+            self._recv()
+
+    def leftover(self):
+        """The received bytes not consumed by the negotiation."""
+        return bytes(self.buf[self.start:self.end])
+
+
 class _BaseSocket(socket.socket):
     """Allows Python 2's "delegated" methods such as send() to be overridden
     """
@@ -255,18 +423,37 @@ class socksocket(_BaseSocket):
             self.proxy = (None, None, None, None, None, None)
         self.proxy_sockname = None
         self.proxy_peername = None
+        self._pending = b""
 
     def _readall(self, file, count):
         """
         Receive EXACTLY the number of bytes requested from the file object.
         Blocks until the required number of bytes have been received.
         """
-        data = b""
-        while len(data) < count:
-            d = file.read(count - len(data))
+        if isinstance(file, _RecvBuffer):
+            return file.read(count)
+
+        data = file.read(count)
+        if len(data) == count:
+            return data
+        chunks = [data]
+        received = len(data)
+        while received < count:
+            d = file.read(count - received)
             if not d:
                 raise GeneralProxyError("Connection closed unexpectedly")
-            data += d
+            chunks.append(d)
+            received += len(d)
+        return b"".join(chunks)
+
+    def pending_data(self):
+        """
+        Returns, and clears, the bytes received from the destination
+        during the proxy negotiation. These belong to the tunneled stream,
+        and must be handed to its reader before reading from the socket.
+        """
+        data = self._pending
+        self._pending = b""
         return data
 
     def set_proxy(self, proxy_type=None, addr=None, port=None, rdns=True, username=None, password=None):
@@ -374,8 +561,13 @@ class socksocket(_BaseSocket):
 
         return (buf.read(), (fromhost, fromport))
 
-    def recv(self, *pos, **kw):
-        bytes, _ = self.recvfrom(*pos, **kw)
+    def recv(self, bufsize, flags=0):
+        if self._pending:
+            # at most bufsize bytes, the rest is returned by the next calls.
+            data = self._pending[:bufsize]
+            self._pending = self._pending[bufsize:]
+            return data
+        bytes, _ = self.recvfrom(bufsize, flags)
         return bytes
 
     def close(self):
@@ -423,80 +615,77 @@ class socksocket(_BaseSocket):
         """
         proxy_type, addr, port, rdns, username, password = self.proxy
 
-        writer = conn.makefile("wb")
-        reader = conn.makefile("rb", 0)  # buffering=0 renamed in Python 3
-        try:
-            # First we'll send the authentication packages we support.
-            if username and password:
-                # The username/password details were supplied to the
-                # set_proxy method so we support the USERNAME/PASSWORD
-                # authentication (in addition to the standard none).
-                writer.write(b"\x05\x02\x00\x02")
-            else:
-                # No username/password were entered, therefore we
-                # only support connections with no authentication.
-                writer.write(b"\x05\x01\x00")
-
-            # We'll receive the server's response to determine which
-            # method was selected
-            writer.flush()
-            chosen_auth = self._readall(reader, 2)
-
-            if chosen_auth[0:1] != b"\x05":
-                # Note: string[i:i+1] is used because indexing of a bytestring
-                # via bytestring[i] yields an integer in Python 3
+        reader = _RecvBuffer(conn)
+
+        # First we'll send the authentication packages we support.
+        if username and password:
+            # The username/password details were supplied to the
+            # set_proxy method so we support the USERNAME/PASSWORD
+            # authentication (in addition to the standard none).
+            conn.sendall(b"\x05\x02\x00\x02")
+        else:
+            # No username/password were entered, therefore we
+            # only support connections with no authentication.
+            conn.sendall(b"\x05\x01\x00")
+
+        # We'll receive the server's response to determine which
+        # method was selected
+        chosen_auth = reader.read(2)
+
+        if chosen_auth[0:1] != b"\x05":
+            # Note: string[i:i+1] is used because indexing of a bytestring
+            # via bytestring[i] yields an integer in Python 3
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+        # Check the chosen authentication method
+
+        if chosen_auth[1:2] == b"\x02":
+            # Okay, we need to perform a basic username/password
+            # authentication.
+            conn.sendall(b"\x01" + chr(len(username)).encode()
+                         + username
+                         + chr(len(password)).encode()
+                         + password)
+            auth_status = reader.read(2)
+            if auth_status[0:1] != b"\x01":
+                # Bad response
                 raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+            if auth_status[1:2] != b"\x00":
+                # Authentication failed
+                raise SOCKS5AuthError("SOCKS5 authentication failed")
+
+            # Otherwise, authentication succeeded
 
-            # Check the chosen authentication method
-
-            if chosen_auth[1:2] == b"\x02":
-                # Okay, we need to perform a basic username/password
-                # authentication.
-                writer.write(b"\x01" + chr(len(username)).encode()
-                             + username
-                             + chr(len(password)).encode()
-                             + password)
-                writer.flush()
-                auth_status = self._readall(reader, 2)
-                if auth_status[0:1] != b"\x01":
-                    # Bad response
-                    raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-                if auth_status[1:2] != b"\x00":
-                    # Authentication failed
-                    raise SOCKS5AuthError("SOCKS5 authentication failed")
-
-                # Otherwise, authentication succeeded
-
-            # No authentication is required if 0x00
-            elif chosen_auth[1:2] != b"\x00":
-                # Reaching here is always bad
-                if chosen_auth[1:2] == b"\xFF":
-                    raise SOCKS5AuthError("All offered SOCKS5 authentication methods were rejected")
-                else:
-                    raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-
-            # Now we can request the actual connection
-            writer.write(b"\x05" + cmd + b"\x00")
-            resolved = self._write_SOCKS5_address(dst, writer)
-            writer.flush()
-
-            # Get the response
-            resp = self._readall(reader, 3)
-            if resp[0:1] != b"\x05":
+        # No authentication is required if 0x00
+        elif chosen_auth[1:2] != b"\x00":
+            # Reaching here is always bad
+            if chosen_auth[1:2] == b"\xFF":
+                raise SOCKS5AuthError("All offered SOCKS5 authentication methods were rejected")
+            else:
                 raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
 
-            status = ord(resp[1:2])
-            if status != 0x00:
-                # Connection failed: server returned an error
-                error = SOCKS5_ERRORS.get(status, "Unknown error")
-                raise SOCKS5Error("{0:#04x}: {1}".format(status, error))
+        # Now we can request the actual connection
+        request = BytesIO()
+        request.write(b"\x05" + cmd + b"\x00")
+        resolved = self._write_SOCKS5_address(dst, request)
+        conn.sendall(request.getvalue())
+
+        # Get the response
+        resp = reader.read(3)
+        if resp[0:1] != b"\x05":
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
 
-            # Get the bound address/port
-            bnd = self._read_SOCKS5_address(reader)
-            return (resolved, bnd)
-        finally:
-            reader.close()
-            writer.close()
+        status = ord(resp[1:2])
+        if status != 0x00:
+            # Connection failed: server returned an error
+            error = SOCKS5_ERRORS.get(status, "Unknown error")
+            raise SOCKS5Error("{0:#04x}: {1}".format(status, error))
+
+        # Get the bound address/port
+        bnd = self._read_SOCKS5_address(reader)
+        if conn is self:
+            self._pending = reader.leftover()
+        return (resolved, bnd)
 
     def _write_SOCKS5_address(self, addr, file):
         """
@@ -546,58 +735,53 @@ class socksocket(_BaseSocket):
         """
         proxy_type, addr, port, rdns, username, password = self.proxy
 
-        writer = self.makefile("wb")
-        reader = self.makefile("rb", 0)  # buffering=0 renamed in Python 3
+        # Check if the destination address provided is an IP address
+        remote_resolve = False
         try:
-            # Check if the destination address provided is an IP address
-            remote_resolve = False
-            try:
-                addr_bytes = socket.inet_aton(dest_addr)
-            except socket.error:
-                # It's a DNS name. Check where it should be resolved.
-                if rdns:
-                    addr_bytes = b"\x00\x00\x00\x01"
-                    remote_resolve = True
-                else:
-                    addr_bytes = socket.inet_aton(socket.gethostbyname(dest_addr))
-
-            # Construct the request packet
-            writer.write(struct.pack(">BBH", 0x04, 0x01, dest_port))
-            writer.write(addr_bytes)
-
-            # The username parameter is considered userid for SOCKS4
-            if username:
-                writer.write(username)
-            writer.write(b"\x00")
-
-            # DNS name if remote resolving is required
-            # NOTE: This is actually an extension to the SOCKS4 protocol
-            # called SOCKS4A and may not be supported in all cases.
-            if remote_resolve:
-                writer.write(dest_addr.encode('idna') + b"\x00")
-            writer.flush()
-
-            # Get the response from the server
-            resp = self._readall(reader, 8)
-            if resp[0:1] != b"\x00":
-                # Bad data
-                raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
-
-            status = ord(resp[1:2])
-            if status != 0x5A:
-                # Connection failed: server returned an error
-                error = SOCKS4_ERRORS.get(status, "Unknown error")
-                raise SOCKS4Error("{0:#04x}: {1}".format(status, error))
-
-            # Get the bound address/port
-            self.proxy_sockname = (socket.inet_ntoa(resp[4:]), struct.unpack(">H", resp[2:4])[0])
-            if remote_resolve:
-                self.proxy_peername = socket.inet_ntoa(addr_bytes), dest_port
+            addr_bytes = socket.inet_aton(dest_addr)
+        except socket.error:
+            # It's a DNS name. Check where it should be resolved.
+            if rdns:
+                addr_bytes = b"\x00\x00\x00\x01"
+                remote_resolve = True
             else:
-                self.proxy_peername = dest_addr, dest_port
-        finally:
-            reader.close()
-            writer.close()
+                addr_bytes = socket.inet_aton(socket.gethostbyname(dest_addr))
+
+        # Construct the request packet
+        request = [struct.pack(">BBH", 0x04, 0x01, dest_port), addr_bytes]
+
+        # The username parameter is considered userid for SOCKS4
+        if username:
+            request.append(username)
+        request.append(b"\x00")
+
+        # DNS name if remote resolving is required
+        # NOTE: This is actually an extension to the SOCKS4 protocol
+        # called SOCKS4A and may not be supported in all cases.
+        if remote_resolve:
+            request.append(dest_addr.encode('idna') + b"\x00")
+        self.sendall(b"".join(request))
+
+        # Get the response from the server
+        reader = _RecvBuffer(self)
+        resp = reader.read(8)
+        if resp[0:1] != b"\x00":
+            # Bad data
+            raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
+
+        status = ord(resp[1:2])
+        if status != 0x5A:
+            # Connection failed: server returned an error
+            error = SOCKS4_ERRORS.get(status, "Unknown error")
+            raise SOCKS4Error("{0:#04x}: {1}".format(status, error))
+
+        # Get the bound address/port
+        self.proxy_sockname = (socket.inet_ntoa(resp[4:]), struct.unpack(">H", resp[2:4])[0])
+        if remote_resolve:
+            self.proxy_peername = socket.inet_ntoa(addr_bytes), dest_port
+        else:
+            self.proxy_peername = dest_addr, dest_port
+        self._pending = reader.leftover()
 
     def _negotiate_HTTP(self, dest_addr, dest_port):
         """
@@ -612,13 +796,12 @@ class socksocket(_BaseSocket):
         self.sendall(b"CONNECT " + addr.encode('idna') + b":" + str(dest_port).encode() +
                      b" HTTP/1.1\r\n" + b"Host: " + dest_addr.encode('idna') + b"\r\n\r\n")
 
-        # We just need the first line to check if the connection was successful
-        fobj = self.makefile()
-        status_line = fobj.readline()
-        fobj.close()
-
-        if not status_line:
-            raise GeneralProxyError("Connection closed unexpectedly")
+        # Read the whole response header, the status line tells if the
+        # connection was successful. Anything after the header belongs
+        # to the tunneled stream.
+        reader = _RecvBuffer(self)
+        response = reader.read_until(b"\r\n\r\n")
+        status_line = response[:response.index(b"\r\n")].decode('iso-8859-1')
 
         try:
             proto, status_code, status_msg = status_line.split(" ", 2)
@@ -643,6 +826,7 @@ class socksocket(_BaseSocket):
 
         self.proxy_sockname = (b"0.0.0.0", 0)
         self.proxy_peername = addr, dest_port
+        self._pending = reader.leftover()
 
     _proxy_negotiators = {
                            SOCKS4: _negotiate_SOCKS4,
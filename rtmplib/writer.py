@@ -1,4 +1,6 @@
+import collections
 import logging
+import threading
 
 from pyamf import amf0, amf3
 import pyamf.util.pure
@@ -7,9 +9,49 @@ from . import header, rtmp_type
 
 log = logging.getLogger(__name__)
 
+# protocol control messages written ahead of the queued messages, E.g ping responses and acks.
+# set chunk size and abort change how the messages after them are read, so they keep their place.
+PRIORITY_TYPES = frozenset((rtmp_type.DT_ACKNOWLEDGEMENT, rtmp_type.DT_USER_CONTROL,
+                            rtmp_type.DT_WINDOW_ACK_SIZE, rtmp_type.DT_SET_PEER_BANDWIDTH))
+
+
+class EncodedElements:
+    """
+    AMF0 elements encoded once, written as is in to command messages.
+
+    Use for parameters shared by many messages, E.g the same
+    message sent to many users.
+    """
+    def __init__(self, elements):
+        """
+        Encode the elements.
+
+        :param elements: The elements, in order.
+        :type elements: list
+        """
+        body_stream = pyamf.util.BufferedByteStream()
+        encoder = amf0.Encoder(body_stream)
+        for element in elements:
+            encoder.writeElement(element)
+        self.data = body_stream.getvalue()
+
+    def __len__(self):
+        return len(self.data)
+
 
 class RtmpWriter:
-    """ This class writes RTMP messages into a stream. """
+    """
+    This class writes RTMP messages into a stream.
+
+    Messages are encoded on the calling thread and queued whole. One thread
+    at a time writes the queue to the stream, so messages written from
+    several threads never interleave their chunks. A caller finding another
+    thread writing leaves its message to that thread instead of waiting.
+
+    Protocol control messages are queued apart, and the writing thread
+    writes them before the next queued message, so a ping response is
+    not kept waiting behind a long run of queued commands.
+    """
 
     # default chunk size
     chunk_size = 128
@@ -20,9 +62,33 @@ class RtmpWriter:
 
         self.stream_id = 0
 
+        self._queue = collections.deque()
+        self._priority = collections.deque()
+        self._sending = threading.Lock()
+
     def flush(self):
-        """ Flush the underlying stream. """
-        self.stream.flush()
+        """ Write any queued messages, and flush the underlying stream. """
+        self._drain()
+
+    def _drain(self):
+        """ Write the queued messages to the stream, unless another thread is. """
+        while self._queue or self._priority:
+            if not self._sending.acquire(False):
+                # the writing thread checks the queues again before it stops.
+                return
+            try:
+                while True:
+                    try:
+                        data = self._priority.popleft()
+                    except IndexError:
+                        try:
+                            data = self._queue.popleft()
+                        except IndexError:
+                            break
+                    self.stream.write(data)
+                self.stream.flush()
+            finally:
+                self._sending.release()
 
     def write(self, message):
         log.debug('send %r', message)
@@ -47,7 +113,10 @@ class RtmpWriter:
 
         elif datatype == rtmp_type.DT_COMMAND:
             for command in message['command']:
-                encoder.writeElement(command)
+                if isinstance(command, EncodedElements):
+                    body_stream.write(command.data)
+                else:
+                    encoder.writeElement(command)
 
             if 'closeStream' in message['command']:
                 self.send_msg(datatype, body_stream.getvalue(), stream_id=self.stream_id)
@@ -113,7 +182,7 @@ class RtmpWriter:
         """
         Helper method that send the specified message into the stream. Takes
         care to prepend the necessary headers and split the message into
-        appropriately sized chunks.
+        appropriately sized chunks. The chunks are queued as one write.
         """
         # Values that just work. :-)
         if 1 <= data_type <= 7:
@@ -129,10 +198,17 @@ class RtmpWriter:
             data_type=data_type,
             body_length=len(body),
             timestamp=timestamp)
-        header.encode(self.stream, _header)
+        out = pyamf.util.BufferedByteStream()
+        header.encode(out, _header)
 
         for i in xrange(0, len(body), self.chunk_size):
             chunk = body[i:i + self.chunk_size]
-            self.stream.write(chunk)
+            out.write(chunk)
             if i+self.chunk_size < len(body):
-                header.encode(self.stream, _header, _header)
+                header.encode(out, _header, _header)
+
+        if data_type in PRIORITY_TYPES:
+            self._priority.append(out.getvalue())
+        else:
+            self._queue.append(out.getvalue())
+        self._drain()
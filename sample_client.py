@@ -1,8 +1,8 @@
 import logging
 import threading
-import time
 
 import ezclib
+import lifecycle
 
 log = logging.getLogger(__name__)
 
@@ -18,8 +18,13 @@ def main():
         t.daemon = True
         t.start()
 
-        while not client.is_connected:
-            time.sleep(2)
+        # returns as soon as the room accepts the connection.
+        if client.lifecycle.wait(lifecycle.JOINED, timeout=30) is None:
+            log.warning('not joined %s within 30 seconds, state: %s' % (room_name, client.lifecycle.state))
+            print ('Failed to join %s.' % room_name)
+            client.disconnect()
+            return
+
         while client.is_connected:
             chat_msg = raw_input()
             client.send_public(chat_msg)
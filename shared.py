@@ -0,0 +1,289 @@
+"""
+Room state published in shared memory, for other processes to read.
+
+The state is a memory mapped file with a fixed layout, E.g in /dev/shm on linux.
+A single writer updates it under a seqlock: the sequence number is odd while
+a write is in progress. Readers copy the state, and retry if the sequence
+number was odd or changed meanwhile, so readers never block the writer.
+
+A new segment replaces the file, readers of the previous segment
+must open the path again to see it.
+
+Layout, little endian:
+    header      magic 4s, layout version H, flags H, sequence Q, capacity I, count I, updated d
+    counters    MAX_COUNTERS Q
+    users       capacity records of 128 bytes: nick length B, nick 63s, status length B, status 31s,
+                mod level i, su i, id q, flags I, 12 padding bytes
+"""
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'EZCS'
+# bump when the layout changes.
+LAYOUT_VERSION = 1
+
+# header flags.
+TRUNCATED = 0x1     # more users than the capacity, the rest are left out.
+
+# user record flags.
+BROADCASTING = 0x1
+MOD = 0x2
+
+# room counters.
+MESSAGES = 0
+PRIVATE_MESSAGES = 1
+JOINS = 2
+LEAVES = 3
+CAMS_STARTED = 4
+CAMS_STOPPED = 5
+
+COUNTER_NAMES = ('messages', 'private_messages', 'joins', 'leaves', 'cams_started', 'cams_stopped')
+MAX_COUNTERS = 8    # room for more counters without changing the layout.
+
+_HEADER = struct.Struct('<4sHHQIId')
+_SEQ = struct.Struct('<Q')
+_SEQ_OFFSET = 8
+_COUNTERS = struct.Struct('<%sQ' % MAX_COUNTERS)
+_COUNTERS_OFFSET = _HEADER.size
+_RECORD = struct.Struct('<B63sB31siiqI12x')
+_RECORDS_OFFSET = _COUNTERS_OFFSET + _COUNTERS.size
+
+# a user read from shared memory.
+UserRecord = collections.namedtuple('UserRecord', ('nick', 'st', 'ml', 'su', 'id', 'flags'))
+
+
+class SharedStateError(Exception):
+    """ Raised when a shared state segment is missing, foreign or of another layout version. """
+    pass
+
+
+class RoomState:
+    """ A consistent copy of the shared room state. """
+    def __init__(self, seq, updated, counters, users, truncated):
+        self.seq = seq
+        self.updated = updated
+        self.counters = counters
+        self.users = users
+        self.truncated = truncated
+
+    def __repr__(self):
+        return '<RoomState seq=%s users=%s counters=%s>' % (self.seq, len(self.users), self.counters)
+
+
+def _size(capacity):
+    return _RECORDS_OFFSET + capacity * _RECORD.size
+
+
+def _encode(value, length):
+    """ UTF-8 encode a string, cut to at most length bytes. """
+    if value is None:
+        return b'', 0
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    value = value[:length]
+    return value, len(value)
+
+
+def _backoff(attempt):
+    """ Yield to the writer, sleeping a little once it keeps writing. """
+    time.sleep(0 if attempt < 100 else 0.0005)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SharedRoomState:
+    """
+    The writer of a shared room state segment.
+
+    Only one process may write a segment. Writes from several
+    threads of that process are serialized by a lock.
+    """
+    def __init__(self, path, capacity=1024):
+        """
+        Create, or replace, a shared room state segment.
+
+        The segment is created in a temporary file renamed over the path,
+        so a segment mapped by readers is never truncated under them.
+
+        :param path: The segment file, E.g /dev/shm/ezclib-room
+        :type path: str
+        :param capacity: The max number of users published.
+        :type capacity: int
+        """
+        self.path = path
+        self.capacity = capacity
+        self._seq = 0
+        self._counters = [0] * MAX_COUNTERS
+        self._lock = threading.Lock()
+
+        size = _size(capacity)
+        tmp_file = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_file, 'w+b') as f:
+            f.truncate(size)
+            self._mm = mmap.mmap(f.fileno(), size)
+        _HEADER.pack_into(self._mm, 0, MAGIC, LAYOUT_VERSION, 0, 0, capacity, 0, time.time())
+        if os.name == 'nt' and os.path.isfile(path):
+            os.remove(path)
+        os.rename(tmp_file, path)
+
+    def count(self, counter, n=1):
+        """
+        Add to a room counter.
+
+        :param counter: The counter, E.g shared.MESSAGES
+        :type counter: int
+        :param n: The amount to add.
+        :type n: int
+        """
+        with self._lock:
+            self._counters[counter] += n
+            self._begin()
+            _COUNTERS.pack_into(self._mm, _COUNTERS_OFFSET, *self._counters)
+            self._end(None)
+
+    def publish(self, users):
+        """
+        Replace the published users.
+
+        :param users: The users.
+        :type users: list of user.User
+        """
+        records = []
+        for _user in users:
+            nick, nick_len = _encode(_user.nick, 63)
+            st, st_len = _encode(_user.st, 31)
+            flags = 0
+            if _user.cam is not None:
+                flags |= BROADCASTING
+            if _user.is_mod:
+                flags |= MOD
+            records.append((nick_len, nick, st_len, st, _int(_user.ml), _int(_user.su), _int(_user.id), flags))
+
+        truncated = len(records) > self.capacity
+        if truncated:
+            records = records[:self.capacity]
+
+        with self._lock:
+            self._begin()
+            offset = _RECORDS_OFFSET
+            for record in records:
+                _RECORD.pack_into(self._mm, offset, *record)
+                offset += _RECORD.size
+            self._end(len(records), TRUNCATED if truncated else 0)
+
+    def close(self):
+        """ Close the segment, and remove the segment file. """
+        with self._lock:
+            self._mm.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _begin(self):
+        """ Make the sequence number odd, readers retry until the write ends. Must hold the lock. """
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+
+    def _end(self, count, flags=None):
+        """ Update the header, then make the sequence number even again. Must hold the lock. """
+        _, version, old_flags, seq, capacity, old_count, _ = _HEADER.unpack_from(self._mm, 0)
+        # the sequence number is still odd, it is made even last, on its own.
+        _HEADER.pack_into(self._mm, 0, MAGIC, version, old_flags if flags is None else flags, seq,
+                          capacity, old_count if count is None else count, time.time())
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+
+
+class SharedRoomStateReader:
+    """ A reader of a shared room state segment, E.g in another process. """
+    def __init__(self, path):
+        """
+        Open a shared room state segment.
+
+        :param path: The segment file.
+        :type path: str
+        """
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise SharedStateError('can not open %s: %s' % (path, e))
+
+        if len(self._mm) < _RECORDS_OFFSET:
+            raise SharedStateError('%s is not a shared room state' % path)
+        magic, version, _, _, capacity, _, _ = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise SharedStateError('%s is not a shared room state' % path)
+        if version != LAYOUT_VERSION:
+            raise SharedStateError('%s has layout version %s, expected %s' % (path, version, LAYOUT_VERSION))
+        if len(self._mm) < _size(capacity):
+            raise SharedStateError('%s is truncated' % path)
+        self.capacity = capacity
+
+    def read(self, retries=10000):
+        """
+        Read a consistent copy of the state.
+
+        :param retries: Max attempts while the writer is writing.
+        :type retries: int
+        :return: The room state.
+        :rtype: RoomState
+        """
+        for attempt in range(retries):
+            seq = _SEQ.unpack_from(self._mm, _SEQ_OFFSET)[0]
+            if seq & 1:
+                _backoff(attempt)
+                continue
+            header = self._mm[:_RECORDS_OFFSET]
+            count = min(_HEADER.unpack_from(header, 0)[5], self.capacity)
+            records = self._mm[_RECORDS_OFFSET:_RECORDS_OFFSET + count * _RECORD.size]
+            if _SEQ.unpack_from(self._mm, _SEQ_OFFSET)[0] == seq:
+                return self._parse(header, records, count)
+            _backoff(attempt)
+        raise SharedStateError('%s kept changing while reading' % self.path)
+
+    def counters(self, retries=10000):
+        """
+        Read a consistent copy of the room counters only.
+
+        :param retries: Max attempts while the writer is writing.
+        :type retries: int
+        :return: A dictionary of counter name to value.
+        :rtype: dict
+        """
+        for attempt in range(retries):
+            seq = _SEQ.unpack_from(self._mm, _SEQ_OFFSET)[0]
+            if seq & 1:
+                _backoff(attempt)
+                continue
+            counters = _COUNTERS.unpack_from(self._mm, _COUNTERS_OFFSET)
+            if _SEQ.unpack_from(self._mm, _SEQ_OFFSET)[0] == seq:
+                return dict(zip(COUNTER_NAMES, counters))
+            _backoff(attempt)
+        raise SharedStateError('%s kept changing while reading' % self.path)
+
+    def close(self):
+        """ Close the segment. """
+        self._mm.close()
+
+    @staticmethod
+    def _parse(header, records, count):
+        _, _, flags, seq, _, _, updated = _HEADER.unpack_from(header, 0)
+        counters = dict(zip(COUNTER_NAMES, _COUNTERS.unpack_from(header, _COUNTERS_OFFSET)))
+        users = []
+        for i in range(count):
+            nick_len, nick, st_len, st, ml, su, user_id, user_flags = _RECORD.unpack_from(records, i * _RECORD.size)
+            users.append(UserRecord(nick[:nick_len].decode('utf-8', 'ignore'), st[:st_len].decode('utf-8', 'ignore'),
+                                    ml, su, user_id, user_flags))
+        return RoomState(seq, updated, counters, users, bool(flags & TRUNCATED))
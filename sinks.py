@@ -0,0 +1,282 @@
+""" Output sinks for events and diagnostics, rendered only when consumed. """
+import collections
+import itertools
+import json
+import logging
+import threading
+import time
+
+# record kinds.
+PACKET = 'packet'            # every amf packet read from the stream.
+EVENT = 'event'              # room events, E.g joins, messages.
+DIAGNOSTIC = 'diagnostic'    # detailed event data, E.g join data.
+ERROR = 'error'              # connection errors.
+
+ALL_KINDS = (PACKET, EVENT, DIAGNOSTIC, ERROR)
+
+
+class Record(object):
+    """
+    Class representing an output record.
+
+    The message is not formatted until render() is called,
+    so records nobody reads cost no formatting.
+    """
+    __slots__ = ('kind', 'time', 'fmt', 'args', '_rendered')
+
+    def __init__(self, kind, fmt, args=()):
+        """
+        Initialize the Record.
+
+        :param kind: The record kind.
+        :type kind: str
+        :param fmt: A format string for args, or a callable returning the message from args.
+        :type fmt: str | callable
+        :param args: The format arguments.
+        :type args: tuple
+        """
+        self.kind = kind
+        self.time = time.time()
+        self.fmt = fmt
+        self.args = args
+        self._rendered = None
+
+    def render(self):
+        """
+        Render the record message, once.
+
+        :return: The message.
+        :rtype: str
+        """
+        if self._rendered is None:
+            if callable(self.fmt):
+                self._rendered = self.fmt(*self.args)
+            elif self.args:
+                self._rendered = self.fmt % self.args
+            else:
+                self._rendered = self.fmt
+        return self._rendered
+
+
+class Sink(object):
+    """ Base sink, accepting the record kinds it was created with, optionally sampling some of them. """
+    def __init__(self, kinds=ALL_KINDS, sample=1, sample_kinds=(PACKET,)):
+        """
+        Initialize the Sink.
+
+        :param kinds: The record kinds to accept.
+        :type kinds: tuple
+        :param sample: Accept 1 in sample records of the sample_kinds.
+        :type sample: int
+        :param sample_kinds: The record kinds to sample.
+        :type sample_kinds: tuple
+        """
+        self.kinds = frozenset(kinds)
+        self.sample = max(1, sample)
+        self.sample_kinds = frozenset(sample_kinds)
+        # next() of itertools.count is atomic, accepts may be called from several threads.
+        self._counter = itertools.count(1)
+
+    def accepts(self, kind):
+        """
+        Check if the sink wants a record kind. Called before a record is created.
+
+        :param kind: The record kind.
+        :type kind: str
+        :return: True if a record of the kind should be emitted to the sink.
+        :rtype: bool
+        """
+        if kind not in self.kinds:
+            return False
+        if self.sample > 1 and kind in self.sample_kinds:
+            return next(self._counter) % self.sample == 1
+        return True
+
+    def emit(self, record):
+        """
+        Consume a record. Subclasses must implement this.
+
+        Only called with records of a kind the sink accepts.
+
+        :param record: The record.
+        :type record: Record
+        :raises NotImplementedError: If a subclass does not implement it.
+        """
+        raise NotImplementedError('%s must implement emit()' % self.__class__.__name__)
+
+    def close(self):
+        """ Release any resources held by the sink. """
+        pass
+
+
+class NullSink(Sink):
+    """ A sink accepting nothing. """
+    def __init__(self):
+        super(NullSink, self).__init__(kinds=())
+
+    def emit(self, record):
+        pass
+
+
+class RingBufferSink(Sink):
+    """ Keeps the latest records, unrendered, in a fixed size buffer. """
+    def __init__(self, capacity=1000, kinds=ALL_KINDS):
+        """
+        Initialize the RingBufferSink.
+
+        :param capacity: The max number of records kept.
+        :type capacity: int
+        :param kinds: The record kinds to accept.
+        :type kinds: tuple
+        """
+        super(RingBufferSink, self).__init__(kinds)
+        self._records = collections.deque(maxlen=capacity)
+
+    @property
+    def records(self):
+        """
+        The buffered records, oldest first.
+
+        :return: A list of records.
+        :rtype: list
+        """
+        return list(self._records)
+
+    def lines(self):
+        """
+        The buffered records rendered.
+
+        :return: A list of messages, oldest first.
+        :rtype: list
+        """
+        return [record.render() for record in list(self._records)]
+
+    def emit(self, record):
+        self._records.append(record)
+
+
+class ConsoleSink(Sink):
+    """ Prints records to the console. """
+    def emit(self, record):
+        print (record.render())
+
+
+class LoggingSink(Sink):
+    """ Passes records to a logger, accepting them only if the logger is enabled for the level. """
+    def __init__(self, logger, level=logging.DEBUG, kinds=ALL_KINDS, sample=1, sample_kinds=(PACKET,)):
+        """
+        Initialize the LoggingSink.
+
+        :param logger: The logger.
+        :type logger: logging.Logger
+        :param level: The log level of the records.
+        :type level: int
+        :param kinds: The record kinds to accept.
+        :type kinds: tuple
+        :param sample: Log 1 in sample records of the sample_kinds.
+        :type sample: int
+        :param sample_kinds: The record kinds to sample.
+        :type sample_kinds: tuple
+        """
+        super(LoggingSink, self).__init__(kinds, sample, sample_kinds)
+        self.logger = logger
+        self.level = level
+
+    def accepts(self, kind):
+        return self.logger.isEnabledFor(self.level) and super(LoggingSink, self).accepts(kind)
+
+    def emit(self, record):
+        self.logger.log(self.level, '[%s] %s', record.kind, record.render())
+
+
+class StructuredFileSink(Sink):
+    """ Writes records to a file as JSON lines, with time, kind and message. """
+    def __init__(self, path, kinds=ALL_KINDS, sample=1, sample_kinds=(PACKET,)):
+        """
+        Initialize the StructuredFileSink.
+
+        :param path: The file path, records are appended.
+        :type path: str
+        :param kinds: The record kinds to accept.
+        :type kinds: tuple
+        :param sample: Write 1 in sample records of the sample_kinds.
+        :type sample: int
+        :param sample_kinds: The record kinds to sample.
+        :type sample_kinds: tuple
+        """
+        super(StructuredFileSink, self).__init__(kinds, sample, sample_kinds)
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps({'time': record.time, 'kind': record.kind, 'msg': record.render()})
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def flush(self):
+        """ Flush the file. """
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class MultiSink(Sink):
+    """
+    Emits records to several sinks.
+
+    accepts() asks every sink, and the sinks that accepted get the record
+    emitted next on the same thread, so each sink samples a record once.
+    """
+    def __init__(self, sinks):
+        """
+        Initialize the MultiSink.
+
+        :param sinks: The sinks.
+        :type sinks: list
+        """
+        kinds = set()
+        for sink in sinks:
+            kinds.update(sink.kinds)
+        super(MultiSink, self).__init__(kinds)
+        self.sinks = list(sinks)
+        self._accepted = threading.local()
+
+    def accepts(self, kind):
+        accepted = [sink for sink in self.sinks if sink.accepts(kind)]
+        self._accepted.kind = kind
+        self._accepted.sinks = accepted
+        return len(accepted) > 0
+
+    def emit(self, record):
+        if getattr(self._accepted, 'kind', None) == record.kind:
+            accepted = self._accepted.sinks
+            self._accepted.kind = None
+        else:
+            # emitted without asking accepts first.
+            accepted = [sink for sink in self.sinks if sink.accepts(record.kind)]
+        for sink in accepted:
+            sink.emit(record)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def format_indexed(title, data):
+    """
+    Render a list as indexed lines, E.g for join data.
+
+    :param title: The title line.
+    :type title: str
+    :param data: The list.
+    :type data: list
+    :return: The rendered lines.
+    :rtype: str
+    """
+    lines = [title]
+    for i, v in enumerate(data):
+        lines.append('\t[%s] - %s' % (i, v))
+    return '\n'.join(lines)
@@ -0,0 +1,76 @@
+""" Compact snapshot files of room state, for a warm start after a restart. """
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+# bump when the layout of the snapshot changes, older snapshots are ignored.
+VERSION = 1
+
+
+def write(path, state):
+    """
+    Write a snapshot, replacing the previous one.
+
+    The state is written as gzipped JSON to a temporary file of its own,
+    which is then renamed, so a crash or a concurrent write never leaves a partial snapshot.
+
+    :param path: The snapshot file.
+    :type path: str
+    :param state: JSON serializable state.
+    :type state: dict
+    :return: True if written.
+    :rtype: bool
+    """
+    data = {'version': VERSION, 'time': time.time(), 'state': state}
+    tmp_file = None
+    try:
+        fd, tmp_file = tempfile.mkstemp(prefix='%s.' % os.path.basename(path), suffix='.tmp',
+                                        dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        with gzip.open(tmp_file, 'wb') as f:
+            f.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        if os.name == 'nt' and os.path.isfile(path):
+            os.remove(path)
+        os.rename(tmp_file, path)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        log.warning('could not write snapshot %s: %s' % (path, e))
+        if tmp_file is not None and os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        return False
+    return True
+
+
+def read(path, max_age=None):
+    """
+    Read a snapshot.
+
+    :param path: The snapshot file.
+    :type path: str
+    :param max_age: Ignore a snapshot older than this many seconds, None for no limit.
+    :type max_age: int | float | None
+    :return: The state, or None if there is no usable snapshot.
+    :rtype: dict | None
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with gzip.open(path, 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+    except (EOFError, IOError, OSError, ValueError, zlib.error) as e:
+        # E.g a truncated or corrupt file, the same as no snapshot.
+        log.warning('could not read snapshot %s: %s' % (path, e))
+        return None
+
+    if data.get('version') != VERSION:
+        log.info('ignoring snapshot %s of version %s' % (path, data.get('version')))
+        return None
+    if max_age is not None and time.time() - data['time'] > max_age:
+        log.info('ignoring stale snapshot %s' % path)
+        return None
+    return data['state']
@@ -1,8 +1,83 @@
-
-class Client:
+import bisect
+import json
+import sys
+
+# the fastest available json backend for large userlists.
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern
+
+def intern_string(value):
+    """
+    Intern a nick or status string, so equal strings are shared across rooms.
+
+    Interned strings are freed once no longer used. py2 can only intern
+    byte strings, so py2 unicode strings are returned as is.
+
+    :param value: The string, other types are returned as is.
+    :type value: str
+    :return: The shared string.
+    :rtype: str
+    """
+    if type(value) is str:
+        return _intern(value)
+    return value
+
+
+def casefold(nick):
+    """
+    Casefold a nick for case insensitive lookups.
+
+    :param nick: The nick.
+    :type nick: str
+    :return: The casefolded nick.
+    :rtype: str
+    """
+    try:
+        return nick.casefold()
+    except AttributeError:
+        return nick.lower()
+
+
+def parse_userlist(data):
+    """
+    Parse a sendUserList payload.
+
+    The payload is a json object of nick to a json string of the user data.
+    All the user data strings are parsed in one call, rather than one call per user.
+
+    :param data: The sendUserList payload.
+    :type data: str
+    :return: A list of (nick, user data) tuples.
+    :rtype: list
+    """
+    outer = _json.loads(data)
+    nicks = list(outer)
+    values = [outer[nick] for nick in nicks]
+    if all(isinstance(value, (type(u''), str)) for value in values):
+        values = _json.loads(u'[' + u','.join(values) + u']')
+    return list(zip(nicks, values))
+
+
+# the user data keys that can change while a user is in the room.
+USER_FIELDS = ('ml', 'id', 'su', 'st')
+
+
+class Client(object):
     """ Class representing the client. """
+    __slots__ = ('nick', 'key', 'join_time', 'ml', 'id', 'su', 'st')
+
     def __init__(self, nick):
-        self.nick = u'' + nick
+        self.nick = intern_string(u'' + nick)
         self.key = u''
         self.join_time = 0
         self.ml = 0
@@ -56,17 +131,30 @@ class Client:
         self.ml = data.get('ml', 0)      # mod level
         self.id = data.get('id', 0)      # ezcapechat user id (if logged in)
         self.su = data.get('su', 0)      # ?
-        self.st = data.get('st')         # status related
+        self.st = intern_string(data.get('st'))  # status related
 
 
-class User:
+class User(object):
     """ Class representing a user. """
+    __slots__ = ('ml', 'nick', 'id', 'su', 'st', 'cam')
+
     def __init__(self, **data):
-        self.ml = data.get('ml', 0)      # mod level
-        self.nick = data.get('un', '')   # nick
-        self.id = data.get('id', 0)      # ezcapechat user id (if logged in)
-        self.su = data.get('su', 0)      # ?
-        self.st = data.get('st')         # status related
+        self.ml = data.get('ml', 0)                     # mod level
+        self.nick = intern_string(data.get('un', ''))   # nick
+        self.id = data.get('id', 0)                     # ezcapechat user id (if logged in)
+        self.su = data.get('su', 0)                     # ?
+        self.st = intern_string(data.get('st'))         # status related
+        self.cam = None                                 # the cam list entry, if broadcasting
+
+    @property
+    def is_broadcasting(self):
+        """
+        Is the user broadcasting a cam.
+
+        :return: True if the user is in the cam list.
+        :rtype: bool
+        """
+        return self.cam is not None
 
     @property
     def is_mod(self):
@@ -106,10 +194,20 @@ class User:
 
 
 class Users:
-    """ Class for doing various client/user related operations. """
+    """
+    Class for doing various client/user related operations.
+
+    The users are indexed by mod level, ezcapechat id and casefolded nick.
+    Changes to a user must go through add, update, remove or clear to keep the indexes consistent.
+    """
     def __init__(self):
         self._users = dict()
         self._client = Client
+        self._by_ml = dict()        # mod level: {nick: User}
+        self._by_id = dict()        # ezcapechat user id: User
+        self._by_fold = dict()      # casefolded nick: tuple of nicks
+        self._sorted = []           # sorted (casefolded nick, nick) tuples
+        self._cams = dict()         # nick: cam list entry, including users not in the user dictionary yet
 
     @property
     def client(self):
@@ -136,13 +234,13 @@ class Users:
         """
         Returns a list of all the mods in the room.
 
-        :return:
-        :rtype:
+        :return: A list of User objects with a mod level of 100 or more.
+        :rtype: list
         """
         _mods = []
-        for username in self.all:
-            if self.all[username].is_mod:
-                _mods.append(self.all[username])
+        for ml in self._by_ml:
+            if ml >= 100:
+                _mods.extend(self._by_ml[ml].values())
         return _mods
 
     @property
@@ -150,14 +248,34 @@ class Users:
         """
         Return a list of all the supers in the room.
 
-        :return:
-        :rtype:
+        :return: A list of User objects with a mod level of 150.
+        :rtype: list
+        """
+        return self.by_mod_level(150)
+
+    def by_mod_level(self, ml):
         """
-        _supers = []
-        for username in self.all:
-            if self.all[username].is_super:
-                _supers.append(self.all[username])
-        return _supers
+        Return a list of the users with a mod level.
+
+        :param ml: The mod level, E.g 200 for the room owner.
+        :type ml: int
+        :return: A list of User objects.
+        :rtype: list
+        """
+        if ml in self._by_ml:
+            return list(self._by_ml[ml].values())
+        return []
+
+    def by_id(self, user_id):
+        """
+        Find a user by ezcapechat user id.
+
+        :param user_id: The ezcapechat user id.
+        :type user_id: int
+        :return: The user if found, else None
+        :rtype: User | None
+        """
+        return self._by_id.get(user_id)
 
     def add_client(self, nick):
         """
@@ -188,11 +306,114 @@ class Users:
         :return: User if the user nick was not in the user dictionary, else None.
         :rtype: User | None
         """
+        nick = intern_string(nick)
         if nick not in self._users:
-            self._users[nick] = User(**user_data)
-            return self._users[nick]
+            _user = User(**user_data)
+            _user.cam = self._cams.get(nick)
+            self._users[nick] = _user
+            self._index(nick, _user)
+            return _user
         return None
 
+    def add_many(self, users, exclude=None):
+        """
+        Add many users at once, E.g from a parsed userlist.
+
+        The indexes are built in one batch, which is much faster than
+        calling add for each user in large rooms.
+
+        :param users: A list of (nick, user data) tuples, as returned by parse_userlist.
+        :type users: list
+        :param exclude: A nick not to add, E.g the client nick.
+        :type exclude: str
+        :return: The added users, users already in the user dictionary are skipped.
+        :rtype: list
+        """
+        added = []
+        folded_nicks = []
+        for nick, user_data in users:
+            nick = intern_string(nick)
+            if nick == exclude or nick in self._users:
+                continue
+            _user = User(**user_data)
+            _user.cam = self._cams.get(nick)
+            self._users[nick] = _user
+            self._index_ml_id(nick, _user)
+            folded_nicks.append((self._index_fold(nick), nick))
+            added.append(_user)
+
+        if folded_nicks:
+            # timsort merges the sorted runs, cheaper than an insort per user.
+            self._sorted.extend(folded_nicks)
+            self._sorted.sort()
+        return added
+
+    def reconcile(self, users, exclude=None):
+        """
+        Reconcile the user dictionary with a full userlist, E.g after a reconnect.
+
+        Users in the userlist but not in the user dictionary are added, users
+        no longer in the userlist are removed, and the data of the remaining
+        users is updated. Every user in the userlist is compared, so the cost is O(room size),
+        but only the users that changed are updated, and only the changes are returned.
+
+        :param users: A list of (nick, user data) tuples, as returned by parse_userlist.
+        :type users: list
+        :param exclude: A nick not to add, E.g the client nick.
+        :type exclude: str
+        :return: The joined users, the users that left, and (user, previous mod level)
+                 tuples for the users with a changed mod level.
+        :rtype: tuple
+        """
+        userlist = {}
+        new = []
+        changed = []
+        for nick, user_data in users:
+            nick = intern_string(nick)
+            if nick == exclude:
+                continue
+            userlist[nick] = user_data
+
+            _user = self._users.get(nick)
+            if _user is None:
+                new.append((nick, user_data))
+            elif any(key in user_data and getattr(_user, key) != user_data[key] for key in USER_FIELDS):
+                ml = _user.ml
+                self.update(nick, user_data)
+                if _user.ml != ml:
+                    changed.append((_user, ml))
+
+        left = [self.remove(nick) for nick in list(self._users) if nick not in userlist]
+        joined = self.add_many(new)
+        return joined, left, changed
+
+    def update(self, nick, user_data):
+        """
+        Update the data of a user, E.g after a status or mod level change.
+
+        :param nick: The nick of the user.
+        :type nick: str
+        :param user_data: The changed user data, using the same keys as the join data.
+        :type user_data: dict
+        :return: The updated user, or None if the nick is not in the user dictionary.
+        :rtype: User | None
+        """
+        if nick not in self._users:
+            return None
+
+        _user = self._users[nick]
+        self._unindex_ml_id(nick, _user)
+        if 'ml' in user_data:
+            _user.ml = user_data['ml']
+        if 'id' in user_data:
+            _user.id = user_data['id']
+        if 'su' in user_data:
+            _user.su = user_data['su']
+        if 'st' in user_data:
+            _user.st = intern_string(user_data['st'])
+        self._index_ml_id(nick, _user)
+        return _user
+
     def remove(self, nick):
         """
         Remove a user from the user dictionary.
@@ -205,14 +426,99 @@ class Users:
         if nick in self._users:
             deleted_user = self._users[nick]
             del self._users[nick]
+            self._unindex(nick, deleted_user)
+            self._cams.pop(nick, None)
+            deleted_user.cam = None
             return deleted_user
         return None
 
+    def clear(self):
+        """ Remove all users, E.g before a full userlist reload. """
+        self._users.clear()
+        self._by_ml.clear()
+        self._by_id.clear()
+        self._by_fold.clear()
+        del self._sorted[:]
+        self._cams.clear()
+
+    def snapshot(self):
+        """
+        The client info, users and cam roster, for restoring after a restart.
+
+        :return: A JSON serializable dictionary.
+        :rtype: dict
+        """
+        client = dict((key, getattr(self._client, key)) for key in ('key', 'join_time') + USER_FIELDS)
+        # copied first, the snapshot may be taken on another thread.
+        users = [[nick, {'un': nick, 'ml': _user.ml, 'id': _user.id, 'su': _user.su, 'st': _user.st}]
+                 for nick, _user in list(self._users.items())]
+        return {'client': client, 'users': users, 'cams': dict(self._cams)}
+
+    def restore(self, state):
+        """
+        Replace the users and cam roster with a snapshot.
+
+        The client nick is kept, the rest of the client info is restored.
+
+        :param state: A dictionary from snapshot.
+        :type state: dict
+        :return: The number of users restored.
+        :rtype: int
+        """
+        self.clear()
+        for key, value in state['client'].items():
+            if key in Client.__slots__ and key != 'nick':
+                setattr(self._client, key, intern_string(value))
+        self._cams.update((intern_string(nick), entry) for nick, entry in state['cams'].items())
+        return len(self.add_many(state['users'], exclude=self._client.nick))
+
+    @property
+    def cams(self):
+        """
+        The nicks broadcasting a cam.
+
+        :return: A list of nicks in the cam list.
+        :rtype: list
+        """
+        return list(self._cams)
+
+    def update_cams(self, cams):
+        """
+        Update the cam roster from a full cam list.
+
+        Only the differences to the current roster are applied,
+        the entries of cams still broadcasting are replaced.
+
+        :param cams: The decoded cam list, {nick: cam entry}
+        :type cams: dict
+        :return: The nicks that started broadcasting, and the nicks that stopped.
+        :rtype: tuple
+        """
+        started = [nick for nick in cams if nick not in self._cams]
+        stopped = [nick for nick in self._cams if nick not in cams]
+
+        for nick in stopped:
+            del self._cams[nick]
+            _user = self._users.get(nick)
+            if _user is not None:
+                _user.cam = None
+
+        for nick in cams:
+            entry = cams[nick]
+            nick = intern_string(nick)
+            self._cams[nick] = entry
+            _user = self._users.get(nick)
+            if _user is not None:
+                _user.cam = entry
+        return started, stopped
+
     def search(self, nick):
         """
         Search the user dictionary
         for a user matching the nick.
 
+        An exact match is preferred, else the nick is matched case insensitive.
+
         :param nick: The nick of the user to search for.
         :type nick: str
         :return: The user if found, else None
@@ -220,4 +526,78 @@ class Users:
         """
         if nick in self._users:
             return self._users[nick]
+
+        matches = self._by_fold.get(casefold(nick))
+        if matches:
+            return self._users[matches[0]]
         return None
+
+    def search_prefix(self, prefix):
+        """
+        Find the users with a nick starting with a prefix, case insensitive.
+
+        :param prefix: The nick prefix.
+        :type prefix: str
+        :return: A list of User objects, sorted by nick.
+        :rtype: list
+        """
+        prefix = casefold(prefix)
+        _users = []
+        i = bisect.bisect_left(self._sorted, (prefix,))
+        while i < len(self._sorted) and self._sorted[i][0].startswith(prefix):
+            _users.append(self._users[self._sorted[i][1]])
+            i += 1
+        return _users
+
+    def search_contains(self, text):
+        """
+        Find the users with a nick containing a text, case insensitive.
+
+        :param text: The text to look for in the nicks.
+        :type text: str
+        :return: A list of User objects, sorted by nick.
+        :rtype: list
+        """
+        text = casefold(text)
+        return [self._users[nick] for folded, nick in self._sorted if text in folded]
+
+    def _index(self, nick, _user):
+        """ Add a user to all indexes. """
+        self._index_ml_id(nick, _user)
+        bisect.insort(self._sorted, (self._index_fold(nick), nick))
+
+    def _index_fold(self, nick):
+        """ Add a nick to the casefold index, returning the casefolded nick. """
+        # interned, so a nick that is already casefolded is stored once.
+        folded = intern_string(casefold(nick))
+        self._by_fold[folded] = self._by_fold.get(folded, ()) + (nick,)
+        return folded
+
+    def _unindex(self, nick, _user):
+        """ Remove a user from all indexes. """
+        self._unindex_ml_id(nick, _user)
+        folded = casefold(nick)
+        matches = tuple(n for n in self._by_fold.get(folded, ()) if n != nick)
+        if matches:
+            self._by_fold[folded] = matches
+        else:
+            self._by_fold.pop(folded, None)
+        i = bisect.bisect_left(self._sorted, (folded, nick))
+        if i < len(self._sorted) and self._sorted[i] == (folded, nick):
+            del self._sorted[i]
+
+    def _index_ml_id(self, nick, _user):
+        """ Add a user to the mod level and id indexes. """
+        self._by_ml.setdefault(_user.ml, {})[nick] = _user
+        if _user.id:
+            self._by_id[_user.id] = _user
+
+    def _unindex_ml_id(self, nick, _user):
+        """ Remove a user from the mod level and id indexes. """
+        users = self._by_ml.get(_user.ml)
+        if users is not None:
+            users.pop(nick, None)
+            if not users:
+                del self._by_ml[_user.ml]
+        if _user.id and self._by_id.get(_user.id) is _user:
+            del self._by_id[_user.id]
@@ -0,0 +1,79 @@
+""" Cross process file locking. """
+import os
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger(__name__)
+
+
+class FileLock:
+    """
+    An exclusive advisory lock on a local file.
+
+    The lock is held from acquire() until release(), and can be
+    used as a context manager. It blocks other processes using a
+    FileLock on the same path, not other threads in the same process.
+    """
+    def __init__(self, path):
+        """
+        Initialize the FileLock.
+
+        :param path: The path of the lock file.
+        :type path: str
+        """
+        self.path = path
+        self._fd = None
+
+    @property
+    def is_locked(self):
+        """
+        Is the lock held by this instance.
+
+        :return: True if the lock is held.
+        :rtype: bool
+        """
+        return self._fd is not None
+
+    def acquire(self):
+        """ Acquire the lock, blocking until it is available. """
+        if self._fd is not None:
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        except (IOError, OSError):
+            os.close(fd)
+            raise
+        self._fd = fd
+        log.debug('acquired file lock: %s' % self.path)
+
+    def release(self):
+        """ Release the lock. """
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            log.debug('released file lock: %s' % self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -0,0 +1,292 @@
+""" A pool of proxies with health scoring and latency aware selection. """
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+HTTP = 'http'
+SOCKS4 = 'socks4'
+SOCKS5 = 'socks5'
+
+PROXY_SCHEMES = (HTTP, SOCKS4, SOCKS5)
+
+
+class NoProxyAvailableError(Exception):
+    """ Raised when the proxy pool is empty. """
+    pass
+
+
+class Proxy:
+    """ Class representing a proxy in the pool, and its health. """
+    def __init__(self, scheme, host, port):
+        """
+        Initialize the Proxy.
+
+        :param scheme: The proxy type. http, socks4 or socks5
+        :type scheme: str
+        :param host: The proxy host.
+        :type host: str
+        :param port: The proxy port.
+        :type port: int
+        """
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+
+        self.latency = None         # moving average connect latency in seconds.
+        self.failure_rate = 0.0     # moving average of failures, 0.0 - 1.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0
+        self.quarantine_count = 0
+        self.active = 0
+
+    @property
+    def address(self):
+        """
+        The proxy address.
+
+        :return: The proxy address as host:port
+        :rtype: str
+        """
+        return '%s:%s' % (self.host, self.port)
+
+    @property
+    def url(self):
+        """
+        The proxy url.
+
+        :return: The proxy url, E.g socks5://host:port
+        :rtype: str
+        """
+        return '%s://%s' % (self.scheme, self.address)
+
+    @property
+    def is_quarantined(self):
+        """
+        Is the proxy quarantined.
+
+        :return: True if the proxy is in quarantine.
+        :rtype: bool
+        """
+        return self.quarantined_until > time.time()
+
+    def __repr__(self):
+        return '<Proxy %s latency=%s failure_rate=%.2f active=%s>' % \
+               (self.url, self.latency, self.failure_rate, self.active)
+
+
+def parse_proxy(proxy):
+    """
+    Parse a proxy string.
+
+    :param proxy: The proxy as scheme://host:port or host:port (http)
+    :type proxy: str
+    :return: The scheme, host and port.
+    :rtype: tuple
+    """
+    scheme = HTTP
+    if '://' in proxy:
+        scheme, proxy = proxy.split('://', 1)
+        scheme = scheme.lower()
+        if scheme not in PROXY_SCHEMES:
+            raise ValueError('unsupported proxy type: %s' % scheme)
+    host, port = proxy.rsplit(':', 1)
+    return scheme, host, int(port)
+
+
+class ProxyPool:
+    """
+    A pool of HTTP, SOCKS4 and SOCKS5 proxies.
+
+    Connect latency and failures are tracked per proxy as moving averages,
+    and each new connection gets the healthy proxy with the best score.
+    Proxies failing repeatedly are quarantined, for a period growing
+    with each quarantine, and taken back in to use when it ends.
+    """
+    def __init__(self, proxies=None, alpha=0.3, max_failures=3, max_failure_rate=0.5,
+                 quarantine_time=60, max_quarantine_time=3600, load_factor=0.1):
+        """
+        Initialize the ProxyPool.
+
+        :param proxies: Proxy strings, scheme://host:port or host:port
+        :type proxies: list
+        :param alpha: Smoothing factor of the moving averages.
+        :type alpha: float
+        :param max_failures: Consecutive failures before quarantine.
+        :type max_failures: int
+        :param max_failure_rate: Failure rate before quarantine.
+        :type max_failure_rate: float
+        :param quarantine_time: Seconds of the first quarantine, doubled for each following.
+        :type quarantine_time: int | float
+        :param max_quarantine_time: Max seconds of a quarantine.
+        :type max_quarantine_time: int | float
+        :param load_factor: Score penalty for each active connection through a proxy.
+        :type load_factor: float
+        """
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.max_failure_rate = max_failure_rate
+        self.quarantine_time = quarantine_time
+        self.max_quarantine_time = max_quarantine_time
+        self.load_factor = load_factor
+
+        self._proxies = []
+        self._lock = threading.Lock()
+
+        if proxies is not None:
+            for proxy in proxies:
+                self.add(proxy)
+
+    @property
+    def all(self):
+        """
+        All the proxies in the pool.
+
+        :return: A list of Proxy objects.
+        :rtype: list
+        """
+        return list(self._proxies)
+
+    @property
+    def healthy(self):
+        """
+        The proxies not in quarantine.
+
+        :return: A list of Proxy objects.
+        :rtype: list
+        """
+        return [proxy for proxy in self._proxies if not proxy.is_quarantined]
+
+    def add(self, proxy):
+        """
+        Add a proxy to the pool.
+
+        :param proxy: The proxy as scheme://host:port or host:port
+        :type proxy: str
+        :return: The Proxy if added, else None if already in the pool.
+        :rtype: Proxy | None
+        """
+        scheme, host, port = parse_proxy(proxy)
+        with self._lock:
+            for _proxy in self._proxies:
+                if _proxy.scheme == scheme and _proxy.host == host and _proxy.port == port:
+                    return None
+            _proxy = Proxy(scheme, host, port)
+            self._proxies.append(_proxy)
+            return _proxy
+
+    def remove(self, proxy):
+        """
+        Remove a proxy from the pool.
+
+        :param proxy: The Proxy to remove.
+        :type proxy: Proxy
+        """
+        with self._lock:
+            if proxy in self._proxies:
+                self._proxies.remove(proxy)
+
+    def score(self, proxy):
+        """
+        The score of a proxy, lower is better.
+
+        :param proxy: The Proxy to score.
+        :type proxy: Proxy
+        :return: The score.
+        :rtype: float
+        """
+        if proxy.latency is None:
+            # untried proxies go first, so they get a latency.
+            return 0.0
+        return proxy.latency * (1 + proxy.failure_rate * 10) * (1 + proxy.active * self.load_factor)
+
+    def acquire(self):
+        """
+        Pick the best proxy for a new connection.
+
+        If all proxies are quarantined, the one leaving quarantine first is used.
+
+        :return: The best proxy.
+        :rtype: Proxy
+        :raises NoProxyAvailableError: If the pool is empty.
+        """
+        return self.acquire_many(1)[0]
+
+    def acquire_many(self, count):
+        """
+        Pick the best proxies, E.g to race a connection through them.
+
+        :param count: The max number of proxies to pick.
+        :type count: int
+        :return: A list of proxies, best first.
+        :rtype: list
+        :raises NoProxyAvailableError: If the pool is empty.
+        """
+        with self._lock:
+            if not self._proxies:
+                raise NoProxyAvailableError('the proxy pool is empty')
+
+            now = time.time()
+            healthy = sorted([proxy for proxy in self._proxies if proxy.quarantined_until <= now], key=self.score)
+            if not healthy:
+                healthy = [min(self._proxies, key=lambda p: p.quarantined_until)]
+                log.warning('all proxies are quarantined, using: %s' % healthy[0])
+            best = healthy[:count]
+            for proxy in best:
+                proxy.active += 1
+
+        log.debug('acquired proxies: %s' % best)
+        return best
+
+    def release(self, proxy):
+        """
+        Release a proxy no longer used by a connection.
+
+        :param proxy: The Proxy to release.
+        :type proxy: Proxy
+        """
+        with self._lock:
+            if proxy.active > 0:
+                proxy.active -= 1
+
+    def report_success(self, proxy, latency):
+        """
+        Report a successful connection through a proxy.
+
+        :param proxy: The Proxy used.
+        :type proxy: Proxy
+        :param latency: The connect latency in seconds.
+        :type latency: float
+        """
+        with self._lock:
+            if proxy.latency is None:
+                proxy.latency = latency
+            else:
+                proxy.latency += self.alpha * (latency - proxy.latency)
+            proxy.failure_rate -= self.alpha * proxy.failure_rate
+            proxy.successes += 1
+            proxy.consecutive_failures = 0
+            proxy.quarantine_count = 0
+
+    def report_failure(self, proxy):
+        """
+        Report a failed connection through a proxy.
+
+        :param proxy: The Proxy used.
+        :type proxy: Proxy
+        """
+        with self._lock:
+            proxy.failure_rate += self.alpha * (1 - proxy.failure_rate)
+            proxy.failures += 1
+            proxy.consecutive_failures += 1
+
+            if proxy.consecutive_failures >= self.max_failures or \
+                    (proxy.failure_rate > self.max_failure_rate and proxy.consecutive_failures > 1):
+                quarantine = min(self.max_quarantine_time, self.quarantine_time * (2 ** proxy.quarantine_count))
+                proxy.quarantined_until = time.time() + quarantine
+                proxy.quarantine_count += 1
+                proxy.consecutive_failures = 0
+                log.warning('proxy %s quarantined for %ss' % (proxy.url, quarantine))
@@ -1,11 +1,18 @@
-""" Web related functions and utilities. version 0.0.7 """
+""" Web related functions and utilities. version 0.0.9 """
 import time
+import random
 import logging
+import threading
 import requests
 import requests_toolbelt
 import requests.utils as utils
 import requests.structures as structures
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 __all__ = ['utils', 'requests_toolbelt', 'structures']
 
 # Default user agent.
@@ -82,6 +89,46 @@ def has_cookie(cookie_name):
     return False
 
 
+def get_cookies(domain=None):
+    """
+    Export the session cookies.
+
+    :param domain: Only export cookies for this domain.
+    :type domain: str | None
+    :return: A list of cookie dictionaries.
+    :rtype: list
+    """
+    cookies = []
+    for cookie in __session.cookies:
+        if domain is None or domain in cookie.domain:
+            cookies.append({
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'expires': cookie.expires
+            })
+    return cookies
+
+
+def set_cookies(cookies):
+    """
+    Import cookies, previously exported with get_cookies, in to the session.
+
+    :param cookies: A list of cookie dictionaries.
+    :type cookies: list
+    """
+    for cookie in cookies:
+        __session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'],
+                              path=cookie['path'], expires=cookie['expires'])
+    log.debug('session cookies after import: %s' % __session.cookies)
+
+
+class DeadlineExceededError(Exception):
+    """ Raised(set as Response.error) when the retry policy deadline was reached. """
+    pass
+
+
 class Response:
     """ Class representing a response. """
     def __init__(self, content, json, cookies, headers, status_code, error=None):
@@ -94,9 +141,171 @@ class Response:
         self.headers = headers
         self.status_code = status_code
         self.error = error
+        self.attempts = 1
+
+
+class RetryPolicy:
+    """
+    Retry policy for get and post requests.
+
+    Each attempt gets its own timeout, failed attempts are retried
+    after a capped exponential backoff, and no attempt is started
+    after the overall deadline. GET requests can optionally be hedged,
+    meaning a second attempt is started if the first one is slow,
+    and the first response to arrive is used.
+    """
+    def __init__(self, attempts=3, timeout=10, backoff=0.5, max_backoff=5, deadline=30,
+                 hedge_after=None, retry_status=(429, 500, 502, 503, 504)):
+        """
+        Initialize the RetryPolicy.
+
+        :param attempts: The maximum number of attempts.
+        :type attempts: int
+        :param timeout: The timeout in seconds for each attempt.
+        :type timeout: int | float
+        :param backoff: The delay in seconds before the first retry, doubled for each retry.
+        :type backoff: int | float
+        :param max_backoff: The maximum delay in seconds between attempts.
+        :type max_backoff: int | float
+        :param deadline: The overall time in seconds for all attempts.
+        :type deadline: int | float
+        :param hedge_after: Start a second GET attempt after this many seconds, None to disable.
+        :type hedge_after: int | float | None
+        :param retry_status: Status codes that should be retried.
+        :type retry_status: tuple
+        """
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.retry_status = retry_status
+
+    def should_retry(self, response):
+        """
+        Check if a response should be retried.
+
+        :param response: The response of an attempt.
+        :type response: Response
+        :return: True if the attempt failed and should be retried.
+        :rtype: bool
+        """
+        if response.error is not None:
+            return True
+        return response.status_code in self.retry_status
+
+    def backoff_delay(self, attempt):
+        """
+        The delay before the next attempt, with jitter.
+
+        :param attempt: The number of the failed attempt, starting at 0.
+        :type attempt: int
+        :return: The delay in seconds.
+        :rtype: float
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def _hedged(request_func, policy, *args, **options):
+    """
+    Run a request, starting a second identical request
+    if the first has not completed within policy.hedge_after seconds.
+
+    :return: The first successful response, or the last failed one.
+    :rtype: Response
+    """
+    timeout = options['timeout']
+    responses = queue.Queue()
+
+    def _run():
+        responses.put(request_func(*args, **options))
+
+    def _start():
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+
+    start = time.time()
+    _start()
+    pending = 1
+    hedged = False
+    response = None
+    while pending:
+        if hedged:
+            wait = timeout - (time.time() - start)
+        else:
+            wait = min(policy.hedge_after, timeout) - (time.time() - start)
+
+        try:
+            response = responses.get(timeout=max(wait, 0.001))
+        except queue.Empty:
+            if hedged or time.time() - start >= timeout:
+                break
+            log.debug('hedging slow request: %s' % (args,))
+            _start()
+            pending += 1
+            hedged = True
+            continue
+
+        pending -= 1
+        if not hedged or not policy.should_retry(response):
+            break
+
+    if response is None:
+        response = Response(None, None, None, None, None, error=DeadlineExceededError('hedged request timed out'))
+    return response
+
+
+def _with_retry(request_func, policy, *args, **options):
+    """
+    Run a request according to a retry policy.
+
+    :param request_func: The request function, get or post.
+    :type request_func: function
+    :param policy: The retry policy.
+    :type policy: RetryPolicy
+    :return: The first successful response, or the last failed one.
+    :rtype: Response
+    """
+    start = time.time()
+    response = None
+    attempt = 0
+    while attempt < policy.attempts:
+        remaining = policy.deadline - (time.time() - start)
+        if remaining <= 0:
+            break
+
+        options['timeout'] = min(policy.timeout, remaining)
+        if policy.hedge_after is not None and request_func is get:
+            response = _hedged(request_func, policy, *args, **options)
+        else:
+            response = request_func(*args, **options)
+        attempt += 1
+        response.attempts = attempt
+
+        if not policy.should_retry(response):
+            return response
+
+        delay = policy.backoff_delay(attempt - 1)
+        if attempt == policy.attempts or time.time() - start + delay >= policy.deadline:
+            break
+        log.debug('attempt %s failed (%s, %s) retrying in %.2fs' %
+                  (attempt, response.status_code, response.error, delay))
+        time.sleep(delay)
+
+    if response is None:
+        response = Response(None, None, None, None, None,
+                            error=DeadlineExceededError('deadline of %ss exceeded' % policy.deadline))
+    return response
 
 
 def get(url, **options):
+    retry = options.pop('retry', None)
+    if retry is not None:
+        return _with_retry(get, retry, url, **options)
+
     json = options.get('json', False)
     proxy = options.get('proxy', u'')
     header = options.get('header', None)
@@ -114,9 +323,11 @@ def get(url, **options):
         default_header.update(header)
 
     if proxy:
+        if '://' not in proxy:
+            proxy = 'http://%s' % proxy
         _proxy = {
-            'https': 'http://%s' % proxy,
-            'http': 'http://%s' % proxy
+            'https': proxy,
+            'http': proxy
         }
         proxy = _proxy
 
@@ -148,6 +359,14 @@ def get(url, **options):
 
 
 def post(url, post_data, **options):
+    retry = options.pop('retry', None)
+    if retry is not None:
+        return _with_retry(post, retry, url, post_data, **options)
+
+    if callable(post_data):
+        # a post data factory, so stream data can be created again for each attempt.
+        post_data = post_data()
+
     json = options.get('json', False)
     proxy = options.get('proxy', u'')
     header = options.get('header', None)
@@ -167,9 +386,11 @@ def post(url, post_data, **options):
         default_header.update(header)
 
     if proxy:
+        if '://' not in proxy:
+            proxy = 'http://%s' % proxy
         _proxy = {
-            'https': 'http://%s' % proxy,
-            'http': 'http://%s' % proxy
+            'https': proxy,
+            'http': proxy
         }
         proxy = _proxy
 